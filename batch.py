@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from controller import register_images
+from workspace import Workspace
+
+def load_manifest(path):
+    with open(path) as f:
+        manifest = json.load(f)
+
+    if isinstance(manifest, dict):
+        manifest = manifest["jobs"]
+
+    jobs = []
+    for i in range(len(manifest)):
+        job = dict(manifest[i])
+
+        if isinstance(job["moving"], str):
+            job["moving"] = [job["moving"]]
+
+        job.setdefault("job_id", "job_{:04d}".format(i))
+        job.setdefault("registration_channel", 0)
+
+        jobs.append(job)
+
+    return jobs
+
+def threads_per_job(max_workers):
+    return max(1, (os.cpu_count() or 1) // max_workers)
+
+def run_job(job, output_directory, num_threads, params=None, progress_callback=None, telemetry_callback=None):
+    result = {"job_id": job["job_id"], "status": "finished", "warped_moving_image_paths": [], "failed_channels": [], "error": None}
+
+    workspace = Workspace(output_directory, job_id=job["job_id"])
+
+    try:
+        controller, apply_transforms_results = register_images(job["fixed"], job["moving"], params=params, registration_channel=job["registration_channel"], workspace_root=output_directory, job_id=job["job_id"], num_threads=num_threads, progress_callback=progress_callback if progress_callback is not None else lambda line: None, telemetry_callback=telemetry_callback,
+                                                               apply_options=job.get("apply_options"))
+    except Exception:
+        result["status"] = "failed"
+        result["error"]  = traceback.format_exc()
+
+        workspace.create()
+
+        with open(workspace.log_path, "a") as log:
+            log.write(result["error"])
+    else:
+        result["params_hash"]               = controller.params_hash()
+        result["peak_memory"]               = max(controller.peak_memory.values()) if len(controller.peak_memory) > 0 else None
+        result["warped_moving_image_paths"] = controller.warped_moving_image_paths
+        result["failed_channels"]           = sorted([ i for i in apply_transforms_results if apply_transforms_results[i] != 0 ])
+
+        if len(result["failed_channels"]) > 0:
+            result["status"] = "partial"
+
+    return result
+
+def run_batch(jobs, output_directory, max_workers=1, num_threads=None, params=None, result_callback=None):
+    if num_threads is None:
+        num_threads = threads_per_job(max_workers)
+
+    results = []
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [ executor.submit(run_job, job, output_directory, num_threads, params) for job in jobs ]
+
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+
+            if result_callback is not None:
+                result_callback(result)
+
+    return results
+
+def print_result(result):
+    print("{}: {}".format(result["job_id"], result["status"]))
+
+def add_batch_arguments(parser):
+    parser.add_argument("manifest", help="JSON list of jobs, each with \"fixed\", \"moving\" and optionally \"job_id\" and \"registration_channel\".")
+    parser.add_argument("-o", "--output-directory", default="batch_output", help="Directory in which each job gets its own workspace.")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of registrations to run at once.")
+    parser.add_argument("-t", "--threads", type=int, default=None, help="ITK threads per registration (default: cores divided by --jobs).")
+
+def run_batch_command(args, params=None):
+    results = run_batch(load_manifest(args.manifest), args.output_directory, max_workers=args.jobs, num_threads=args.threads, params=params, result_callback=print_result)
+
+    num_failed = len([ result for result in results if result["status"] != "finished" ])
+    print("{} of {} jobs finished.".format(len(results) - num_failed, len(results)))
+
+    return 1 if num_failed > 0 else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Register a batch of moving images listed in a JSON manifest.")
+    add_batch_arguments(parser)
+    args = parser.parse_args()
+
+    sys.exit(run_batch_command(args))
@@ -0,0 +1,436 @@
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import resource
+import argparse
+import itertools
+import subprocess
+import traceback
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ProcessPoolExecutor
+
+from controller import Controller
+from convergence import IterationBudgets
+from memory import MemoryHistory
+from presets import get_preset
+from transforms import AffineTransform, write_itk_affine
+
+result_fields = ["commit", "date", "case", "runner", "size", "preset", "metric", "sampling_percentage", "pyramid", "threads", "params_hash", "status",
+                 "wall_time", "peak_rss_mb", "initial_error_mean", "landmark_error_mean", "landmark_error_max", "error"]
+
+# (num_iterations, shrink_factors, gaussian_sigma), applied to every enabled stage
+pyramids = {
+    "shallow": ("100x50x25", "4x2x1", "2x1x0"),
+    "deep":    ("100x100x50x25", "8x4x2x1", "3x2x1x0")
+}
+
+benchmark_axes = {
+    "metric":              ["Cross-Correlation", "Mutual Information"],
+    "sampling_percentage": ["0.1", "0.25", "0.5"],
+    "pyramid":             sorted(pyramids),
+    "threads":             sorted(set([1, os.cpu_count() or 1]))
+}
+
+stage_names = ["translation", "rigid", "affine", "syn"]
+
+def render_blobs(shape, centers, sigma, amplitudes):
+    image = np.zeros(shape, dtype=np.float32)
+
+    # only evaluate each blob within 4 sigma of its center
+    radius = int(np.ceil(4*sigma))
+
+    for center, amplitude in zip(centers, amplitudes):
+        lower = [ max(0, int(center[k]) - radius) for k in range(3) ]
+        upper = [ min(shape[k], int(center[k]) + radius + 2) for k in range(3) ]
+
+        if any([ lower[k] >= upper[k] for k in range(3) ]):
+            continue
+
+        x, y, z = np.ogrid[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]]
+        distance = (x - center[0])**2 + (y - center[1])**2 + (z - center[2])**2
+
+        image[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]] += amplitude*np.exp(-distance/(2*sigma**2))
+
+    return image
+
+class Deformation:
+    def __init__(self, shape, rotation=5.0, translation=(3.0, -2.0, 1.0), scale=1.03, amplitude=2.0):
+        self.shape       = np.array(shape, dtype=float)
+        self.center      = (self.shape - 1)/2
+        self.translation = np.array(translation)
+        self.scale       = scale
+        self.amplitude   = amplitude
+
+        angle = np.radians(rotation)
+        self.rotation = np.array([[np.cos(angle), -np.sin(angle), 0], [np.sin(angle), np.cos(angle), 0], [0, 0, 1]])
+
+    def __call__(self, points):
+        points = np.asarray(points, dtype=float)
+
+        affine_points = (points - self.center) @ self.rotation.T*self.scale + self.center + self.translation
+
+        # a smooth nonlinear part on top of the affine one, so SyN has something to recover
+        displacement = self.amplitude*np.sin(2*np.pi*points[:, [1, 2, 0]]/self.shape[[1, 2, 0]])
+
+        return affine_points + displacement
+
+def synthetic_landmarks(shape, num_landmarks, rng):
+    shape = np.array(shape)
+
+    # keep the landmarks away from the border so they stay inside the volume once deformed
+    return rng.uniform(0.25*shape, 0.75*shape, size=(num_landmarks, 3))
+
+def create_synthetic_case(directory, size, seed=0, num_landmarks=24, num_blobs=96):
+    shape = (size, size, size)
+    name  = "synthetic_{}_{}".format(size, seed)
+
+    fixed_image_path     = os.path.join(directory, "{}_fixed.nii.gz".format(name))
+    moving_image_path    = os.path.join(directory, "{}_moving.nii.gz".format(name))
+    moving_landmark_path = os.path.join(directory, "{}_moving_landmarks.nii.gz".format(name))
+    landmarks_path       = os.path.join(directory, "{}_landmarks.json".format(name))
+
+    if not all([ os.path.exists(path) for path in (fixed_image_path, moving_image_path, moving_landmark_path, landmarks_path) ]):
+        os.makedirs(directory, exist_ok=True)
+
+        rng         = np.random.RandomState(seed)
+        deformation = Deformation(shape)
+
+        landmarks  = synthetic_landmarks(shape, num_landmarks, rng)
+        centers    = np.concatenate([landmarks, rng.uniform(0.1*size, 0.9*size, size=(num_blobs, 3))])
+        amplitudes = rng.uniform(0.2, 1.0, size=len(centers))
+        sigma      = size/24
+
+        affine = np.eye(4)
+
+        # the moving image has the same blobs, but placed at their deformed positions
+        nib.save(nib.Nifti1Image(render_blobs(shape, centers, sigma, amplitudes), affine), fixed_image_path)
+        nib.save(nib.Nifti1Image(render_blobs(shape, deformation(centers), sigma, amplitudes), affine), moving_image_path)
+        nib.save(nib.Nifti1Image(render_blobs(shape, deformation(landmarks), 1.5, np.ones(len(landmarks))), affine), moving_landmark_path)
+
+        with open(landmarks_path, "w") as f:
+            json.dump({"fixed": landmarks.tolist(), "moving": deformation(landmarks).tolist()}, f)
+
+    with open(landmarks_path) as f:
+        landmarks = json.load(f)
+
+    return {"fixed": fixed_image_path, "moving": [moving_image_path, moving_landmark_path], "fixed_landmarks": np.array(landmarks["fixed"]), "moving_landmarks": np.array(landmarks["moving"])}
+
+def landmark_errors(warped_landmark_path, fixed_landmarks, radius=6):
+    image = np.asanyarray(nib.load(warped_landmark_path).dataobj).astype(np.float32)
+
+    errors = []
+
+    for landmark in fixed_landmarks:
+        lower = [ max(0, int(round(landmark[k])) - radius) for k in range(3) ]
+        upper = [ min(image.shape[k], int(round(landmark[k])) + radius + 1) for k in range(3) ]
+
+        window = np.maximum(image[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]], 0)
+
+        # a landmark that was warped out of its window counts as missed
+        if window.sum() <= 0:
+            errors.append(float("inf"))
+            continue
+
+        grid     = np.meshgrid(*[ np.arange(lower[k], upper[k]) for k in range(3) ], indexing="ij")
+        centroid = np.array([ (grid[k]*window).sum()/window.sum() for k in range(3) ])
+
+        errors.append(float(np.linalg.norm(centroid - landmark)))
+
+    return np.array(errors)
+
+def case_name(case):
+    return ",".join([ "{}={}".format(axis, case[axis]) for axis in sorted(benchmark_axes) if case[axis] is not None ]) or "base"
+
+def benchmark_cases(suite, threads=None):
+    base = { axis: None for axis in benchmark_axes }
+
+    if threads is not None:
+        base["threads"] = threads
+
+    if suite == "base":
+        return [base]
+
+    if suite == "full":
+        axes = [ axis for axis in sorted(benchmark_axes) if base[axis] is None ]
+
+        return [ dict(base, **dict(zip(axes, values))) for values in itertools.product(*[ benchmark_axes[axis] for axis in axes ]) ]
+
+    # one axis at a time, starting from the preset's own values
+    cases = [base]
+    for axis in sorted(benchmark_axes):
+        if base[axis] is None:
+            cases += [ dict(base, **{axis: value}) for value in benchmark_axes[axis] ]
+
+    return cases
+
+def case_params(preset, case):
+    params = get_preset(preset)["params"]
+
+    for stage in stage_names:
+        stage_params = params["{}_params".format(stage)]
+
+        if case["metric"] is not None:
+            stage_params["metric"] = case["metric"]
+
+        if case["sampling_percentage"] is not None:
+            params["{}_cross_correlation_params".format(stage)]["sampling_percentage"]  = case["sampling_percentage"]
+            params["{}_mutual_information_params".format(stage)]["sampling_percentage"] = case["sampling_percentage"]
+
+            # CC samples every voxel unless told otherwise
+            if params["{}_cross_correlation_params".format(stage)]["sampling_strategy"] == "None":
+                params["{}_cross_correlation_params".format(stage)]["sampling_strategy"] = "Regular"
+
+        if case["pyramid"] is not None:
+            stage_params["num_iterations"], stage_params["shrink_factors"], stage_params["gaussian_sigma"] = pyramids[case["pyramid"]]
+
+    return params
+
+def current_commit():
+    try:
+        process = subprocess.run(["git", "describe", "--always", "--dirty"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return "unknown"
+
+    return process.stdout.strip() if process.returncode == 0 else "unknown"
+
+def install_stubs(directory):
+    os.makedirs(directory, exist_ok=True)
+
+    for program in ("antsRegistration", "antsApplyTransforms"):
+        path = os.path.join(directory, program)
+
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\nexec \"{}\" \"{}\" stub {} \"$@\"\n".format(sys.executable, os.path.abspath(__file__), program))
+
+        os.chmod(path, 0o755)
+
+    return directory
+
+def argument_value(argv, flag):
+    return argv[argv.index(flag) + 1]
+
+def copy_image(input_path, output_path):
+    image = nib.load(input_path)
+    nib.save(nib.Nifti1Image(np.asanyarray(image.dataobj), image.affine), output_path)
+
+def stub_registration(argv):
+    # writes identity transforms and an unregistered warped image, so the rest of the
+    # pipeline runs and the benchmark measures everything but ANTs itself
+    output = argument_value(argv, "-o")
+    metric = argument_value(argv, "-m")
+
+    fixed_image_path, moving_image_path = metric[metric.index("[")+1:].split(",")[:2]
+
+    if output.startswith("["):
+        prefix, warped_image_path = output[1:-1].split(",")
+    else:
+        prefix, warped_image_path = output, None
+
+    write_itk_affine(prefix + "0GenericAffine.mat", AffineTransform(np.eye(3), np.zeros(3), np.zeros(3)))
+
+    if argument_value(argv, "-t").startswith("SyN"):
+        fixed_image = nib.load(fixed_image_path)
+        nib.save(nib.Nifti1Image(np.zeros(fixed_image.shape[:3] + (1, 3), dtype=np.float32), fixed_image.affine), prefix + "1Warp.nii.gz")
+
+    if warped_image_path is not None:
+        copy_image(moving_image_path, warped_image_path)
+
+    print("Stub registration of {} to {}.".format(moving_image_path, fixed_image_path))
+
+    return 0
+
+def stub_apply_transforms(argv):
+    copy_image(argument_value(argv, "-i"), argument_value(argv, "-o"))
+
+    return 0
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS; children is the largest waited-for child
+    scale = 1.0/1024 if sys.platform != "darwin" else 1.0/1024**2
+
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)*scale
+
+def run_case(case, preset, synthetic_case, work_directory, stub_directory=None):
+    if stub_directory is not None:
+        os.environ["PATH"] = stub_directory + os.pathsep + os.environ["PATH"]
+
+    result = {"case": case_name(case), "preset": preset, "metric": case["metric"], "sampling_percentage": case["sampling_percentage"], "pyramid": case["pyramid"], "threads": case["threads"], "status": "finished", "error": None}
+
+    controller = Controller()
+    controller.fixed_image_path  = synthetic_case["fixed"]
+    controller.num_threads       = case["threads"]
+    controller.workspace_root    = os.path.join(work_directory, "registrations")
+    controller.transform_cache   = None
+    controller.iteration_budgets = IterationBudgets(os.path.join(work_directory, "iteration_budgets.json"))
+    controller.memory_history    = MemoryHistory(os.path.join(work_directory, "memory.json"))
+    controller.add_moving_images(list(synthetic_case["moving"]))
+    controller.set_params(case_params(preset, case))
+
+    result["params_hash"]        = controller.params_hash()
+    result["initial_error_mean"] = float(np.linalg.norm(synthetic_case["moving_landmarks"] - synthetic_case["fixed_landmarks"], axis=1).mean())
+
+    start = time.perf_counter()
+
+    try:
+        apply_transforms_results = controller.register(progress_callback=lambda line: None)
+    except Exception:
+        result["status"] = "failed"
+        result["error"]  = traceback.format_exc().strip().splitlines()[-1]
+    else:
+        result["wall_time"] = time.perf_counter() - start
+
+        if apply_transforms_results.get(1) == 0:
+            errors = landmark_errors(controller.warped_moving_image_paths[-1], synthetic_case["fixed_landmarks"])
+
+            result["landmark_error_mean"] = float(errors.mean())
+            result["landmark_error_max"]  = float(errors.max())
+        else:
+            result["status"] = "partial"
+
+    result["peak_rss_mb"] = peak_rss_mb()
+
+    return result
+
+def run_benchmark(cases, preset, size, work_directory, stub=False, result_callback=None):
+    synthetic_case = create_synthetic_case(os.path.join(work_directory, "images"), size)
+
+    stub_directory = install_stubs(os.path.join(work_directory, "bin")) if stub else None
+
+    commit = current_commit()
+    date   = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    results = []
+
+    for case in cases:
+        # a fresh process per case, so peak RSS isn't carried over from earlier cases
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(run_case, case, preset, synthetic_case, work_directory, stub_directory).result()
+
+        result.update({"commit": commit, "date": date, "runner": "stub" if stub else "ants", "size": size})
+        results.append(result)
+
+        if result_callback is not None:
+            result_callback(result)
+
+    return results
+
+def save_results(results, path):
+    exists = os.path.exists(path)
+
+    with open(path, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=result_fields)
+
+        if not exists:
+            writer.writeheader()
+
+        for result in results:
+            writer.writerow({ field: result.get(field) for field in result_fields })
+
+def load_results(path):
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
+
+def format_number(text, format_spec):
+    try:
+        return format_spec.format(float(text))
+    except ValueError:
+        return "-"
+
+def compare_results(results, baseline=None):
+    commits = []
+    for result in results:
+        if result["commit"] not in commits:
+            commits.append(result["commit"])
+
+    if baseline is None:
+        baseline = commits[0]
+
+    groups = {}
+    for result in results:
+        groups.setdefault((result["runner"], result["size"], result["preset"], result["case"]), {}).setdefault(result["commit"], []).append(result)
+
+    rows = []
+
+    for key in sorted(groups):
+        baseline_times = [ float(result["wall_time"]) for result in groups[key].get(baseline, []) if result["wall_time"] ]
+
+        for commit in commits:
+            if commit not in groups[key]:
+                continue
+
+            commit_results = groups[key][commit]
+
+            wall_times = [ float(result["wall_time"]) for result in commit_results if result["wall_time"] ]
+            peak_rss   = [ float(result["peak_rss_mb"]) for result in commit_results if result["peak_rss_mb"] ]
+            errors     = [ float(result["landmark_error_mean"]) for result in commit_results if result["landmark_error_mean"] ]
+
+            # medians, since a commit may have been benchmarked more than once
+            wall_time = np.median(wall_times) if len(wall_times) > 0 else float("nan")
+            change    = wall_time/np.median(baseline_times) - 1 if len(baseline_times) > 0 and commit != baseline else float("nan")
+
+            rows.append(list(key) + [commit, wall_time, change, np.median(peak_rss) if len(peak_rss) > 0 else float("nan"), np.median(errors) if len(errors) > 0 else float("nan")])
+
+    return rows
+
+def print_result(result):
+    print("{:<60} {:<8} {:>9} s {:>9} MB  landmark error {} mm (initial {} mm)".format(result["case"], result["status"], format_number(result.get("wall_time"), "{:.2f}"), format_number(result.get("peak_rss_mb"), "{:.0f}"),
+                                                                                     format_number(result.get("landmark_error_mean"), "{:.2f}"), format_number(result.get("initial_error_mean"), "{:.2f}")))
+
+    if result["error"] is not None:
+        print("    {}".format(result["error"]))
+
+def run_command(args):
+    if not args.stub and shutil.which("antsRegistration") is None:
+        print("antsRegistration was not found on the PATH; use --stub to benchmark everything but ANTs.", file=sys.stderr)
+        return 1
+
+    results = run_benchmark(benchmark_cases(args.suite, threads=args.threads), args.preset, args.size, os.path.abspath(args.work_directory), stub=args.stub, result_callback=print_result)
+
+    save_results(results, args.results)
+
+    return 0 if all([ result["status"] == "finished" for result in results ]) else 1
+
+def compare_command(args):
+    for row in compare_results(load_results(args.results), baseline=args.baseline):
+        runner, size, preset, case, commit, wall_time, change, peak_rss, error = row
+
+        print("{:<5} {:>4} {:<10} {:<60} {:<16} {:>9.2f} s {:>8} {:>7.0f} MB {:>7.2f} mm".format(runner, size, preset, case, commit, wall_time, "" if np.isnan(change) else "{:+.1%}".format(change), peak_rss, error))
+
+    return 0
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+
+    # the stubs call back into this script in place of the ANTs programs
+    if len(argv) > 1 and argv[0] == "stub":
+        return stub_registration(argv[2:]) if argv[1] == "antsRegistration" else stub_apply_transforms(argv[2:])
+
+    parser = argparse.ArgumentParser(description="Benchmark registration time, peak memory and landmark error on synthetic volumes with known deformations.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser("run", help="Run a benchmark suite and append the results to a CSV table.")
+    run_parser.add_argument("--preset", default="fast", help="Built-in preset name or preset file the cases start from.")
+    run_parser.add_argument("--suite", choices=["base", "quick", "full"], default="quick", help="base runs the preset as is, quick varies one of metric, sampling, pyramid and threads at a time, full runs every combination.")
+    run_parser.add_argument("--size", type=int, default=64, help="Edge length of the synthetic volumes in voxels.")
+    run_parser.add_argument("-t", "--threads", type=int, default=None, help="Run every case with this many ITK threads instead of varying them.")
+    run_parser.add_argument("--stub", action="store_true", help="Replace antsRegistration and antsApplyTransforms with stubs that write identity transforms.")
+    run_parser.add_argument("--work-directory", default="benchmark_work", help="Directory for the synthetic volumes and registration workspaces.")
+    run_parser.add_argument("-o", "--results", default="benchmark_results.csv", help="CSV table the results are appended to.")
+    run_parser.set_defaults(function=run_command)
+
+    compare_parser = subparsers.add_parser("compare", help="Compare the results of different commits.")
+    compare_parser.add_argument("-o", "--results", default="benchmark_results.csv", help="CSV table of benchmark results.")
+    compare_parser.add_argument("--baseline", default=None, help="Commit the others are compared against (default: the first one in the table).")
+    compare_parser.set_defaults(function=compare_command)
+
+    args = parser.parse_args(argv)
+
+    return args.function(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+file_hashes = {}
+
+def file_hash(path, chunk_size=16*1024*1024):
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    if memo_key not in file_hashes:
+        sha = hashlib.sha256()
+
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                sha.update(chunk)
+
+        file_hashes[memo_key] = sha.hexdigest()
+
+    return file_hashes[memo_key]
+
+def file_key(path):
+    stat = os.stat(path)
+
+    return "{}:{}:{}".format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+def params_hash(params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+def directory_size(directory):
+    size = 0
+
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(dirpath, filename))
+
+    return size
+
+def default_cache_directory(name):
+    return os.path.join(os.path.expanduser("~"), ".cache", "ants-registration", name)
+
+class TransformCache:
+    def __init__(self, directory, max_size=20*1024**3):
+        self.directory = directory
+        self.max_size  = max_size
+
+    def key(self, fixed_image_path, moving_image_path, params):
+        sha = hashlib.sha256()
+        sha.update(file_hash(fixed_image_path).encode())
+        sha.update(file_hash(moving_image_path).encode())
+        sha.update(json.dumps(params, sort_keys=True).encode())
+
+        return sha.hexdigest()
+
+    def lookup(self, key):
+        entry_directory = os.path.join(self.directory, key)
+
+        if not os.path.isdir(entry_directory):
+            return None
+
+        # mark the entry as recently used
+        os.utime(entry_directory)
+
+        return { filename: os.path.join(entry_directory, filename) for filename in os.listdir(entry_directory) }
+
+    def store(self, key, paths):
+        entry_directory = os.path.join(self.directory, key)
+
+        if os.path.isdir(entry_directory):
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # copy into a temporary directory first so concurrent jobs never see a partial entry
+        temp_directory = tempfile.mkdtemp(dir=self.directory, prefix=".tmp-")
+
+        try:
+            for filename in paths:
+                shutil.copyfile(paths[filename], os.path.join(temp_directory, filename))
+
+            os.rename(temp_directory, entry_directory)
+        except OSError:
+            shutil.rmtree(temp_directory, ignore_errors=True)
+
+            if not os.path.isdir(entry_directory):
+                raise
+
+        self.evict()
+
+    def evict(self):
+        if not os.path.isdir(self.directory):
+            return
+
+        entries = []
+        for name in os.listdir(self.directory):
+            entry_directory = os.path.join(self.directory, name)
+
+            if os.path.isdir(entry_directory) and not name.startswith("."):
+                entries.append((os.path.getmtime(entry_directory), directory_size(entry_directory), entry_directory))
+
+        total_size = sum([ entry[1] for entry in entries ])
+
+        # remove least recently used entries first
+        for mtime, size, entry_directory in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            shutil.rmtree(entry_directory, ignore_errors=True)
+            total_size -= size
@@ -0,0 +1,203 @@
+import os
+import sys
+import argparse
+
+from controller import register_images, plateau_param_names
+from batch import add_batch_arguments, run_batch_command
+
+def load_config(name_or_path):
+    if name_or_path is None:
+        return None
+
+    # imported here so plain registrations don't have to build the default presets
+    from presets import get_preset
+
+    return get_preset(name_or_path)["params"]
+
+def load_params(args):
+    params = load_config(args.config)
+
+    # options given on the command line override the preset's
+    overrides = { name: getattr(args, name) for name in plateau_param_names if getattr(args, name) is not None }
+
+    if len(overrides) > 0:
+        params = dict(params) if params is not None else {}
+        params["params"] = dict(params.get("params", {}), **overrides)
+
+    return params
+
+def add_plateau_arguments(parser):
+    parser.add_argument("--plateau-window-size", type=int, default=None, help="Iterations over which a level's metric has to improve to count as converging (default: 10).")
+    parser.add_argument("--plateau-min-relative-improvement", type=float, default=None, help="Relative metric improvement over the window below which a level has plateaued (default: 1e-4).")
+    parser.add_argument("--plateau-margin", type=float, default=None, help="Factor on the latest recorded plateau iteration that a level's iterations are adapted to (default: 1.25).")
+    parser.add_argument("--plateau-min-iterations", type=int, default=None, help="Fewest iterations an adapted level is given (default: 10).")
+
+def print_line(line):
+    print(line, end='')
+
+def ignore_line(line):
+    pass
+
+def register_command(args):
+    controller, apply_transforms_results = register_images(args.fixed, args.moving, params=load_params(args), registration_channel=args.registration_channel, workspace_root=args.output_directory, job_id=args.job_id, num_threads=args.threads, progress_callback=ignore_line if args.quiet else print_line, tiled_apply=args.tiled_apply)
+
+    for path in controller.warped_moving_image_paths:
+        print(path)
+
+    failed_channels = sorted([ i for i in apply_transforms_results if apply_transforms_results[i] != 0 ])
+
+    if len(failed_channels) > 0:
+        print("Could not apply transforms to channel(s) {}.".format(", ".join([ str(i) for i in failed_channels ])), file=sys.stderr)
+        return 1
+
+    return 0
+
+def batch_command(args):
+    return run_batch_command(args, params=load_params(args))
+
+def presets_command(args):
+    from presets import builtin_presets, get_preset, save_preset, diff_presets
+
+    if args.action == "list":
+        for name in sorted(builtin_presets):
+            preset = get_preset(name)
+            print("{:<12} {}  {}".format(name, preset["hash"], preset["description"]))
+    elif args.action == "show":
+        preset = get_preset(args.presets[0])
+        print("{} ({})".format(preset["name"], preset["hash"]))
+
+        for name in sorted(preset["params"]):
+            for key in sorted(preset["params"][name]):
+                print("  {}.{} = {}".format(name, key, preset["params"][name][key]))
+    elif args.action == "diff":
+        preset_a = get_preset(args.presets[0])
+        preset_b = get_preset(args.presets[1])
+
+        for name, key, value_a, value_b in diff_presets(preset_a, preset_b):
+            print("{}.{}: {} -> {}".format(name, key, value_a, value_b))
+    elif args.action == "save":
+        save_preset(get_preset(args.presets[0]), args.presets[1])
+
+    return 0
+
+def format_memory(num_bytes):
+    return "{:.1f} GB".format(num_bytes/1024**3) if num_bytes is not None else "-"
+
+def queue_command(args):
+    from jobs import JobStore, Scheduler, progress_summary
+    from executors import SpoolExecutor, spawn_local_workers
+
+    store    = JobStore(args.store)
+    executor = SpoolExecutor(args.spool) if args.spool is not None else None
+
+    # with a spool, the workers serving it bound the running jobs; handing them more than they
+    # can take only takes the jobs out of priority order early
+    max_jobs = args.jobs
+
+    if max_jobs is None and args.spool is not None:
+        max_jobs = args.local_workers if args.local_workers > 0 else 64
+    elif max_jobs is None:
+        max_jobs = 1
+
+    scheduler = Scheduler(store, max_jobs=max_jobs, max_threads=args.threads, memory_budget=int(args.memory_budget*1024**3) if args.memory_budget is not None else None, executor=executor)
+
+    if args.action == "submit":
+        if args.fixed is None or args.moving is None:
+            print("submit needs --fixed and --moving.", file=sys.stderr)
+            return 1
+
+        print(scheduler.submit(args.fixed, args.moving, params=load_params(args), registration_channel=args.registration_channel, workspace_root=args.output_directory, priority=args.priority, max_attempts=args.max_attempts))
+    elif args.action == "list":
+        for job in store.list():
+            print("{:>5} {:<10} priority {:>3}  attempts {}/{}  memory {}/{}  {}  {}{}{}".format(job["id"], job["status"], job["priority"], job["attempts"], job["max_attempts"], format_memory(job["predicted_memory"]), format_memory(job["peak_memory"]), job["job_id"], os.path.basename(job["fixed"]),
+                                                                                             "  on {}".format(job["worker"]) if job["worker"] is not None else "", "  ({})".format(progress_summary(job["progress"])) if job["progress"] is not None else ""))
+    elif args.action == "run":
+        if args.local_workers > 0 and args.spool is None:
+            print("--local-workers needs --spool.", file=sys.stderr)
+            return 1
+
+        workers = spawn_local_workers(args.spool, args.local_workers, num_threads=args.threads) if args.local_workers > 0 else []
+
+        try:
+            scheduler.run()
+        finally:
+            for worker in workers:
+                worker.terminate()
+                worker.wait()
+    elif args.action == "cancel":
+        for id in args.ids:
+            scheduler.cancel(id)
+    elif args.action == "retry":
+        for id in args.ids:
+            store.retry(id)
+
+    return 0
+
+def worker_command(args):
+    from executors import run_worker
+
+    run_worker(args.spool, num_threads=args.threads, worker_id=args.worker_id, once=args.once)
+
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Register images with ANTs without the GUI.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    register_parser = subparsers.add_parser("register", help="Register moving image channel(s) to a fixed image.")
+    register_parser.add_argument("--fixed", required=True, help="Fixed image.")
+    register_parser.add_argument("--moving", required=True, nargs="+", help="Moving image channel(s).")
+    register_parser.add_argument("--config", "--preset", default=None, help="Built-in preset name or JSON/YAML preset file; a file may list only the parameters it changes.")
+    register_parser.add_argument("--registration-channel", type=int, default=0, help="Index of the moving channel used for registration.")
+    register_parser.add_argument("-o", "--output-directory", default=None, help="Directory for job workspaces (default: registrations/ next to the fixed image).")
+    register_parser.add_argument("--job-id", default=None, help="Job ID; reuse one to resume an interrupted registration.")
+    register_parser.add_argument("-t", "--threads", type=int, default=None, help="ITK threads to use.")
+    register_parser.add_argument("-q", "--quiet", action="store_true", help="Don't print antsRegistration output.")
+    register_parser.add_argument("--tiled-apply", action="store_true", help="Warp the channels in blocks with bounded memory instead of with antsApplyTransforms.")
+    add_plateau_arguments(register_parser)
+    register_parser.set_defaults(function=register_command)
+
+    batch_parser = subparsers.add_parser("batch", help="Register a batch of moving images listed in a JSON manifest.")
+    add_batch_arguments(batch_parser)
+    batch_parser.add_argument("--config", "--preset", default=None, help="Built-in preset name or JSON/YAML preset file applied to every job.")
+    add_plateau_arguments(batch_parser)
+    batch_parser.set_defaults(function=batch_command)
+
+    presets_parser = subparsers.add_parser("presets", help="List, show, diff or save parameter presets.")
+    presets_parser.add_argument("action", choices=["list", "show", "diff", "save"])
+    presets_parser.add_argument("presets", nargs="*", help="Preset names or files: one for show, two for diff, a preset and an output path for save.")
+    presets_parser.set_defaults(function=presets_command)
+
+    queue_parser = subparsers.add_parser("queue", help="Submit registrations to the persistent job queue, list them, or run the scheduler.")
+    queue_parser.add_argument("action", choices=["submit", "list", "run", "cancel", "retry"])
+    queue_parser.add_argument("ids", nargs="*", type=int, help="Job IDs to cancel or retry.")
+    queue_parser.add_argument("--store", default=None, help="Job store (default: ~/.cache/ants-registration/jobs/jobs.sqlite3).")
+    queue_parser.add_argument("--fixed", default=None, help="Fixed image of a submitted job.")
+    queue_parser.add_argument("--moving", default=None, nargs="+", help="Moving image channel(s) of a submitted job.")
+    queue_parser.add_argument("--config", "--preset", default=None, help="Built-in preset name or JSON/YAML preset file for a submitted job.")
+    queue_parser.add_argument("--registration-channel", type=int, default=0, help="Index of the moving channel used for registration.")
+    queue_parser.add_argument("-o", "--output-directory", default=None, help="Directory for the job's workspace (default: registrations/ next to the fixed image).")
+    queue_parser.add_argument("--priority", type=int, default=0, help="Jobs with higher priorities run first.")
+    queue_parser.add_argument("--max-attempts", type=int, default=3, help="Attempts before a failing job is given up on.")
+    queue_parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of jobs the scheduler runs at once (default: 1, or as many as the spool's workers take).")
+    queue_parser.add_argument("-t", "--threads", type=int, default=None, help="ITK threads shared by the running jobs (default: all cores).")
+    queue_parser.add_argument("--memory-budget", type=float, default=None, help="GB the predicted peaks of the running jobs may add up to (default: 90%% of the node's memory).")
+    queue_parser.add_argument("--spool", default=None, help="Spool directory on shared storage; jobs are handed to the workers serving it instead of run on this node.")
+    queue_parser.add_argument("--local-workers", type=int, default=0, help="Workers to start on this node for the spool while the scheduler runs.")
+    add_plateau_arguments(queue_parser)
+    queue_parser.set_defaults(function=queue_command)
+
+    worker_parser = subparsers.add_parser("worker", help="Claim and run jobs from a spool directory until stopped.")
+    worker_parser.add_argument("spool", help="Spool directory shared with the scheduler.")
+    worker_parser.add_argument("-t", "--threads", type=int, default=None, help="ITK threads per job, unless the job sets its own (default: all cores).")
+    worker_parser.add_argument("--worker-id", default=None, help="Name reported with results (default: host name and PID).")
+    worker_parser.add_argument("--once", action="store_true", help="Run at most one job, then exit.")
+    worker_parser.set_defaults(function=worker_command)
+
+    args = parser.parse_args(argv)
+
+    return args.function(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
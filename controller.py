@@ -1,18 +1,49 @@
-import numpy as np
 import subprocess
+import hashlib
+import shutil
+import json
+import copy
 import os
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from workspace import Workspace
+from cache import TransformCache, default_cache_directory, file_hash, file_key, params_hash
+from telemetry import ConvergenceParser, TelemetryWriter
+from convergence import PlateauPolicy, IterationBudgets, plateau_iterations
+from pipeline import Pipeline, PipelineError, create_stage, apply_transforms_argv, render_command, transform_names
+
+# how the transforms are applied, which doesn't change them, so they're kept out of the params
+apply_option_names = ["tiled_apply", "tiled_apply_memory", "warp_on_demand"]
+
+plateau_param_names = ["plateau_window_size", "plateau_min_relative_improvement", "plateau_margin", "plateau_min_iterations"]
+
 initial_moving_transform_lut = {"Geometric Center": 0, "Image Intensities": 1, "Image Origins": 2}
 
+param_names = ["params",
+               "translation_params", "translation_cross_correlation_params", "translation_mutual_information_params",
+               "rigid_params", "rigid_cross_correlation_params", "rigid_mutual_information_params",
+               "affine_params", "affine_cross_correlation_params", "affine_mutual_information_params",
+               "syn_params", "syn_cross_correlation_params", "syn_mutual_information_params"]
+
 class Controller:
     def __init__(self):
-        self.preview_window            = None
+        # staging, memory and tiled read images with numpy and nibabel, so they're imported where
+        # they're used and importing this module only needs the standard library
+        from staging import StagingCache
+        from memory import MemoryHistory
+
         self.fixed_image_path          = None
         self.moving_image_paths        = []
         self.warped_moving_image_paths = []
         self.registration_channel      = 0
+        self.num_threads               = None
+        self.workspace_root            = None
+        self.job_id                    = None
+        self.workspace                 = None
 
-        self.params = {"translation": True, "rigid": True, "affine": True, "syn": True, "prefix": "warp_", "initial_moving_transform": "Geometric Center"}
+        self.params = {"translation": True, "rigid": True, "affine": True, "syn": True, "prefix": "warp_", "initial_moving_transform": "Geometric Center", "adaptive_iterations": False,
+                       "plateau_window_size": 10, "plateau_min_relative_improvement": 1e-4, "plateau_margin": 1.25, "plateau_min_iterations": 10}
 
         self.translation_params = {
             "gradient_step": "0.1",
@@ -112,121 +143,607 @@ class Controller:
             "sampling_percentage": "0.25"
         }
 
-        self.shell_command = ""
+        self.max_apply_workers = 4
+
+        # resample channels in blocks with tiled.py instead of antsApplyTransforms, so volumes
+        # larger than memory can be warped; the apply workers share tiled_apply_memory
+        self.tiled_apply        = False
+        self.tiled_apply_memory = 2*1024**3
+
+        # leave warping the other channels to the preview window, which resamples the slices
+        # it shows from the transforms
+        self.warp_on_demand = False
+
+        self.transform_cache   = TransformCache(default_cache_directory("transforms"))
+        self.iteration_budgets = IterationBudgets(os.path.join(default_cache_directory("history"), "iteration_budgets.json"))
+        self.staging_cache     = StagingCache(default_cache_directory("staged"))
+        self.memory_history    = MemoryHistory(os.path.join(default_cache_directory("history"), "memory.json"))
+
+        # peak RSS of each phase of the last registration, measured as it ran
+        self.peak_memory = {}
 
-    def register(self):
+        # uncompressed copies of the input images that the commands read instead
+        self.staged_image_paths = {}
+
+        self.pipeline                  = None
+        self.pipeline_error            = None
+        self.rendered_command_key      = None
+        self.registration_commands     = []
+        self.apply_transforms_commands = []
+        self.shell_command             = ""
+
+    def register(self, progress_callback=None, telemetry_callback=None):
         self.create_shell_command()
 
+        if self.pipeline_error is not None:
+            raise PipelineError(self.pipeline_error)
+
+        apply_transforms_results = {}
+
         if self.shell_command != "":
+            for path in [self.fixed_image_path] + self.moving_image_paths:
+                self.stage_image(path, progress_callback)
+
+            # the commands now read the staged copies
+            self.create_shell_command()
+
+            warped_moving_image_paths = [ self.workspace.warped_image_path(moving_image_path, self.fixed_image_path) for moving_image_path in self.moving_image_paths ]
 
             self.warped_moving_image_paths = []
+            self.peak_memory               = {}
+
+            self.workspace.create()
+            self.workspace.save_params(self.get_params(), self.params_hash())
+
+            with open(self.workspace.log_path, "a") as log:
+                def log_progress(line):
+                    log.write(line)
+                    log.flush()
+
+                    if progress_callback is not None:
+                        progress_callback(line)
+                    else:
+                        print(line, end='')
+
+                cache_key         = None
+                cached_transforms = None
+
+                if self.transform_cache is not None:
+                    cache_key         = self.transform_cache.key(self.fixed_image_path, self.moving_image_paths[self.registration_channel], self.registration_params())
+                    cached_transforms = self.transform_cache.lookup(cache_key)
+
+                    if cached_transforms is not None and not all([ filename in cached_transforms for filename in self.transform_files() ]):
+                        cached_transforms = None
+
+                if cached_transforms is not None:
+                    log_progress("Reusing cached transforms {}.\n".format(cache_key))
+
+                    transform_files = self.transform_files()
+                    for filename in transform_files:
+                        shutil.copyfile(cached_transforms[filename], transform_files[filename])
+
+                    # the registration channel is warped by antsRegistration, so it needs applying too
+                    apply_transforms_commands = [ (i, self.create_apply_transforms_command(i)) for i in range(len(self.moving_image_paths)) if not self.warp_on_demand or i == self.registration_channel ]
+                    apply_transforms_results  = {}
+                else:
+                    self.run_registration_stages(progress_callback=log_progress, telemetry_callback=telemetry_callback)
+
+                    if self.transform_cache is not None:
+                        self.transform_cache.store(cache_key, self.transform_files())
+
+                    apply_transforms_commands = self.apply_transforms_commands
+                    apply_transforms_results  = {self.registration_channel: 0}
+
+                apply_transforms_results.update(self.apply_transforms(apply_transforms_commands, progress_callback=log_progress))
+
+                # slices are resampled from the warp as they're shown, which needs it uncompressed
+                if self.warp_on_demand and self.params["syn"]:
+                    self.stage_image(self.workspace.warp_path, log_progress)
+
+            # only list channels that were actually warped, in channel order
+            self.warped_moving_image_paths = [ warped_moving_image_paths[i] for i in range(len(warped_moving_image_paths)) if apply_transforms_results.get(i) == 0 ]
+
+            # the next run gets a fresh workspace
+            self.job_id = None
+
+        return apply_transforms_results
+
+    def run_registration_stages(self, progress_callback=None, telemetry_callback=None):
+        env = os.environ.copy()
+        if self.num_threads is not None:
+            env["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(self.num_threads)
+
+        stages = self.registration_params()["stages"]
+
+        completed_stages = self.workspace.load_checkpoint()
+
+        telemetry_writer = TelemetryWriter(self.workspace.telemetry_path)
+
+        def record_telemetry(record):
+            telemetry_writer.write(record)
+
+            if telemetry_callback is not None:
+                telemetry_callback(record)
+
+        parser = ConvergenceParser(callback=record_telemetry)
 
-            for i in range(len(self.moving_image_paths)):
-                moving_image_path = self.moving_image_paths[i]
+        try:
+            memory_estimates = self.memory_estimates()
+        except (OSError, ValueError):
+            memory_estimates = {}
 
-                directory       = os.path.dirname(self.fixed_image_path)
-                fixed_filename  = os.path.splitext(os.path.basename(self.fixed_image_path))[0]
-                moving_filename = os.path.splitext(os.path.basename(moving_image_path))[0]
+        try:
+            self.run_stage_commands(stages, completed_stages, parser, env, progress_callback, memory_estimates)
+        finally:
+            telemetry_writer.close()
 
-                warped_moving_image_path = os.path.join(directory, "{}_warped_to_{}.nii.gz".format(moving_filename, fixed_filename))
+            self.save_memory_history()
 
-                self.warped_moving_image_paths.append(warped_moving_image_path)
+    def run_stage_commands(self, stages, completed_stages, parser, env, progress_callback, memory_estimates=None):
+        from memory import wait_for_peak_rss
 
-            with subprocess.Popen(self.shell_command, shell=True, stdout=subprocess.PIPE, bufsize=1, universal_newlines=True) as p:
+        if memory_estimates is None:
+            memory_estimates = {}
+
+        for i in range(len(self.registration_commands)):
+            name, command, output_paths = self.registration_commands[i]
+
+            # a stage's key covers the inputs and every stage up to and including it, so
+            # changing an earlier stage invalidates the checkpoints of the later ones
+            stage_key = self.stage_key(stages[:i+1])
+
+            if stage_key in completed_stages and all([ os.path.exists(path) for path in output_paths ]):
+                message = "Skipping completed {} stage.\n".format(transform_names[name])
+
+                if progress_callback is not None:
+                    progress_callback(message)
+                else:
+                    print(message, end='')
+
+                continue
+
+            parser.begin_stage(name)
+
+            with subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=1, universal_newlines=True, env=env) as p:
                 for line in p.stdout:
-                    print(line, end='') # process line here
+                    parser.feed(line)
+
+                    if progress_callback is not None:
+                        progress_callback(line)
+                    else:
+                        print(line, end='')
+
+                peak_rss = wait_for_peak_rss(p)
+
+            self.record_peak_memory(name, memory_estimates.get(name), peak_rss)
 
             if p.returncode != 0:
                 raise subprocess.CalledProcessError(p.returncode, p.args)
 
-            self.preview_window.update_warped_moving_image_combobox()
-            self.preview_window.show_warped_moving_image()
+            completed_stages.append(stage_key)
+            self.workspace.save_checkpoint(completed_stages)
 
-    def create_shell_command(self):
-        if self.fixed_image_path is not None and len(self.moving_image_paths) > 0:
-            moving_image_path = self.moving_image_paths[self.registration_channel]
+            self.record_iteration_budgets(name, [ record for record in parser.records if record.stage == name ], progress_callback)
+
+    def record_iteration_budgets(self, name, records, progress_callback=None):
+        if self.iteration_budgets is None:
+            return
+
+        template_key = file_key(self.fixed_image_path)
+
+        plateaus = plateau_iterations(records, self.plateau_policy())
+
+        for stage, level in sorted(plateaus):
+            num_iterations = len([ record for record in records if record.level == level ])
+
+            if plateaus[(stage, level)] is not None:
+                message = "{} level {} plateaued at iteration {} of {}.\n".format(transform_names[name], level, plateaus[(stage, level)], num_iterations)
+
+                self.iteration_budgets.record(template_key, name, level, plateaus[(stage, level)])
+            else:
+                message = "{} level {} was still improving after {} iterations.\n".format(transform_names[name], level, num_iterations)
+
+                self.iteration_budgets.record(template_key, name, level, num_iterations)
+
+            if progress_callback is not None:
+                progress_callback(message)
+            else:
+                print(message, end='')
+
+        try:
+            self.iteration_budgets.save()
+        except OSError:
+            pass
+
+    def stage_image(self, path, progress_callback=None):
+        if self.staging_cache is None:
+            return path
+
+        try:
+            staged_path = self.staging_cache.stage(path)
+        except OSError as e:
+            # staging only saves time, so run on the original rather than fail
+            staged_path = path
+
+            message = "Could not stage {}: {}\n".format(path, e)
+
+            if progress_callback is not None:
+                progress_callback(message)
+            else:
+                print(message, end='')
+
+        if staged_path != path and self.staged_image_paths.get(path) != staged_path:
+            message = "Staged {} as {}.\n".format(path, staged_path)
+
+            if progress_callback is not None:
+                progress_callback(message)
+            else:
+                print(message, end='')
+
+        self.staged_image_paths[path] = staged_path
+
+        return staged_path
+
+    def input_image_path(self, path):
+        staged_path = self.staged_image_paths.get(path)
+
+        # fall back to the original if the staged copy was evicted since
+        if staged_path is not None and os.path.exists(staged_path):
+            return staged_path
+
+        return path
+
+    def stage_key(self, stages):
+        sha = hashlib.sha256()
+        sha.update(file_hash(self.fixed_image_path).encode())
+        sha.update(file_hash(self.moving_image_paths[self.registration_channel]).encode())
+        sha.update(json.dumps({"initial_moving_transform": self.params["initial_moving_transform"], "adaptive_iterations": self.params["adaptive_iterations"], "stages": stages}, sort_keys=True).encode())
+
+        return sha.hexdigest()
+
+    def apply_transforms(self, apply_transforms_commands, progress_callback=None):
+        from memory import image_voxels, apply_transforms_memory, run_measured
+
+        if len(apply_transforms_commands) == 0:
+            return {}
+
+        num_workers = self.num_apply_workers(len(apply_transforms_commands))
+
+        # share the thread budget between the concurrent antsApplyTransforms processes
+        num_threads = self.num_threads if self.num_threads is not None else (os.cpu_count() or 1)
+
+        env = os.environ.copy()
+        env["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(max(1, num_threads // num_workers))
 
-            directory       = os.path.dirname(self.fixed_image_path)
-            fixed_filename  = os.path.splitext(os.path.basename(self.fixed_image_path))[0]
-            moving_filename = os.path.splitext(os.path.basename(moving_image_path))[0]
+        results = {}
 
-            warped_moving_image_path = os.path.join(directory, "{}_warped_to_{}.nii.gz".format(moving_filename, fixed_filename))
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = { executor.submit(run_measured, command, env=env): i for i, command in apply_transforms_commands }
 
-            a = warped_moving_image_path.replace(" ", "\ ")
-            b = self.fixed_image_path.replace(" ", "\ ")
-            c = moving_image_path.replace(" ", "\ ")
+            for future in as_completed(futures):
+                i = futures[future]
 
-            self.shell_command = "antsRegistration -v 1 -d 3 -o [warp_,{}] -n Linear -r [{},{},{}]".format(a, b, c, initial_moving_transform_lut[self.params["initial_moving_transform"]])
-            
-            if self.params["translation"]:
-                self.shell_command += " -t Translation[{}]".format(self.translation_params["gradient_step"])
+                try:
+                    process, peak_rss = future.result()
+                except OSError as e:
+                    results[i] = -1
+                    message     = "Applying transforms to channel {} failed: {}\n".format(i, e)
+                else:
+                    results[i] = process.returncode
 
-                if self.translation_params["metric"] == "Cross-Correlation":
-                    self.shell_command += " -m CC[{},{},{},{},{},{}]".format(b, c, self.translation_cross_correlation_params["metric_weight"], self.translation_cross_correlation_params["radius"], self.translation_cross_correlation_params["sampling_strategy"], self.translation_cross_correlation_params["sampling_percentage"])
-                elif self.translation_params["metric"] == "Mutual Information":
-                    self.shell_command += " -m MI[{},{},{},{},{},{}]".format(b, c, self.translation_mutual_information_params["metric_weight"], self.translation_mutual_information_params["num_bins"], self.translation_mutual_information_params["sampling_strategy"], self.translation_mutual_information_params["sampling_percentage"])
-                
-                self.shell_command += " -c [{},{},{}]".format(self.translation_params["num_iterations"], self.translation_params["convergence_threshold"], self.translation_params["convergence_window_size"])
+                    try:
+                        estimate = apply_transforms_memory(image_voxels(self.fixed_image_path), image_voxels(self.moving_image_paths[i]), self.params["syn"])
+                    except (OSError, ValueError):
+                        estimate = None
 
-                self.shell_command += " -f {} -s {}".format(self.translation_params["shrink_factors"], self.translation_params["gaussian_sigma"])
+                    # a tiled apply is a tree of processes, so its peak can't be compared to the model
+                    if self.tiled_apply:
+                        estimate = None
 
-            if self.params["rigid"]:
-                self.shell_command += " -t Rigid[{}]".format(self.rigid_params["gradient_step"])
+                    self.record_peak_memory("apply", estimate, peak_rss)
 
-                if self.rigid_params["metric"] == "Cross-Correlation":
-                    self.shell_command += " -m CC[{},{},{},{},{},{}]".format(b, c, self.rigid_cross_correlation_params["metric_weight"], self.rigid_cross_correlation_params["radius"], self.rigid_cross_correlation_params["sampling_strategy"], self.rigid_cross_correlation_params["sampling_percentage"])
-                elif self.rigid_params["metric"] == "Mutual Information":
-                    self.shell_command += " -m MI[{},{},{},{},{},{}]".format(b, c, self.rigid_mutual_information_params["metric_weight"], self.rigid_mutual_information_params["num_bins"], self.rigid_mutual_information_params["sampling_strategy"], self.rigid_mutual_information_params["sampling_percentage"])
-                
-                self.shell_command += " -c [{},{},{}]".format(self.rigid_params["num_iterations"], self.rigid_params["convergence_threshold"], self.rigid_params["convergence_window_size"])
+                    if process.returncode == 0:
+                        message = "Applied transforms to channel {}.\n".format(i)
+                    else:
+                        message = process.stdout + "Applying transforms to channel {} failed with exit code {}.\n".format(i, process.returncode)
 
-                self.shell_command += " -f {} -s {}".format(self.rigid_params["shrink_factors"], self.rigid_params["gaussian_sigma"])
+                if progress_callback is not None:
+                    progress_callback(message)
+                else:
+                    print(message, end='')
 
-            if self.params["affine"]:
-                self.shell_command += " -t Affine[{}]".format(self.affine_params["gradient_step"])
+        self.save_memory_history()
 
-                if self.affine_params["metric"] == "Cross-Correlation":
-                    self.shell_command += " -m CC[{},{},{},{},{},{}]".format(b, c, self.affine_cross_correlation_params["metric_weight"], self.affine_cross_correlation_params["radius"], self.affine_cross_correlation_params["sampling_strategy"], self.affine_cross_correlation_params["sampling_percentage"])
-                elif self.affine_params["metric"] == "Mutual Information":
-                    self.shell_command += " -m MI[{},{},{},{},{},{}]".format(b, c, self.affine_mutual_information_params["metric_weight"], self.affine_mutual_information_params["num_bins"], self.affine_mutual_information_params["sampling_strategy"], self.affine_mutual_information_params["sampling_percentage"])
-                
-                self.shell_command += " -c [{},{},{}]".format(self.affine_params["num_iterations"], self.affine_params["convergence_threshold"], self.affine_params["convergence_window_size"])
+        return results
 
-                self.shell_command += " -f {} -s {}".format(self.affine_params["shrink_factors"], self.affine_params["gaussian_sigma"])
+    def memory_estimates(self):
+        from memory import image_voxels, stage_memory, apply_transforms_memory, tiled_apply_transforms_memory
 
-            if self.params["syn"]:
-                self.shell_command += " -t SyN[{},{},{}]".format(self.syn_params["gradient_step"], self.syn_params["update_field_variance"], self.syn_params["total_field_variance"])
+        fixed_voxels  = image_voxels(self.fixed_image_path)
+        moving_voxels = [ image_voxels(path) for path in self.moving_image_paths ]
+        num_threads   = self.num_threads if self.num_threads is not None else (os.cpu_count() or 1)
 
-                if self.syn_params["metric"] == "Cross-Correlation":
-                    self.shell_command += " -m CC[{},{},{},{},{},{}]".format(b, c, self.syn_cross_correlation_params["metric_weight"], self.syn_cross_correlation_params["radius"], self.syn_cross_correlation_params["sampling_strategy"], self.syn_cross_correlation_params["sampling_percentage"])
-                elif self.syn_params["metric"] == "Mutual Information":
-                    self.shell_command += " -m MI[{},{},{},{},{},{}]".format(b, c, self.syn_mutual_information_params["metric_weight"], self.syn_mutual_information_params["num_bins"], self.syn_mutual_information_params["sampling_strategy"], self.syn_mutual_information_params["sampling_percentage"])
-                
-                self.shell_command += " -c [{},{},{}]".format(self.syn_params["num_iterations"], self.syn_params["convergence_threshold"], self.syn_params["convergence_window_size"])
+        estimates = {}
 
-                self.shell_command += " -f {} -s {}".format(self.syn_params["shrink_factors"], self.syn_params["gaussian_sigma"])
+        # stages run one antsRegistration process after another, so they don't add up
+        for name, stage_params, metric_params in self.get_stages():
+            estimates[name] = stage_memory(name, stage_params, metric_params, fixed_voxels, moving_voxels[self.registration_channel], num_threads)
 
-            if len(self.moving_image_paths) > 1:
-                warp_path   = os.path.join(os.getcwd(), "warp_1Warp.nii.gz")
-                affine_path = os.path.join(os.getcwd(), "warp_0GenericAffine.mat")
+        # but the antsApplyTransforms processes run side by side
+        if len(moving_voxels) > 0 and self.tiled_apply:
+            # a limit rather than a model, so it's kept apart from the corrected "apply" phase
+            estimates["tiled_apply"] = tiled_apply_transforms_memory(self.tiled_apply_memory, num_threads)
+        elif len(moving_voxels) > 0:
+            num_workers = self.num_apply_workers(len(moving_voxels))
 
-                for i in range(len(self.moving_image_paths)):
-                    if i != self.registration_channel:
-                        moving_image_path = self.moving_image_paths[i]
-                        fixed_filename  = os.path.splitext(os.path.basename(self.fixed_image_path))[0]
-                        moving_filename = os.path.splitext(os.path.basename(moving_image_path))[0]
+            estimates["apply"] = num_workers*max([ apply_transforms_memory(fixed_voxels, voxels, self.params["syn"]) for voxels in moving_voxels ])
 
-                        warped_moving_image_path = os.path.join(directory, "{}_warped_to_{}.nii.gz".format(moving_filename, fixed_filename))
+        return estimates
 
-                        a = warped_moving_image_path.replace(" ", "\ ")
-                        b = self.fixed_image_path.replace(" ", "\ ")
-                        c = moving_image_path.replace(" ", "\ ")
-                        d = warp_path.replace(" ", "\ ")
-                        e = affine_path.replace(" ", "\ ")
+    def estimate_peak_memory(self):
+        estimates = self.memory_estimates()
 
-                        self.shell_command += " && antsApplyTransforms -d 3 -i {} -r {} -t {} -t {} -o {}".format(c, b, d, e, a)
+        if len(estimates) == 0:
+            return 0
+
+        # scale the model by how far off it was on earlier runs
+        if self.memory_history is None:
+            return int(max(estimates.values()))
+
+        return int(max([ estimates[phase]*self.memory_history.correction(phase) for phase in estimates ]))
+
+    def record_peak_memory(self, phase, estimate, peak_rss):
+        if peak_rss is None:
+            return
+
+        self.peak_memory[phase] = max(self.peak_memory.get(phase, 0), peak_rss)
+
+        if estimate is not None and estimate > 0 and self.memory_history is not None:
+            self.memory_history.record(phase, estimate, peak_rss)
+
+    def save_memory_history(self):
+        if self.memory_history is None:
+            return
+
+        try:
+            self.memory_history.save()
+        except OSError:
+            pass
+
+    def get_params(self):
+        return { name: copy.deepcopy(getattr(self, name)) for name in param_names }
+
+    def params_hash(self):
+        return params_hash(self.get_params())
+
+    def set_params(self, params):
+        for name in params:
+            if name not in param_names:
+                raise KeyError("Unknown parameter group \"{}\".".format(name))
+
+            getattr(self, name).update(params[name])
+
+    def get_apply_options(self):
+        return { name: getattr(self, name) for name in apply_option_names }
+
+    def set_apply_options(self, options):
+        for name in options:
+            if name not in apply_option_names:
+                raise KeyError("Unknown apply option \"{}\".".format(name))
+
+            setattr(self, name, options[name])
+
+    def copy_params_from(self, controller):
+        for name in param_names:
+            setattr(self, name, copy.deepcopy(getattr(controller, name)))
+
+    def snapshot(self):
+        # a copy to run a registration on while the GUI keeps editing this controller; the caches
+        # and histories are shared, since they're only added to
+        controller = Controller()
+        controller.copy_params_from(self)
+
+        controller.fixed_image_path          = self.fixed_image_path
+        controller.moving_image_paths        = list(self.moving_image_paths)
+        controller.warped_moving_image_paths = list(self.warped_moving_image_paths)
+        controller.registration_channel      = self.registration_channel
+        controller.num_threads               = self.num_threads
+        controller.workspace_root            = self.workspace_root
+        controller.job_id                    = self.job_id
+
+        controller.max_apply_workers = self.max_apply_workers
+        controller.set_apply_options(self.get_apply_options())
+
+        controller.transform_cache    = self.transform_cache
+        controller.iteration_budgets  = self.iteration_budgets
+        controller.staging_cache      = self.staging_cache
+        controller.memory_history     = self.memory_history
+        controller.staged_image_paths = dict(self.staged_image_paths)
+
+        return controller
+
+    def get_stages(self):
+        stages = [("translation", self.translation_params, self.translation_cross_correlation_params, self.translation_mutual_information_params),
+                  ("rigid", self.rigid_params, self.rigid_cross_correlation_params, self.rigid_mutual_information_params),
+                  ("affine", self.affine_params, self.affine_cross_correlation_params, self.affine_mutual_information_params),
+                  ("syn", self.syn_params, self.syn_cross_correlation_params, self.syn_mutual_information_params)]
+
+        enabled_stages = []
+        for name, stage_params, cross_correlation_params, mutual_information_params in stages:
+            if self.params[name]:
+                if stage_params["metric"] == "Cross-Correlation":
+                    metric_params = cross_correlation_params
+                else:
+                    metric_params = mutual_information_params
+
+                enabled_stages.append((name, stage_params, metric_params))
+
+        return enabled_stages
+
+    def registration_params(self):
+        # everything that affects the computed transforms, and nothing that doesn't (eg. the prefix)
+        stages = [ {"stage": name, "params": dict(stage_params), "metric_params": dict(metric_params)} for name, stage_params, metric_params in self.get_stages() ]
+
+        # adapted runs use the iteration counts the pipeline passes to antsRegistration, not the requested ones
+        if self.params["adaptive_iterations"]:
+            self.create_shell_command()
+
+            if self.pipeline_error is not None:
+                raise PipelineError(self.pipeline_error)
+
+            for stage, pipeline_stage in zip(stages, self.pipeline.stages if self.pipeline is not None else []):
+                stage["params"]["num_iterations"] = "x".join(pipeline_stage.convergence.num_iterations)
+
+        return {"initial_moving_transform": self.params["initial_moving_transform"], "adaptive_iterations": self.params["adaptive_iterations"], "stages": stages}
+
+    def plateau_policy(self):
+        return PlateauPolicy(window_size=int(self.params["plateau_window_size"]), min_relative_improvement=float(self.params["plateau_min_relative_improvement"]),
+                             margin=float(self.params["plateau_margin"]), min_iterations=int(self.params["plateau_min_iterations"]))
+
+    def transform_files(self):
+        transform_files = {"0GenericAffine.mat": self.workspace.affine_path}
+
+        if self.params["syn"]:
+            transform_files["1Warp.nii.gz"] = self.workspace.warp_path
+
+        return transform_files
+
+    def create_apply_transforms_command(self, i):
+        from tiled import tiled_apply_transforms_argv
+
+        moving_image_path = self.moving_image_paths[i]
+
+        warped_moving_image_path = self.workspace.warped_image_path(moving_image_path, self.fixed_image_path)
+
+        transform_paths = self.transform_paths()
+
+        if self.tiled_apply:
+            return tiled_apply_transforms_argv(self.input_image_path(moving_image_path), self.input_image_path(self.fixed_image_path), transform_paths, warped_moving_image_path,
+                                               max_memory=self.tiled_apply_memory//self.num_apply_workers(len(self.moving_image_paths)))
+
+        return apply_transforms_argv(self.input_image_path(moving_image_path), self.input_image_path(self.fixed_image_path), transform_paths, warped_moving_image_path)
+
+    def transform_paths(self):
+        # transforms are applied last to first, so the warp goes before the affine
+        transform_paths = [self.workspace.affine_path]
+        if self.params["syn"]:
+            transform_paths.insert(0, self.workspace.warp_path)
+
+        return transform_paths
+
+    def num_apply_workers(self, num_commands):
+        return max(1, min(self.max_apply_workers, num_commands))
+
+    def create_pipeline(self, stages):
+        pipeline_stages = []
+
+        if self.params["adaptive_iterations"]:
+            # budgets are kept by the fixed image's contents, which may have moved since it was chosen
+            try:
+                template_key = file_key(self.fixed_image_path)
+            except OSError as e:
+                raise PipelineError("Could not read the fixed image {}: {}".format(self.fixed_image_path, e.strerror or e))
+
+        for name, stage_params, metric_params in stages:
+            num_iterations = stage_params["num_iterations"]
+
+            # shorten levels that converged early on this template in earlier runs
+            if self.params["adaptive_iterations"]:
+                num_iterations = self.iteration_budgets.adapt(template_key, name, num_iterations, self.plateau_policy())
+
+            pipeline_stages.append(create_stage(name, stage_params, metric_params, num_iterations=num_iterations))
+
+        pipeline = Pipeline(self.input_image_path(self.fixed_image_path), self.input_image_path(self.moving_image_paths[self.registration_channel]), initial_moving_transform_lut[self.params["initial_moving_transform"]], pipeline_stages)
+        pipeline.validate()
+
+        return pipeline
+
+    def command_key(self):
+        key = [ getattr(self, name) for name in param_names ] + [self.fixed_image_path, self.moving_image_paths, self.registration_channel, self.workspace.directory]
+        key += [ self.input_image_path(path) for path in [self.fixed_image_path] + self.moving_image_paths ]
+        key += [self.tiled_apply, self.tiled_apply_memory, self.warp_on_demand]
+
+        if self.params["adaptive_iterations"]:
+            # an unreadable fixed image is reported by create_pipeline
+            try:
+                key += [file_key(self.fixed_image_path), self.iteration_budgets.version]
+            except OSError:
+                key += [None, self.iteration_budgets.version]
+
+        return json.dumps(key, sort_keys=True)
+
+    def create_workspace(self):
+        if self.job_id is None:
+            self.workspace = Workspace(self.get_workspace_root(), prefix=self.params["prefix"])
+            self.job_id    = self.workspace.job_id
         else:
-            self.shell_command = ""
+            self.workspace = Workspace(self.get_workspace_root(), job_id=self.job_id, prefix=self.params["prefix"])
+
+    def get_workspace_root(self):
+        if self.workspace_root is not None:
+            return self.workspace_root
+
+        return os.path.join(os.path.dirname(self.fixed_image_path), "registrations")
+
+    def create_shell_command(self):
+        stages = []
+        if self.fixed_image_path is not None and len(self.moving_image_paths) > 0:
+            stages = self.get_stages()
+
+        if len(stages) == 0:
+            self.pipeline                  = None
+            self.pipeline_error            = None
+            self.rendered_command_key      = None
+            self.registration_commands     = []
+            self.apply_transforms_commands = []
+            self.shell_command             = ""
+            return
+
+        self.create_workspace()
+
+        # only rebuild the commands when something they depend on has changed
+        command_key = self.command_key()
+        if command_key == self.rendered_command_key:
+            return
+
+        self.rendered_command_key      = command_key
+        self.registration_commands     = []
+        self.apply_transforms_commands = []
+        self.shell_command             = ""
+
+        try:
+            self.pipeline       = self.create_pipeline(stages)
+            self.pipeline_error = None
+        except PipelineError as e:
+            self.pipeline       = None
+            self.pipeline_error = str(e)
+            return
+
+        warped_moving_image_path = self.workspace.warped_image_path(self.moving_image_paths[self.registration_channel], self.fixed_image_path)
+
+        # each stage is run separately and starts from the affine of the stage before it,
+        # so an interrupted run can resume from the last completed stage
+        initial_transform = self.pipeline.initial_transform()
+
+        for i in range(len(self.pipeline.stages)):
+            name = self.pipeline.stages[i].name
+
+            if i == len(self.pipeline.stages) - 1:
+                output       = "[{},{}]".format(self.workspace.transform_prefix, warped_moving_image_path)
+                output_paths = list(self.transform_files().values())
+            else:
+                output       = self.workspace.stage_prefix(name)
+                output_paths = [self.workspace.stage_affine_path(name)]
+
+            self.registration_commands.append((name, self.pipeline.stage_argv(i, output, initial_transform), output_paths))
+
+            initial_transform = self.workspace.stage_affine_path(name)
+
+        for i in range(len(self.moving_image_paths)):
+            if i != self.registration_channel and not self.warp_on_demand:
+                self.apply_transforms_commands.append((i, self.create_apply_transforms_command(i)))
+
+        self.shell_command = "\n".join([ render_command(command) for name, command, output_paths in self.registration_commands ] + [ render_command(command) for i, command in self.apply_transforms_commands ])
 
     def add_moving_images(self, paths):
         self.moving_image_paths += paths
@@ -240,4 +757,25 @@ class Controller:
         self.warped_moving_image_paths += paths
 
     def remove_warped_moving_image(self, index):
-        del self.warped_moving_image_paths[index]
\ No newline at end of file
+        del self.warped_moving_image_paths[index]
+
+
+def register_images(fixed_image_path, moving_image_paths, params=None, registration_channel=0, workspace_root=None, job_id=None, num_threads=None, progress_callback=None, telemetry_callback=None, tiled_apply=False, apply_options=None):
+    controller = Controller()
+    controller.tiled_apply          = tiled_apply
+    controller.fixed_image_path     = os.path.abspath(fixed_image_path)
+    controller.registration_channel = registration_channel
+    controller.num_threads          = num_threads
+    controller.workspace_root       = workspace_root
+    controller.job_id               = job_id
+    controller.add_moving_images([ os.path.abspath(path) for path in moving_image_paths ])
+
+    if params is not None:
+        controller.set_params(params)
+
+    if apply_options is not None:
+        controller.set_apply_options(apply_options)
+
+    apply_transforms_results = controller.register(progress_callback=progress_callback, telemetry_callback=telemetry_callback)
+
+    return controller, apply_transforms_results
@@ -0,0 +1,88 @@
+import os
+import json
+import math
+import tempfile
+
+class PlateauPolicy:
+    def __init__(self, window_size=10, min_relative_improvement=1e-4, margin=1.25, min_iterations=10):
+        self.window_size              = window_size
+        self.min_relative_improvement = min_relative_improvement
+        self.margin                   = margin
+        self.min_iterations           = min_iterations
+
+    def plateau_iteration(self, metric_values):
+        # ANTs metrics decrease as the images align, so improvement is the drop over the window
+        for i in range(self.window_size, len(metric_values)):
+            previous = metric_values[i - self.window_size]
+            current  = metric_values[i]
+
+            if not (math.isfinite(previous) and math.isfinite(current)):
+                continue
+
+            if (previous - current) < self.min_relative_improvement*max(abs(previous), 1e-12):
+                return i + 1
+
+        return None
+
+    def iteration_budget(self, plateau_iterations):
+        return max(self.min_iterations, int(math.ceil(max(plateau_iterations)*self.margin)))
+
+class IterationBudgets:
+    def __init__(self, path, history_size=5):
+        self.path         = path
+        self.history_size = history_size
+
+        self.budgets = {}
+
+        # bumped on every change so rendered commands know when to adapt again
+        self.version = 0
+
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.budgets = json.load(f)
+            except (OSError, ValueError):
+                self.budgets = {}
+
+    def record(self, template_key, stage, level, plateau_iteration):
+        history = self.budgets.setdefault(template_key, {}).setdefault(stage, {}).setdefault(str(level), [])
+        history.append(plateau_iteration)
+        self.version += 1
+
+        del history[:-self.history_size]
+
+    def history(self, template_key, stage, level):
+        return self.budgets.get(template_key, {}).get(stage, {}).get(str(level), [])
+
+    def adapt(self, template_key, stage, num_iterations, policy):
+        levels = num_iterations.split("x")
+
+        for i in range(len(levels)):
+            history = self.history(template_key, stage, i + 1)
+
+            # never raise the configured count, and leave skipped (0 iteration) levels alone
+            if len(history) > 0 and int(levels[i]) > 0:
+                levels[i] = str(min(int(levels[i]), policy.iteration_budget(history)))
+
+        return "x".join(levels)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.budgets, f)
+
+        os.replace(temp_path, self.path)
+
+def plateau_iterations(records, policy):
+    metric_values = {}
+    for record in records:
+        metric_values.setdefault((record.stage, record.level), []).append(record.metric_value)
+
+    plateaus = {}
+    for key in metric_values:
+        plateaus[key] = policy.plateau_iteration(metric_values[key])
+
+    return plateaus
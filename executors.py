@@ -0,0 +1,354 @@
+import os
+import sys
+import json
+import time
+import glob
+import signal
+import socket
+import sqlite3
+import tempfile
+import subprocess
+
+from batch import run_job
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+def kill_process_group(pid):
+    try:
+        os.killpg(pid, signal.SIGTERM)
+    except OSError:
+        pass
+
+def write_json(path, data):
+    # write next to the destination and rename, so readers on other nodes never see a partial file
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+
+    os.replace(temp_path, path)
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class ProgressReporter:
+    # the last output line and telemetry record of a job, handed to write at most every interval
+    # seconds, since the store or spool may be on a network filesystem
+    def __init__(self, write, interval=2.0, worker=None):
+        self.write    = write
+        self.interval = interval
+        self.progress = {"worker": worker, "line": None, "telemetry": None, "time": 0}
+
+    def report(self):
+        if time.time() - self.progress["time"] >= self.interval:
+            self.progress["time"] = time.time()
+
+            try:
+                self.write(self.progress)
+            except (OSError, sqlite3.Error):
+                pass
+
+    def progress_callback(self, line):
+        self.progress["line"] = line.strip()
+        self.report()
+
+    def telemetry_callback(self, record):
+        self.progress["telemetry"] = record._asdict()
+        self.report()
+
+class LocalExecutor:
+    # jobs run as detached processes on this machine and record their results in the store themselves
+    is_local = True
+
+    def __init__(self, store):
+        self.store = store
+
+        # job processes started by this executor; jobs still running from an earlier
+        # session are watched through their PIDs instead
+        self.processes = {}
+
+    def start(self, job, num_threads, token):
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs.py"), self.store.path, str(job["id"]), str(num_threads), token]
+
+        # a session of its own keeps the job running if the GUI exits or crashes
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+        self.processes[job["id"]] = process
+
+        return process.pid
+
+    def collect(self):
+        # reap processes of jobs that finished or were cancelled
+        for id in list(self.processes):
+            if self.processes[id].poll() is None:
+                continue
+
+            # a process that exited while its job still shows as running is left to check
+            job = self.store.get(id)
+
+            if job is None or job["status"] != "running":
+                del self.processes[id]
+
+        return []
+
+    def check(self, job):
+        process = self.processes.get(job["id"])
+
+        if process is not None:
+            if process.poll() is None:
+                return None
+
+            del self.processes[job["id"]]
+
+            return "Job process exited without recording a result (exit code {}).".format(process.returncode)
+
+        if job["pid"] is not None and process_alive(job["pid"]):
+            return None
+
+        return "Job process exited without recording a result."
+
+    def cancel(self, job):
+        if job["pid"] is not None and process_alive(job["pid"]):
+            kill_process_group(job["pid"])
+
+    def progress(self, job):
+        # the job processes write their progress to the store themselves
+        return None
+
+class SpoolExecutor:
+    # jobs are handed to worker processes, on this or other nodes, through a spool directory on
+    # a shared filesystem, with the files named by the token of the job's attempt:
+    #   queued/<token>.json       waiting for a worker
+    #   claimed/<token>.json      renamed here by the worker that claimed it
+    #   claimed/<token>.worker    the claiming worker, touched as its heartbeat
+    #   progress/<token>.json     the last output line and telemetry record
+    #   results/<token>.json      the result, until the scheduler collects it
+    #   cancelled/<token>         asks the worker to stop the job
+    # a worker whose claimed file is removed, because the scheduler gave up on it, stops its job
+    is_local = False
+
+    def __init__(self, directory, heartbeat_timeout=60.0):
+        self.directory         = os.path.abspath(directory)
+        self.heartbeat_timeout = heartbeat_timeout
+
+        create_spool(self.directory)
+
+    def path(self, state, token, extension=".json"):
+        return os.path.join(self.directory, state, token + extension)
+
+    def start(self, job, num_threads, token):
+        # paths are passed as they are, so the inputs and workspaces have to be on storage every
+        # node mounts at the same place; workers stage the inputs into their own local caches
+        write_json(self.path("queued", token), {"id": job["id"], "job_id": job["job_id"], "token": token, "fixed": job["fixed"], "moving": job["moving"], "registration_channel": job["registration_channel"],
+                                                "params": job["params"], "apply_options": job["apply_options"], "workspace_root": job["workspace_root"], "num_threads": job["num_threads"]})
+
+        return None
+
+    def collect(self):
+        results = []
+
+        for path in sorted(glob.glob(os.path.join(self.directory, "results", "*.json"))):
+            result = read_json(path)
+
+            if result is None:
+                continue
+
+            results.append((result["id"], result))
+
+            remove_file(path)
+            remove_file(self.path("progress", result["token"]))
+
+        return results
+
+    def check(self, job):
+        token = job["token"]
+
+        if token is None:
+            return "Job was started without an attempt token."
+
+        if os.path.exists(self.path("queued", token)) or os.path.exists(self.path("results", token)):
+            return None
+
+        if os.path.exists(self.path("claimed", token)):
+            try:
+                heartbeat = os.path.getmtime(self.path("claimed", token, ".worker"))
+            except OSError:
+                heartbeat = os.path.getmtime(self.path("claimed", token))
+
+            if time.time() - heartbeat <= self.heartbeat_timeout:
+                return None
+
+            try:
+                with open(self.path("claimed", token, ".worker")) as f:
+                    worker_id = f.read().strip()
+            except OSError:
+                worker_id = "unknown"
+
+            remove_file(self.path("claimed", token))
+            remove_file(self.path("claimed", token, ".worker"))
+            remove_file(self.path("progress", token))
+
+            return "Worker {} stopped sending heartbeats.".format(worker_id)
+
+        return "Job disappeared from the spool directory."
+
+    def cancel(self, job):
+        if job["token"] is None:
+            return
+
+        remove_file(self.path("queued", job["token"]))
+
+        if os.path.exists(self.path("claimed", job["token"])):
+            open(self.path("cancelled", job["token"], ""), "w").close()
+
+    def progress(self, job):
+        return read_json(self.path("progress", job["token"])) if job["token"] is not None else None
+
+def create_spool(directory):
+    for state in ("queued", "claimed", "progress", "results", "cancelled"):
+        os.makedirs(os.path.join(directory, state), exist_ok=True)
+
+def claim_job(directory, worker_id):
+    # oldest first; the scheduler only queues jobs it has admitted, in priority order
+    paths = sorted(glob.glob(os.path.join(directory, "queued", "*.json")), key=lambda path: (os.path.getmtime(path) if os.path.exists(path) else 0, path))
+
+    for path in paths:
+        claimed_path = os.path.join(directory, "claimed", os.path.basename(path))
+
+        # rename is atomic, so only one worker wins each job
+        try:
+            os.rename(path, claimed_path)
+        except OSError:
+            continue
+
+        with open(os.path.splitext(claimed_path)[0] + ".worker", "w") as f:
+            f.write(worker_id)
+
+        return read_json(claimed_path)
+
+    return None
+
+def run_spooled_job(directory, token, num_threads, worker_id, progress_interval=2.0):
+    job = read_json(os.path.join(directory, "claimed", token + ".json"))
+
+    progress_path = os.path.join(directory, "progress", token + ".json")
+    reporter      = ProgressReporter(lambda progress: write_json(progress_path, progress), interval=progress_interval, worker=worker_id)
+
+    try:
+        result = run_job(job, job["workspace_root"], num_threads, params=job["params"], progress_callback=reporter.progress_callback, telemetry_callback=reporter.telemetry_callback)
+    except Exception as e:
+        result = {"status": "failed", "error": str(e)}
+
+    result.update({"id": job["id"], "job_id": job["job_id"], "token": token, "worker": worker_id})
+
+    write_json(os.path.join(directory, "results", token + ".json"), result)
+
+def run_worker(directory, num_threads=None, worker_id=None, poll_interval=1.0, heartbeat_interval=5.0, once=False):
+    directory = os.path.abspath(directory)
+    worker_id = worker_id if worker_id is not None else "{}-{}".format(socket.gethostname(), os.getpid())
+
+    create_spool(directory)
+
+    while True:
+        job = claim_job(directory, worker_id)
+
+        if job is None:
+            if once:
+                return
+
+            time.sleep(poll_interval)
+            continue
+
+        token          = job["token"]
+        claimed_path   = os.path.join(directory, "claimed", token + ".json")
+        heartbeat_path = os.path.join(directory, "claimed", token + ".worker")
+        cancelled_path = os.path.join(directory, "cancelled", token)
+        result_path    = os.path.join(directory, "results", token + ".json")
+
+        job_threads = job["num_threads"] or num_threads or os.cpu_count() or 1
+
+        # the job runs in a process group of its own, so cancelling it also stops ANTs
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "run-job", directory, token, str(job_threads), worker_id], start_new_session=True)
+
+        while True:
+            try:
+                process.wait(timeout=heartbeat_interval)
+                break
+            except subprocess.TimeoutExpired:
+                try:
+                    os.utime(heartbeat_path)
+                except OSError:
+                    pass
+
+                # the scheduler removes the claim when it gives up on this worker and requeues the
+                # job under a new token, so the job would only be running twice
+                if os.path.exists(cancelled_path) or not os.path.exists(claimed_path):
+                    kill_process_group(process.pid)
+
+        if not os.path.exists(result_path):
+            write_json(result_path, {"id": job["id"], "job_id": job["job_id"], "token": token, "worker": worker_id, "status": "failed", "error": "Job process exited with code {} without a result.".format(process.returncode)})
+
+        remove_file(claimed_path)
+        remove_file(heartbeat_path)
+        remove_file(cancelled_path)
+
+        if once:
+            return
+
+def spawn_local_workers(directory, num_workers, num_threads=None):
+    # stand-ins for worker nodes, for trying out and testing the spool protocol on one machine
+    processes = []
+
+    for i in range(num_workers):
+        command = [sys.executable, os.path.abspath(__file__), "worker", os.path.abspath(directory), "--worker-id", "local-{}".format(i)]
+
+        if num_threads is not None:
+            command += ["--threads", str(num_threads)]
+
+        processes.append(subprocess.Popen(command))
+
+    return processes
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run registration jobs from a spool directory.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    worker_parser = subparsers.add_parser("worker", help="Claim and run jobs until stopped.")
+    worker_parser.add_argument("spool", help="Spool directory shared with the scheduler.")
+    worker_parser.add_argument("-t", "--threads", type=int, default=None, help="ITK threads per job (default: all cores).")
+    worker_parser.add_argument("--worker-id", default=None, help="Name reported with results (default: host name and PID).")
+    worker_parser.add_argument("--once", action="store_true", help="Run at most one job, then exit.")
+
+    run_job_parser = subparsers.add_parser("run-job", help="Run one claimed job; started by workers.")
+    run_job_parser.add_argument("spool")
+    run_job_parser.add_argument("token")
+    run_job_parser.add_argument("threads", type=int)
+    run_job_parser.add_argument("worker_id")
+
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        run_worker(args.spool, num_threads=args.threads, worker_id=args.worker_id, once=args.once)
+    else:
+        run_spooled_job(args.spool, args.token, args.threads, args.worker_id)
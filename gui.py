@@ -1,16 +1,22 @@
-import numpy as np
 import sys
-import nibabel as nib
+import os
 import pyqtgraph as pg
-import cv2
 import subprocess
-import matplotlib.cm as cm
+import threading
 
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
+from concurrent.futures import ThreadPoolExecutor
+
 from controller import Controller
+from volume import VolumeCache, VolumeLoadCancelled, WarpedVolume
+from transforms import SliceTransformer
+from rendering import SliceCache, OverlayCompositor, FrameTimer
+from preview import register_preview
+from jobs import JobStore, Scheduler, progress_summary, job_controller
+from presets import builtin_presets, get_preset, create_preset, save_preset
 
 class PreviewWindow(QMainWindow):
     def __init__(self, controller):
@@ -18,8 +24,6 @@ class PreviewWindow(QMainWindow):
 
         self.controller = controller
 
-        self.controller.preview_window = self
-
         self.fixed_image_z  = 0
         self.moving_image_z = 0
 
@@ -29,9 +33,31 @@ class PreviewWindow(QMainWindow):
         self.moving_image        = None
         self.warped_moving_image = None
 
+        self.fixed_image_slices         = None
+        self.moving_image_slices        = None
+        self.warped_moving_image_slices = None
+
+        self.overlay_compositor = OverlayCompositor("hot")
+
         self.moving_image_channel = 0
         self.warped_moving_image_channel = 0
 
+        self.registration_thread = None
+
+        # warped channels that are resampled from the transforms as they're shown, by their
+        # label in the warped channel list, as (moving image path, slice transformer)
+        self.on_demand_channels    = {}
+        self.on_demand_transformer = None
+
+        self.frame_timer = FrameTimer(callback=self.update_frame_time_overlay)
+
+        # volumes load off the UI thread, and recently used channels stay in memory
+        self.volume_cache  = VolumeCache(staging_cache=self.controller.staging_cache)
+        self.volume_loader = VolumeLoader(self.volume_cache)
+        self.volume_loader.progress.connect(self.volume_load_progress)
+        self.volume_loader.loaded.connect(self.volume_loaded)
+        self.volume_loader.failed.connect(self.volume_load_failed)
+
         # Create main widget
         self.main_widget = QWidget(self)
         self.main_widget.setMinimumSize(QSize(1300, 700))
@@ -87,6 +113,15 @@ class PreviewWindow(QMainWindow):
         self.warped_moving_image_viewbox.setYLink('fixed_image')
         self.warped_moving_image_viewbox.setYLink('fixed_image')
 
+        # frame times of the slice, alpha and channel handlers, toggled with Ctrl+Shift+F
+        self.frame_time_label = QLabel(self.pg_widget)
+        self.frame_time_label.setStyleSheet("background-color: rgba(0, 0, 0, 160); color: white; font-family: monospace; padding: 4px;")
+        self.frame_time_label.move(10, 10)
+        self.frame_time_label.setVisible(os.environ.get("REGISTRATION_FRAME_TIMES", "") not in ("", "0"))
+
+        self.frame_time_shortcut = QShortcut(QKeySequence("Ctrl+Shift+F"), self)
+        self.frame_time_shortcut.activated.connect(self.toggle_frame_time_overlay)
+
         # self.bottom_widget = QWidget(self)
         # self.main_layout.addWidget(self.bottom_widget)
         # self.bottom_layout = QHBoxLayout(self.bottom_widget)
@@ -235,6 +270,14 @@ class PreviewWindow(QMainWindow):
         layout.addWidget(self.syn_checkbox)
         self.main_layout.addWidget(widget, 6, 2)
 
+        widget = QWidget(self)
+        layout = QHBoxLayout(widget)
+        self.warp_on_demand_checkbox = QCheckBox("Warp channels on demand instead of applying transforms")
+        self.warp_on_demand_checkbox.clicked.connect(self.toggle_warp_on_demand)
+        self.warp_on_demand_checkbox.setChecked(self.controller.warp_on_demand)
+        layout.addWidget(self.warp_on_demand_checkbox)
+        self.main_layout.addWidget(widget, 6, 1)
+
         widget = QWidget(self)
         layout = QHBoxLayout(widget)
         # layout.addStretch()
@@ -253,16 +296,36 @@ class PreviewWindow(QMainWindow):
         self.show_shell_command_button = QPushButton("Show Shell Command...")
         self.show_shell_command_button.clicked.connect(self.show_shell_command)
         layout.addWidget(self.show_shell_command_button)
+        self.show_queue_button = QPushButton("Show Queue...")
+        self.show_queue_button.clicked.connect(self.show_queue)
+        layout.addWidget(self.show_queue_button)
+        layout.addStretch()
+        self.show_convergence_button = QPushButton("Show Convergence...")
+        self.show_convergence_button.clicked.connect(self.show_convergence)
+        layout.addWidget(self.show_convergence_button)
         layout.addStretch()
+        self.preview_register_button = QPushButton("Quick Preview")
+        self.preview_register_button.clicked.connect(self.preview_register)
+        layout.addWidget(self.preview_register_button)
+        self.add_to_queue_button = QPushButton("Add to Queue")
+        self.add_to_queue_button.clicked.connect(self.add_to_queue)
+        layout.addWidget(self.add_to_queue_button)
         self.register_button = QPushButton("Register")
-        self.register_button.clicked.connect(self.controller.register)
+        self.register_button.clicked.connect(self.register)
         self.register_button.setStyleSheet("font-weight: bold;")
         layout.addWidget(self.register_button)
         self.main_layout.addWidget(widget, 7, 2)
 
         self.setCentralWidget(self.main_widget)
 
+        self.volume_load_progress_bar = QProgressBar()
+        self.volume_load_progress_bar.setMaximumWidth(200)
+        self.volume_load_progress_bar.setVisible(False)
+        self.statusBar().addPermanentWidget(self.volume_load_progress_bar)
+
         self.shell_command_window = ShellCommandWindow()
+        self.queue_window         = None
+        self.convergence_window   = ConvergenceWindow()
         self.param_window = ParamWindow(self, self.controller)
 
         self.show()
@@ -278,97 +341,101 @@ class PreviewWindow(QMainWindow):
 
         return widget
 
-    def update_fixed_image(self, image):
-        if self.fixed_image_z >= image.shape[2]:
+    def create_slice_cache(self, slice_cache, volume):
+        if slice_cache is not None:
+            slice_cache.close()
+
+        return SliceCache(lambda z: render_slice(volume, z), volume.depth)
+
+    def update_fixed_image(self, volume):
+        if self.fixed_image_z >= volume.depth:
             self.fixed_image_z = 0
             self.fixed_image_z_slider.setValue(self.fixed_image_z)
 
-        self.fixed_image = image.astype(np.uint8)
-        if len(self.fixed_image.shape) > 3:
-            self.fixed_image = self.fixed_image[:, :, :, 0]
-        self.fixed_image_item.setImage(cv2.cvtColor(self.fixed_image[:, :, self.fixed_image_z], cv2.COLOR_GRAY2RGB), levels=(0, 255))
+        self.fixed_image = volume
+        self.fixed_image_slices = self.create_slice_cache(self.fixed_image_slices, volume)
+        self.fixed_image_item.setImage(self.fixed_image_slices.get(self.fixed_image_z), levels=(0, 255))
         self.fixed_image_viewbox.autoRange()
 
-        self.fixed_image_z_slider.setMaximum(self.fixed_image.shape[2]-1)
-        self.warped_moving_image_z_slider.setMaximum(self.fixed_image.shape[2]-1)
+        self.fixed_image_z_slider.setMaximum(self.fixed_image.depth-1)
+        self.warped_moving_image_z_slider.setMaximum(self.fixed_image.depth-1)
+
+        # a warped image that finished loading first is composited now
+        self.update_overlay_image()
     
-    def update_moving_image(self, image):
-        if self.moving_image_z >= image.shape[2]:
+    def update_moving_image(self, volume):
+        if self.moving_image_z >= volume.depth:
             self.moving_image_z = 0
             self.moving_image_z_slider.setValue(self.moving_image_z)
 
-        self.moving_image = image.astype(np.uint8)
-        if len(self.moving_image.shape) > 3:
-            self.moving_image = self.moving_image[:, :, :, 0]
-        self.moving_image_item.setImage(cv2.cvtColor(self.moving_image[:, :, self.moving_image_z], cv2.COLOR_GRAY2RGB), levels=(0, 255))
+        self.moving_image = volume
+        self.moving_image_slices = self.create_slice_cache(self.moving_image_slices, volume)
+        self.moving_image_item.setImage(self.moving_image_slices.get(self.moving_image_z), levels=(0, 255))
         self.moving_image_viewbox.autoRange()
 
-        self.moving_image_z_slider.setMaximum(self.moving_image.shape[2]-1)
+        self.moving_image_z_slider.setMaximum(self.moving_image.depth-1)
     
-    def update_warped_moving_image(self, image):
-        self.warped_moving_image = image.astype(np.uint8)
-        if len(self.warped_moving_image.shape) > 3:
-            self.warped_moving_image = self.warped_moving_image[:, :, :, 0]
-
-        fixed_image = cv2.cvtColor(self.fixed_image[:, :, self.fixed_image_z], cv2.COLOR_GRAY2RGB)
-
-        cm_hot = cm.get_cmap('hot')
-        image = (cm_hot(self.warped_moving_image[:, :, self.fixed_image_z])*255.0)[:, :, :3].astype(np.uint8)
-
-        alpha = 0.5
-
-        cv2.addWeighted(image, alpha, fixed_image, 1 - alpha, 0, fixed_image)
+    def update_warped_moving_image(self, volume):
+        self.warped_moving_image = volume
+        self.warped_moving_image_slices = self.create_slice_cache(self.warped_moving_image_slices, volume)
 
-        self.warped_moving_image_item.setImage(fixed_image, levels=(0, 255))
+        self.update_overlay_image()
         self.warped_moving_image_viewbox.autoRange()
 
-        self.warped_moving_image_z_slider.setMaximum(self.warped_moving_image.shape[2]-1)
+        self.warped_moving_image_z_slider.setMaximum(self.warped_moving_image.depth-1)
 
-    def update_warped_moving_image_z(self):
-        self.fixed_image_z = self.warped_moving_image_z_slider.sliderPosition()
+    def clear_warped_moving_image(self):
+        if self.warped_moving_image_slices is not None:
+            self.warped_moving_image_slices.close()
 
-        self.fixed_image_z_slider.setValue(self.fixed_image_z)
+        self.warped_moving_image        = None
+        self.warped_moving_image_slices = None
 
-        self.fixed_image_item.setImage(cv2.cvtColor(self.fixed_image[:, :, self.fixed_image_z], cv2.COLOR_GRAY2RGB), levels=(0, 255))
+        self.warped_moving_image_item.setImage(None)
 
-        if self.warped_moving_image is not None:
-            fixed_image = cv2.cvtColor(self.fixed_image[:, :, self.fixed_image_z], cv2.COLOR_GRAY2RGB)
+    def update_overlay_image(self):
+        # the volumes load independently, so either may not be there yet
+        if self.fixed_image_slices is None or self.warped_moving_image_slices is None:
+            return
 
-            cm_hot = cm.get_cmap('hot')
-            image = (cm_hot(self.warped_moving_image[:, :, self.fixed_image_z])*255.0)[:, :, :3].astype(np.uint8)
+        image = self.overlay_compositor.composite(self.fixed_image_slices.get(self.fixed_image_z), self.warped_moving_image_slices.get(self.fixed_image_z), self.overlay_alpha)
 
-            cv2.addWeighted(image, self.overlay_alpha, fixed_image, 1 - self.overlay_alpha, 0, fixed_image)
+        self.warped_moving_image_item.setImage(image, levels=(0, 255))
 
-            self.warped_moving_image_item.setImage(fixed_image, levels=(0, 255))
+    def update_warped_moving_image_z(self):
+        with self.frame_timer.frame("warped_moving_image_z"):
+            self.fixed_image_z = self.warped_moving_image_z_slider.sliderPosition()
 
-    def update_fixed_image_z(self):
-        self.fixed_image_z = self.fixed_image_z_slider.sliderPosition()
+            self.fixed_image_z_slider.setValue(self.fixed_image_z)
 
-        self.warped_moving_image_z_slider.setValue(self.fixed_image_z)
+            if self.fixed_image_slices is not None:
+                self.fixed_image_item.setImage(self.fixed_image_slices.get(self.fixed_image_z), levels=(0, 255))
 
-        self.fixed_image_item.setImage(cv2.cvtColor(self.fixed_image[:, :, self.fixed_image_z], cv2.COLOR_GRAY2RGB), levels=(0, 255))
+            self.update_overlay_image()
 
-        if self.warped_moving_image is not None:
-            fixed_image = cv2.cvtColor(self.fixed_image[:, :, self.fixed_image_z], cv2.COLOR_GRAY2RGB)
+    def update_fixed_image_z(self):
+        with self.frame_timer.frame("fixed_image_z"):
+            self.fixed_image_z = self.fixed_image_z_slider.sliderPosition()
 
-            cm_hot = cm.get_cmap('hot')
-            image = (cm_hot(self.warped_moving_image[:, :, self.fixed_image_z])*255.0)[:, :, :3].astype(np.uint8)
+            self.warped_moving_image_z_slider.setValue(self.fixed_image_z)
 
-            cv2.addWeighted(image, self.overlay_alpha, fixed_image, 1 - self.overlay_alpha, 0, fixed_image)
+            if self.fixed_image_slices is not None:
+                self.fixed_image_item.setImage(self.fixed_image_slices.get(self.fixed_image_z), levels=(0, 255))
 
-            self.warped_moving_image_item.setImage(fixed_image, levels=(0, 255))
+            self.update_overlay_image()
    
     def update_moving_image_z(self):
-        self.moving_image_z = self.moving_image_z_slider.sliderPosition()
+        with self.frame_timer.frame("moving_image_z"):
+            self.moving_image_z = self.moving_image_z_slider.sliderPosition()
 
-        self.moving_image_item.setImage(cv2.cvtColor(self.moving_image[:, :, self.moving_image_z], cv2.COLOR_GRAY2RGB), levels=(0, 255))
+            if self.moving_image_slices is not None:
+                self.moving_image_item.setImage(self.moving_image_slices.get(self.moving_image_z), levels=(0, 255))
 
     def select_fixed_image(self):
         video_paths = QFileDialog.getOpenFileNames(self, 'Select fixed image.', '', 'NIFTI Files (*.nii *.nii.gz)')[0]
         
         if len(video_paths) > 0:
-            fixed_image = nib.load(video_paths[0]).get_fdata()
-            self.update_fixed_image(fixed_image)
+            self.volume_loader.load("fixed", video_paths[0])
 
             self.controller.fixed_image_path = video_paths[0]
 
@@ -380,8 +447,7 @@ class PreviewWindow(QMainWindow):
         video_paths = [ video_path for video_path in video_paths if video_path not in self.controller.moving_image_paths ]
         
         if len(video_paths) > 0:
-            moving_image = nib.load(video_paths[0]).get_fdata()
-            self.update_moving_image(moving_image)
+            self.volume_loader.load("moving", video_paths[0])
             
             self.controller.add_moving_images(video_paths)
 
@@ -400,8 +466,7 @@ class PreviewWindow(QMainWindow):
         video_paths = [ video_path for video_path in video_paths if video_path not in self.controller.warped_moving_image_paths ]
         
         if len(video_paths) > 0:
-            warped_moving_image = nib.load(video_paths[0]).get_fdata()
-            self.update_warped_moving_image(warped_moving_image)
+            self.volume_loader.load("warped", video_paths[0])
             
             self.controller.add_warped_moving_images(video_paths)
 
@@ -415,26 +480,88 @@ class PreviewWindow(QMainWindow):
         self.warped_moving_image_channel_combobox.setCurrentIndex(len(self.controller.warped_moving_image_paths)-1)
         self.warped_moving_image_channel = len(self.controller.warped_moving_image_paths)-1
 
-    def show_warped_moving_image(self):
+    def load_warped_moving_image(self, path):
+        if path in self.on_demand_channels:
+            moving_image_path, self.on_demand_transformer = self.on_demand_channels[path]
+
+            # only the moving channel is loaded; its slices are warped as they're shown
+            self.volume_loader.cancel("warped")
+            self.volume_loader.load("unwarped", moving_image_path)
+        else:
+            self.volume_loader.cancel("unwarped")
+            self.volume_loader.load("warped", path)
+
+    def add_on_demand_channels(self, controller):
+        # the controller the registration ran on, which has its workspace and inputs
         try:
-            warped_moving_image = nib.load(self.controller.warped_moving_image_paths[self.warped_moving_image_channel]).get_fdata()
-            self.update_warped_moving_image(warped_moving_image)
-        except:
-            self.warped_moving_image_item.setImage(None)
+            transform_paths = [ controller.input_image_path(path) for path in controller.transform_paths() ]
+            transformer     = SliceTransformer(controller.input_image_path(controller.fixed_image_path), transform_paths)
+        except (OSError, ValueError) as e:
+            self.statusBar().showMessage("Could not read the transforms: {}".format(e))
+            return
+
+        for i, path in enumerate(controller.moving_image_paths):
+            # antsRegistration already wrote the registration channel, which is listed as a file
+            if i == controller.registration_channel:
+                continue
+
+            # a label rather than a file, since nothing is written for these channels
+            name = "{} (warped on demand)".format(controller.workspace.warped_image_path(path, controller.fixed_image_path))
+
+            self.on_demand_channels[name] = (path, transformer)
+
+            if name not in self.controller.warped_moving_image_paths:
+                self.controller.add_warped_moving_images([name])
+
+    def show_warped_moving_image(self):
+        if 0 <= self.warped_moving_image_channel < len(self.controller.warped_moving_image_paths):
+            self.load_warped_moving_image(self.controller.warped_moving_image_paths[self.warped_moving_image_channel])
+        else:
+            self.clear_warped_moving_image()
 
     def update_moving_image_channel(self, i):
         if i >= 0:
-            self.moving_image_channel = i
-            moving_image = nib.load(self.controller.moving_image_paths[self.moving_image_channel]).get_fdata()
-            self.update_moving_image(moving_image)
+            with self.frame_timer.frame("moving_image_channel"):
+                self.moving_image_channel = i
+                self.volume_loader.load("moving", self.controller.moving_image_paths[self.moving_image_channel])
 
-            self.registration_channel_checkbox.setChecked(i == self.controller.registration_channel)
+                self.registration_channel_checkbox.setChecked(i == self.controller.registration_channel)
 
     def update_warped_moving_image_channel(self, i):
         if i >= 0 and self.warped_moving_image is not None:
-            self.warped_moving_image_channel = i
-            warped_moving_image = nib.load(self.controller.warped_moving_image_paths[self.warped_moving_image_channel]).get_fdata()
-            self.update_warped_moving_image(warped_moving_image)
+            with self.frame_timer.frame("warped_moving_image_channel"):
+                self.warped_moving_image_channel = i
+                self.load_warped_moving_image(self.controller.warped_moving_image_paths[self.warped_moving_image_channel])
+
+    def volume_load_progress(self, target, fraction):
+        self.volume_load_progress_bar.setMaximum(1000)
+        self.volume_load_progress_bar.setValue(int(fraction*1000))
+        self.volume_load_progress_bar.setVisible(True)
+
+        self.statusBar().showMessage("Loading {} image...".format(target))
+
+    def volume_loaded(self, target, volume):
+        self.volume_load_progress_bar.setVisible(self.volume_loader.is_loading())
+
+        if target == "fixed":
+            self.update_fixed_image(volume)
+        elif target == "moving":
+            self.update_moving_image(volume)
+        elif target == "warped":
+            self.update_warped_moving_image(volume)
+        elif target == "unwarped":
+            self.update_warped_moving_image(WarpedVolume(volume, self.on_demand_transformer))
+
+        if not self.volume_loader.is_loading():
+            self.statusBar().clearMessage()
+
+    def volume_load_failed(self, target, message):
+        self.volume_load_progress_bar.setVisible(self.volume_loader.is_loading())
+
+        if target in ("warped", "unwarped"):
+            self.clear_warped_moving_image()
+
+        self.statusBar().showMessage("Could not load {} image: {}".format(target, message))
 
     def delete_moving_image(self):
         self.controller.remove_moving_image(self.moving_image_channel)
@@ -454,6 +581,9 @@ class PreviewWindow(QMainWindow):
         self.update_shell_command()
 
     def delete_warped_moving_image(self):
+        if 0 <= self.warped_moving_image_channel < len(self.controller.warped_moving_image_paths):
+            self.on_demand_channels.pop(self.controller.warped_moving_image_paths[self.warped_moving_image_channel], None)
+
         self.controller.remove_warped_moving_image(self.warped_moving_image_channel)
         
         self.warped_moving_image_channel_combobox.removeItem(self.warped_moving_image_channel)
@@ -463,7 +593,12 @@ class PreviewWindow(QMainWindow):
         if len(self.controller.warped_moving_image_paths) > 0:
             self.update_warped_moving_image_channel(self.warped_moving_image_channel)
         else:
-            self.warped_moving_image_item.setImage(None)
+            self.clear_warped_moving_image()
+
+    def toggle_warp_on_demand(self):
+        self.controller.warp_on_demand = self.warp_on_demand_checkbox.isChecked()
+
+        self.update_shell_command()
 
     def toggle_registration_channel(self):
         use_channel_for_registration = self.registration_channel_checkbox.isChecked()
@@ -511,15 +646,283 @@ class PreviewWindow(QMainWindow):
 
     def update_shell_command(self):
         self.controller.create_shell_command()
-        self.shell_command_window.set_shell_command(self.controller.shell_command)
+
+        if self.controller.pipeline_error is not None:
+            self.shell_command_window.set_shell_command("Invalid parameters: {}".format(self.controller.pipeline_error))
+        else:
+            self.shell_command_window.set_shell_command(self.controller.shell_command)
 
     def show_shell_command(self):
         self.shell_command_window.show()
 
+    def show_convergence(self):
+        self.convergence_window.show()
+
+    def get_queue_window(self):
+        # the window schedules the queue while it exists, so it's only created once the queue is
+        # used; otherwise every open app would start jobs
+        if self.queue_window is None:
+            self.queue_window = QueueWindow(self, Scheduler(JobStore()))
+
+        return self.queue_window
+
+    def show_queue(self):
+        self.get_queue_window().refresh()
+        self.queue_window.show()
+
+    def add_to_queue(self):
+        self.update_shell_command()
+
+        if self.controller.pipeline_error is not None:
+            QMessageBox.warning(self, "Invalid parameters", self.controller.pipeline_error)
+            return
+
+        if self.controller.shell_command == "":
+            return
+
+        queue_window = self.get_queue_window()
+
+        id = queue_window.scheduler.submit(self.controller.fixed_image_path, list(self.controller.moving_image_paths), params=self.controller.get_params(), registration_channel=self.controller.registration_channel,
+                                           workspace_root=self.controller.workspace_root, num_threads=self.controller.num_threads, apply_options=self.controller.get_apply_options())
+
+        queue_window.poll()
+
+        self.statusBar().showMessage("Added job {} to the queue.".format(id))
+
     def update_overlay_alpha(self):
-        self.overlay_alpha = self.overlay_alpha_slider.sliderPosition()/100.0
+        with self.frame_timer.frame("overlay_alpha"):
+            self.overlay_alpha = self.overlay_alpha_slider.sliderPosition()/100.0
+
+            self.update_warped_moving_image_z()
+
+    def toggle_frame_time_overlay(self):
+        self.frame_time_label.setVisible(not self.frame_time_label.isVisible())
+
+    def update_frame_time_overlay(self, name, frame_time):
+        if not self.frame_time_label.isVisible():
+            return
+
+        lines = []
+        for frame_name in sorted(self.frame_timer.frame_times):
+            p50, p95, p99 = self.frame_timer.percentiles(frame_name)
+            lines.append("{:<28} p50 {:6.1f} ms  p95 {:6.1f} ms  p99 {:6.1f} ms".format(frame_name, p50*1000, p95*1000, p99*1000))
+
+        lines.append("last: {} {:.1f} ms".format(name, frame_time*1000))
+
+        self.frame_time_label.setText("\n".join(lines))
+        self.frame_time_label.adjustSize()
+
+    def register(self):
+        if self.registration_thread is not None and self.registration_thread.isRunning():
+            return
+
+        self.update_shell_command()
+
+        if self.controller.pipeline_error is not None:
+            QMessageBox.warning(self, "Invalid parameters", self.controller.pipeline_error)
+            return
+
+        if self.controller.shell_command == "":
+            return
+
+        self.register_button.setEnabled(False)
+        self.register_button.setText("Registering...")
+        self.preview_register_button.setEnabled(False)
+
+        self.convergence_window.clear()
+
+        # the thread runs on a copy, so parameters edited while it runs apply to the next run
+        self.registration_thread = RegistrationThread(self.controller.snapshot())
+        self.registration_thread.progress.connect(self.registration_progress)
+        self.registration_thread.telemetry.connect(self.convergence_window.add_record)
+        self.registration_thread.succeeded.connect(self.registration_succeeded)
+        self.registration_thread.failed.connect(self.registration_failed)
+        self.registration_thread.start()
+
+    def preview_register(self):
+        if self.registration_thread is not None and self.registration_thread.isRunning():
+            return
+
+        self.update_shell_command()
+
+        if self.controller.pipeline_error is not None:
+            QMessageBox.warning(self, "Invalid parameters", self.controller.pipeline_error)
+            return
+
+        if self.controller.shell_command == "":
+            return
+
+        self.register_button.setEnabled(False)
+        self.preview_register_button.setEnabled(False)
+        self.preview_register_button.setText("Previewing...")
+
+        self.convergence_window.clear()
+
+        self.registration_thread = PreviewRegistrationThread(self.controller.snapshot())
+        self.registration_thread.progress.connect(self.registration_progress)
+        self.registration_thread.telemetry.connect(self.convergence_window.add_record)
+        self.registration_thread.succeeded.connect(self.preview_registration_succeeded)
+        self.registration_thread.failed.connect(self.registration_failed)
+        self.registration_thread.start()
+
+    def preview_registration_succeeded(self, warped_moving_image_path):
+        self.register_button.setEnabled(True)
+        self.preview_register_button.setEnabled(True)
+        self.preview_register_button.setText("Quick Preview")
+        self.statusBar().showMessage("Preview registration finished.")
+
+        self.controller.staged_image_paths.update(self.registration_thread.controller.staged_image_paths)
+        self.controller.add_warped_moving_images([warped_moving_image_path])
+
+        self.update_warped_moving_image_combobox()
+        self.show_warped_moving_image()
+
+    def registration_progress(self, line):
+        print(line, end='')
+
+        self.statusBar().showMessage(line.strip())
+
+    def registration_succeeded(self, apply_transforms_results):
+        self.register_button.setEnabled(True)
+        self.register_button.setText("Register")
+        self.preview_register_button.setEnabled(True)
+        self.statusBar().showMessage("Registration finished.")
+
+        registered_controller = self.registration_thread.controller
+
+        self.controller.warped_moving_image_paths = list(registered_controller.warped_moving_image_paths)
+        self.controller.peak_memory               = registered_controller.peak_memory
+        self.controller.staged_image_paths.update(registered_controller.staged_image_paths)
+
+        # the next run gets a fresh workspace
+        self.controller.job_id = None
+        self.update_shell_command()
+
+        if registered_controller.warp_on_demand:
+            self.add_on_demand_channels(registered_controller)
+
+        self.update_warped_moving_image_combobox()
+        self.show_warped_moving_image()
+
+        failed_channels = sorted([ i for i in apply_transforms_results if apply_transforms_results[i] != 0 ])
+
+        if len(failed_channels) > 0:
+            QMessageBox.warning(self, "Applying transforms failed", "Could not apply transforms to channel(s) {}.".format(", ".join([ str(i) for i in failed_channels ])))
+
+    def registration_failed(self, message):
+        self.controller.staged_image_paths.update(self.registration_thread.controller.staged_image_paths)
+
+        self.register_button.setEnabled(True)
+        self.register_button.setText("Register")
+        self.preview_register_button.setEnabled(True)
+        self.preview_register_button.setText("Quick Preview")
+        self.statusBar().showMessage("Registration failed.")
+
+        QMessageBox.warning(self, "Registration failed", message)
+
+    def closeEvent(self, event):
+        self.volume_loader.shutdown()
+
+        QMainWindow.closeEvent(self, event)
+
+def render_slice(volume, z):
+    return volume.get_display_slice(z)
+
+class VolumeLoader(QObject):
+    progress = pyqtSignal(str, float)
+    loaded   = pyqtSignal(str, object)
+    failed   = pyqtSignal(str, str)
+
+    # emitted from the worker threads, and delivered on the UI thread
+    finished = pyqtSignal(str, object, object, str)
+
+    def __init__(self, volume_cache, max_workers=2):
+        QObject.__init__(self)
+
+        self.volume_cache = volume_cache
+        self.executor     = ThreadPoolExecutor(max_workers=max_workers)
+
+        # the pending load of each view, as (path, cancellation event)
+        self.requests = {}
+
+        self.finished.connect(self.finish)
+
+    def load(self, target, path):
+        # a newer load for the same view replaces the pending one
+        self.cancel(target)
+
+        volume = self.volume_cache.get(path)
+
+        if volume is not None:
+            self.loaded.emit(target, volume)
+            return
+
+        cancelled = threading.Event()
 
-        self.update_warped_moving_image_z()
+        self.requests[target] = (path, cancelled)
+        self.executor.submit(self.run, target, path, cancelled)
+
+    def run(self, target, path, cancelled):
+        # staging reports bytes and loading reports slices, so pass on the fraction done
+        def report_progress(num_loaded, total):
+            if not cancelled.is_set():
+                self.progress.emit(target, num_loaded/max(total, 1))
+
+        try:
+            volume = self.volume_cache.load(path, progress_callback=report_progress, cancelled=cancelled.is_set)
+        except VolumeLoadCancelled:
+            pass
+        except Exception as e:
+            self.finished.emit(target, cancelled, None, str(e))
+        else:
+            self.finished.emit(target, cancelled, volume, "")
+
+    def finish(self, target, cancelled, volume, message):
+        # drop loads that were replaced while they were finishing
+        if target not in self.requests or self.requests[target][1] is not cancelled:
+            return
+
+        del self.requests[target]
+
+        if volume is not None:
+            self.loaded.emit(target, volume)
+        else:
+            self.failed.emit(target, message)
+
+    def cancel(self, target):
+        if target in self.requests:
+            self.requests.pop(target)[1].set()
+
+    def is_loading(self, target=None):
+        if target is None:
+            return len(self.requests) > 0
+
+        return target in self.requests
+
+    def shutdown(self):
+        for target in list(self.requests):
+            self.cancel(target)
+
+        self.executor.shutdown(wait=False)
+
+class RegistrationThread(QThread):
+    progress  = pyqtSignal(str)
+    telemetry = pyqtSignal(object)
+    succeeded = pyqtSignal(dict)
+    failed    = pyqtSignal(str)
+
+    def __init__(self, controller):
+        QThread.__init__(self)
+
+        self.controller = controller
+
+    def run(self):
+        try:
+            apply_transforms_results = self.controller.register(progress_callback=self.progress.emit, telemetry_callback=self.telemetry.emit)
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.succeeded.emit(apply_transforms_results)
 
 class ShellCommandWindow(QMainWindow):
     def __init__(self):
@@ -545,6 +948,209 @@ class ShellCommandWindow(QMainWindow):
     def set_shell_command(self, shell_command):
         self.shell_command_text.setPlainText(shell_command)
 
+class QueueWindow(QMainWindow):
+    columns = [("id", "ID"), ("status", "Status"), ("priority", "Priority"), ("attempts", "Attempts"), ("fixed", "Fixed Image"), ("moving", "Moving Image(s)"), ("memory", "Memory (Predicted/Peak)"), ("job_id", "Job ID"), ("progress", "Progress"), ("worker", "Worker"), ("error", "Error")]
+
+    def __init__(self, preview_window, scheduler):
+        QMainWindow.__init__(self)
+
+        self.setWindowTitle("Queue")
+
+        self.preview_window = preview_window
+        self.scheduler      = scheduler
+
+        # Create main widget
+        self.main_widget = QWidget(self)
+        self.resize(900, 400)
+
+        # Create main layout
+        self.main_layout = QVBoxLayout(self.main_widget)
+        self.main_layout.setContentsMargins(0, 0, 0, 0)
+        self.main_layout.setSpacing(0)
+
+        self.job_table = QTableWidget(0, len(self.columns))
+        self.job_table.setHorizontalHeaderLabels([ label for name, label in self.columns ])
+        self.job_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.job_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.job_table.horizontalHeader().setStretchLastSection(True)
+        self.main_layout.addWidget(self.job_table)
+
+        widget = QWidget(self)
+        layout = QHBoxLayout(widget)
+        self.raise_priority_button = QPushButton("Raise Priority")
+        self.raise_priority_button.clicked.connect(lambda: self.change_priority(1))
+        layout.addWidget(self.raise_priority_button)
+        self.lower_priority_button = QPushButton("Lower Priority")
+        self.lower_priority_button.clicked.connect(lambda: self.change_priority(-1))
+        layout.addWidget(self.lower_priority_button)
+        layout.addStretch()
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel_jobs)
+        layout.addWidget(self.cancel_button)
+        self.retry_button = QPushButton("Retry")
+        self.retry_button.clicked.connect(self.retry_jobs)
+        layout.addWidget(self.retry_button)
+        self.remove_finished_button = QPushButton("Clear Finished")
+        self.remove_finished_button.clicked.connect(self.remove_finished_jobs)
+        layout.addWidget(self.remove_finished_button)
+        layout.addStretch()
+        self.run_jobs_checkbox = QCheckBox("Run Jobs")
+        self.run_jobs_checkbox.setChecked(True)
+        self.run_jobs_checkbox.setToolTip("Start queued jobs from this app; turn off when another app or queue run schedules this queue.")
+        layout.addWidget(self.run_jobs_checkbox)
+        self.open_result_button = QPushButton("Open Result")
+        self.open_result_button.clicked.connect(self.open_result)
+        layout.addWidget(self.open_result_button)
+        self.main_layout.addWidget(widget)
+
+        self.setCentralWidget(self.main_widget)
+
+        # jobs run in processes of their own, so polling picks up jobs that were still
+        # running when the app last closed
+        self.poll_timer = QTimer(self)
+        self.poll_timer.timeout.connect(self.poll)
+        self.poll_timer.start(1000)
+
+    def poll(self):
+        try:
+            if self.run_jobs_checkbox.isChecked():
+                self.scheduler.poll()
+        except Exception as e:
+            self.preview_window.statusBar().showMessage("Could not update the queue: {}".format(e))
+            return
+
+        if self.isVisible():
+            self.refresh()
+
+    def refresh(self):
+        selected_ids = self.selected_ids()
+
+        jobs = self.scheduler.store.list()
+
+        self.job_table.setRowCount(len(jobs))
+
+        for i in range(len(jobs)):
+            job = jobs[i]
+
+            values = dict(job)
+            values["fixed"]    = os.path.basename(job["fixed"])
+            values["moving"]   = ", ".join([ os.path.basename(path) for path in job["moving"] ])
+            values["memory"]   = "{} / {}".format(*[ "{:.1f} GB".format(num_bytes/1024**3) if num_bytes is not None else "-" for num_bytes in (job["predicted_memory"], job["peak_memory"]) ])
+            values["progress"] = progress_summary(job["progress"])
+            values["worker"]   = job["worker"] if job["worker"] is not None else ""
+            values["error"]    = job["error"].strip().splitlines()[-1] if job["error"] and job["error"].strip() else ""
+
+            for j in range(len(self.columns)):
+                self.job_table.setItem(i, j, QTableWidgetItem(str(values[self.columns[j][0]])))
+
+            if job["id"] in selected_ids:
+                self.job_table.selectRow(i)
+
+    def selected_ids(self):
+        return sorted(set([ int(self.job_table.item(index.row(), 0).text()) for index in self.job_table.selectionModel().selectedRows() ]))
+
+    def change_priority(self, change):
+        for id in self.selected_ids():
+            self.scheduler.store.set_priority(id, self.scheduler.store.get(id)["priority"] + change)
+
+        self.refresh()
+
+    def cancel_jobs(self):
+        for id in self.selected_ids():
+            self.scheduler.cancel(id)
+
+        self.refresh()
+
+    def retry_jobs(self):
+        for id in self.selected_ids():
+            self.scheduler.store.retry(id)
+
+        self.poll()
+        self.refresh()
+
+    def remove_finished_jobs(self):
+        self.scheduler.store.remove_finished()
+
+        self.refresh()
+
+    def open_result(self):
+        controller = self.preview_window.controller
+
+        for id in self.selected_ids():
+            job = self.scheduler.store.get(id)
+
+            if job["warped_moving_image_paths"]:
+                controller.add_warped_moving_images([ path for path in job["warped_moving_image_paths"] if path not in controller.warped_moving_image_paths ])
+
+            # like after pressing Register, the other channels are resampled as they're shown
+            if job["status"] in ("finished", "partial") and job["apply_options"] is not None and job["apply_options"].get("warp_on_demand"):
+                self.preview_window.add_on_demand_channels(job_controller(job))
+
+        self.preview_window.update_warped_moving_image_combobox()
+        self.preview_window.show_warped_moving_image()
+
+class PreviewRegistrationThread(QThread):
+    progress  = pyqtSignal(str)
+    telemetry = pyqtSignal(object)
+    succeeded = pyqtSignal(str)
+    failed    = pyqtSignal(str)
+
+    def __init__(self, controller):
+        QThread.__init__(self)
+
+        self.controller = controller
+
+    def run(self):
+        try:
+            warped_moving_image_path = register_preview(self.controller, progress_callback=self.progress.emit, telemetry_callback=self.telemetry.emit)
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.succeeded.emit(warped_moving_image_path)
+
+class ConvergenceWindow(QMainWindow):
+    def __init__(self):
+        QMainWindow.__init__(self)
+
+        self.setWindowTitle("Convergence")
+        self.resize(700, 400)
+
+        self.plot_widget = pg.PlotWidget()
+        self.plot_widget.setLabel('left', "Metric value")
+        self.plot_widget.setLabel('bottom', "Iteration")
+        self.plot_widget.addLegend()
+        self.setCentralWidget(self.plot_widget)
+
+        self.clear()
+
+    def clear(self):
+        self.plot_widget.clear()
+
+        self.curves     = {}
+        self.iterations = {}
+        self.values     = {}
+
+        self.num_iterations = 0
+
+    def add_record(self, record):
+        key = (record.stage, record.level)
+
+        if key not in self.curves:
+            name = "{} level {}".format(record.stage, record.level)
+            self.curves[key]     = self.plot_widget.plot(pen=pg.intColor(len(self.curves), hues=9), name=name)
+            self.iterations[key] = []
+            self.values[key]     = []
+
+        # plot all stages and levels along one running iteration axis
+        self.num_iterations += 1
+
+        self.iterations[key].append(self.num_iterations)
+        self.values[key].append(record.metric_value)
+
+        self.curves[key].setData(self.iterations[key], self.values[key])
+
+        self.statusBar().showMessage("{} level {}, iteration {}: metric {:.6g}, convergence {:.3g}, {:.3g} s/iteration".format(record.stage, record.level, record.iteration, record.metric_value, record.convergence_value, record.iteration_time))
+
 class ParamWindow(QMainWindow):
     def __init__(self, preview_window, controller):
         QMainWindow.__init__(self)
@@ -581,6 +1187,26 @@ class ParamWindow(QMainWindow):
         self.main_layout.setContentsMargins(0, 0, 0, 0)
         self.main_layout.setSpacing(0)
 
+        widget = QWidget(self)
+        layout = QHBoxLayout(widget)
+        label = QLabel("Preset: ")
+        layout.addWidget(label)
+        self.preset_combobox = QComboBox()
+        self.preset_combobox.addItems(sorted(builtin_presets))
+        self.preset_combobox.setCurrentText("balanced")
+        layout.addWidget(self.preset_combobox)
+        self.apply_preset_button = QPushButton("Apply")
+        self.apply_preset_button.clicked.connect(self.apply_builtin_preset)
+        layout.addWidget(self.apply_preset_button)
+        layout.addStretch()
+        self.load_preset_button = QPushButton("Load Preset...")
+        self.load_preset_button.clicked.connect(self.load_preset)
+        layout.addWidget(self.load_preset_button)
+        self.save_preset_button = QPushButton("Save Preset...")
+        self.save_preset_button.clicked.connect(self.save_preset)
+        layout.addWidget(self.save_preset_button)
+        self.main_layout.addWidget(widget)
+
         main_form_widget = QWidget(self)
         self.main_form_layout = QFormLayout(main_form_widget)
         self.main_layout.addWidget(main_form_widget)
@@ -715,6 +1341,44 @@ class ParamWindow(QMainWindow):
         self.update_form_layout(self.syn_metric_form_layout)
         self.update_form_layout(self.syn_form_layout)
 
+    def apply_builtin_preset(self):
+        self.apply_preset(get_preset(self.preset_combobox.currentText()))
+
+    def load_preset(self):
+        path = QFileDialog.getOpenFileName(self, 'Load preset.', '', 'Preset Files (*.json *.yaml *.yml)')[0]
+
+        if path != "":
+            try:
+                preset = get_preset(path)
+            except Exception as e:
+                QMessageBox.warning(self, "Could not load preset", str(e))
+            else:
+                self.apply_preset(preset)
+
+    def save_preset(self):
+        path = QFileDialog.getSaveFileName(self, 'Save preset.', '', 'Preset Files (*.json *.yaml *.yml)')[0]
+
+        if path != "":
+            preset = create_preset(os.path.splitext(os.path.basename(path))[0], self.controller.get_params())
+
+            try:
+                save_preset(preset, path)
+            except Exception as e:
+                QMessageBox.warning(self, "Could not save preset", str(e))
+
+    def apply_preset(self, preset):
+        self.controller.set_params(preset["params"])
+
+        self.preview_window.translation_checkbox.setChecked(self.controller.params["translation"])
+        self.preview_window.rigid_checkbox.setChecked(self.controller.params["rigid"])
+        self.preview_window.affine_checkbox.setChecked(self.controller.params["affine"])
+        self.preview_window.syn_checkbox.setChecked(self.controller.params["syn"])
+
+        self.update_widgets()
+
+        self.preview_window.update_shell_command()
+        self.preview_window.statusBar().showMessage("Applied preset {} ({}).".format(preset["name"], preset["hash"]))
+
     def update_widgets(self):
         self.translation_checkbox.setChecked(self.preview_window.translation_checkbox.isChecked())
         self.translation_group_box.setEnabled(self.translation_checkbox.isChecked())
@@ -757,11 +1421,24 @@ class ParamWindow(QMainWindow):
 
         widget_dictionary[name] = combobox
 
+    def add_checkbox_param(self, name, label, form_layout, widget_dictionary, param_dictionary):
+        checkbox = QCheckBox()
+        checkbox.setChecked(param_dictionary[name])
+        checkbox.clicked.connect(lambda:self.update_checkbox_param(name, widget_dictionary, param_dictionary))
+        form_layout.addRow("{}: ".format(label), checkbox)
+
+        widget_dictionary[name] = checkbox
+
     def update_text_param(self, name, widget_dictionary, param_dictionary):
         param_dictionary[name] = widget_dictionary[name].text()
 
         self.preview_window.update_shell_command()
 
+    def update_checkbox_param(self, name, widget_dictionary, param_dictionary):
+        param_dictionary[name] = widget_dictionary[name].isChecked()
+
+        self.preview_window.update_shell_command()
+
     def update_combobox_param(self, name, widget_dictionary, param_dictionary, form_layout, form_layout_to_update=None):
         param_dictionary[name] = widget_dictionary[name].currentText()
 
@@ -776,6 +1453,7 @@ class ParamWindow(QMainWindow):
 
             self.add_text_param("prefix", "Transform prefix", self.main_form_layout, self.main_param_widgets, self.controller.params)
             self.add_combobox_param("initial_moving_transform", "Initial moving transform", self.main_form_layout, self.main_param_widgets, self.controller.params, ["Geometric Center", "Image Intensities", "Image Origins"])
+            self.add_checkbox_param("adaptive_iterations", "Adapt iterations to earlier runs", self.main_form_layout, self.main_param_widgets, self.controller.params)
         elif form_layout is self.translation_form_layout:
             self.clear_layout(self.translation_form_layout)
 
@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import nibabel as nib
+
+# render without a display unless the caller asked for a real platform
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtWidgets import QApplication
+
+from controller import Controller
+from volume import Volume
+from gui import PreviewWindow
+from benchmark import current_commit
+
+scenario_names = ["fixed_scrub", "fixed_jump", "moving_scrub", "warped_scrub", "overlay_alpha", "moving_channel", "warped_channel"]
+
+def create_synthetic_volume(path, shape, seed):
+    rng = np.random.RandomState(seed)
+
+    # a smooth gradient with some structure and noise, so the intensity windows aren't degenerate
+    x, y = np.meshgrid(np.linspace(0, 1, shape[0]), np.linspace(0, 1, shape[1]), indexing="ij")
+    image = np.empty(shape, dtype=np.uint16)
+
+    for z in range(shape[2]):
+        pattern = 1000*(1 + np.sin(8*np.pi*(x + seed*0.1))*np.cos(6*np.pi*(y + z/shape[2])))
+        image[:, :, z] = np.clip(pattern + rng.normal(0, 100, size=shape[:2]), 0, 65535)
+
+    nib.save(nib.Nifti1Image(image, np.eye(4)), path)
+
+def create_synthetic_images(directory, shape, num_channels):
+    fixed_image_path = os.path.join(directory, "fixed.nii")
+    create_synthetic_volume(fixed_image_path, shape, 0)
+
+    moving_image_paths = []
+    for i in range(num_channels):
+        moving_image_paths.append(os.path.join(directory, "moving_{}.nii".format(i)))
+        create_synthetic_volume(moving_image_paths[-1], shape, i + 1)
+
+    return fixed_image_path, moving_image_paths
+
+def load_images(window, fixed_image_path, moving_image_paths):
+    # the same steps as the select_*_image handlers, without the file dialogs
+    window.update_fixed_image(Volume(fixed_image_path))
+    window.controller.fixed_image_path = fixed_image_path
+
+    window.update_moving_image(Volume(moving_image_paths[0]))
+    window.controller.add_moving_images(moving_image_paths)
+    window.moving_image_channel_combobox.addItems(moving_image_paths)
+    window.moving_image_channel_combobox.setCurrentIndex(0)
+    window.moving_image_channel = 0
+
+    # the moving images have the fixed image's shape, so they stand in for warped images
+    window.update_warped_moving_image(Volume(moving_image_paths[0]))
+    window.controller.add_warped_moving_images(moving_image_paths)
+    window.warped_moving_image_channel_combobox.addItems(moving_image_paths)
+    window.warped_moving_image_channel_combobox.setCurrentIndex(0)
+    window.warped_moving_image_channel = 0
+
+def wait_for_loads(app, window):
+    # channel switches load volumes in the background, so a frame lasts until they're shown
+    while window.volume_loader.is_loading():
+        app.processEvents()
+        time.sleep(0.001)
+
+def sweep(num_positions, num_frames):
+    # back and forth over the whole range, like dragging a slider
+    period = max(1, 2*(num_positions - 1))
+
+    return [ min(i % period, period - i % period) for i in range(num_frames) ]
+
+def slider_frames(slider, handler, positions):
+    def frame(position):
+        slider.setSliderPosition(position)
+        handler()
+
+    return [ (lambda position=position: frame(position)) for position in positions ]
+
+def scenario_frames(window, name, num_frames, seed=0):
+    depth        = window.fixed_image.depth
+    num_channels = len(window.controller.moving_image_paths)
+
+    if name == "fixed_scrub":
+        return slider_frames(window.fixed_image_z_slider, window.update_fixed_image_z, sweep(depth, num_frames))
+    elif name == "fixed_jump":
+        return slider_frames(window.fixed_image_z_slider, window.update_fixed_image_z, np.random.RandomState(seed).randint(0, depth, size=num_frames).tolist())
+    elif name == "moving_scrub":
+        return slider_frames(window.moving_image_z_slider, window.update_moving_image_z, sweep(window.moving_image.depth, num_frames))
+    elif name == "warped_scrub":
+        return slider_frames(window.warped_moving_image_z_slider, window.update_warped_moving_image_z, sweep(depth, num_frames))
+    elif name == "overlay_alpha":
+        return slider_frames(window.overlay_alpha_slider, window.update_overlay_alpha, sweep(101, num_frames))
+    elif name == "moving_channel":
+        return [ (lambda i=i: window.update_moving_image_channel((i + 1) % num_channels)) for i in range(num_frames) ]
+    elif name == "warped_channel":
+        return [ (lambda i=i: window.update_warped_moving_image_channel((i + 1) % num_channels)) for i in range(num_frames) ]
+
+    raise ValueError("Unknown scenario \"{}\".".format(name))
+
+def run_frames(app, window, frames, trace_allocations=False):
+    frame_times     = []
+    allocated_bytes = []
+    retained_bytes  = []
+
+    for frame in frames:
+        if trace_allocations:
+            tracemalloc.reset_peak()
+            current_bytes = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+
+        frame()
+
+        # let Qt repaint, so the frame time includes what the user waits for
+        wait_for_loads(app, window)
+        app.processEvents()
+
+        frame_times.append(time.perf_counter() - start)
+
+        if trace_allocations:
+            new_bytes, peak_bytes = tracemalloc.get_traced_memory()
+
+            allocated_bytes.append(peak_bytes - current_bytes)
+            retained_bytes.append(new_bytes - current_bytes)
+
+    return np.array(frame_times), np.array(allocated_bytes), np.array(retained_bytes)
+
+def run_scenario(app, window, name, num_frames, warmup_frames=0, trace_allocations=True):
+    run_frames(app, window, scenario_frames(window, name, warmup_frames))
+
+    window.frame_timer.clear()
+
+    frame_times   = run_frames(app, window, scenario_frames(window, name, num_frames))[0]
+    handler_times = np.concatenate([ list(times) for times in window.frame_timer.frame_times.values() ]) if len(window.frame_timer.frame_times) > 0 else np.array([np.nan])
+
+    result = {"scenario": name, "num_frames": num_frames}
+
+    for percentile in (50, 90, 99):
+        result["p{}_ms".format(percentile)] = float(np.percentile(frame_times, percentile)*1000)
+
+    result["max_ms"]         = float(frame_times.max()*1000)
+    result["handler_p50_ms"] = float(np.percentile(handler_times, 50)*1000)
+
+    # a separate pass, since tracing allocations slows every frame down
+    if trace_allocations:
+        tracemalloc.start()
+
+        try:
+            allocated_bytes, retained_bytes = run_frames(app, window, scenario_frames(window, name, num_frames, seed=1), trace_allocations=True)[1:]
+        finally:
+            tracemalloc.stop()
+
+        result["allocated_mb_per_frame"] = float(allocated_bytes.mean()/1024**2)
+        result["retained_mb"]            = float(retained_bytes.sum()/1024**2)
+
+    return result
+
+def close_window(window):
+    for slice_cache in (window.fixed_image_slices, window.moving_image_slices, window.warped_moving_image_slices):
+        if slice_cache is not None:
+            slice_cache.close()
+
+    window.close()
+
+def print_result(result):
+    print("{:<16} p50 {:8.2f} ms  p90 {:8.2f} ms  p99 {:8.2f} ms  max {:8.2f} ms  handler p50 {:8.2f} ms  allocated {:8.2f} MB/frame".format(result["scenario"], result["p50_ms"], result["p90_ms"], result["p99_ms"], result["max_ms"],
+                                                                                                                                      result["handler_p50_ms"], result.get("allocated_mb_per_frame", float("nan"))))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure PreviewWindow frame times while scrubbing slices, changing the overlay alpha and switching channels.")
+    parser.add_argument("--shape", type=int, nargs=3, default=[512, 512, 128], help="Shape of the synthetic volumes.")
+    parser.add_argument("--channels", type=int, default=3, help="Number of moving image channels.")
+    parser.add_argument("--frames", type=int, default=200, help="Frames per scenario.")
+    parser.add_argument("--channel-frames", type=int, default=20, help="Frames for the channel switching scenarios, which load a volume every frame.")
+    parser.add_argument("--warmup", type=int, default=0, help="Frames run before each scenario and left out of the results.")
+    parser.add_argument("--scenarios", nargs="+", choices=scenario_names, default=scenario_names)
+    parser.add_argument("--no-allocations", action="store_true", help="Skip the allocation tracing pass.")
+    parser.add_argument("-o", "--output", default=None, help="JSON file the results are written to.")
+    args = parser.parse_args(argv)
+
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        fixed_image_path, moving_image_paths = create_synthetic_images(directory, tuple(args.shape), args.channels)
+
+        window = PreviewWindow(Controller())
+        load_images(window, fixed_image_path, moving_image_paths)
+        wait_for_loads(app, window)
+        app.processEvents()
+
+        try:
+            for name in args.scenarios:
+                result = run_scenario(app, window, name, args.channel_frames if name.endswith("channel") else args.frames, warmup_frames=args.warmup, trace_allocations=not args.no_allocations)
+                results.append(result)
+
+                print_result(result)
+        finally:
+            close_window(window)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"commit": current_commit(), "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "shape": args.shape, "channels": args.channels, "results": results}, f, indent=4)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
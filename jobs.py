@@ -0,0 +1,386 @@
+import os
+import sys
+import json
+import time
+import uuid
+import sqlite3
+
+from cache import default_cache_directory, params_hash
+from batch import run_job
+from controller import Controller
+from memory import available_memory, total_memory
+from executors import LocalExecutor, ProgressReporter
+from workspace import new_job_id
+
+json_columns = ["moving", "params", "warped_moving_image_paths", "failed_channels", "progress", "apply_options"]
+
+final_statuses = ["finished", "partial", "failed", "cancelled"]
+
+schema = """
+create table if not exists jobs (
+    id                        integer primary key autoincrement,
+    job_id                    text unique not null,
+    status                    text not null,
+    priority                  integer not null default 0,
+    fixed                     text not null,
+    moving                    text not null,
+    registration_channel      integer not null default 0,
+    params                    text,
+    params_hash               text,
+    workspace_root            text,
+    num_threads               integer,
+    attempts                  integer not null default 0,
+    max_attempts              integer not null default 3,
+    next_attempt_at           real not null default 0,
+    pid                       integer,
+    created_at                real not null,
+    started_at                real,
+    finished_at               real,
+    error                     text,
+    warped_moving_image_paths text,
+    failed_channels           text,
+    predicted_memory          integer,
+    peak_memory               integer,
+    worker                    text,
+    progress                  text,
+    token                     text,
+    apply_options             text
+)
+"""
+
+# columns added after the first version of the schema, for stores created before them
+added_columns = [("predicted_memory", "integer"), ("peak_memory", "integer"), ("worker", "text"), ("progress", "text"), ("token", "text"), ("apply_options", "text")]
+
+def default_store_path():
+    return os.path.join(default_cache_directory("jobs"), "jobs.sqlite3")
+
+def predict_memory(fixed, moving, params=None, registration_channel=0, num_threads=None, apply_options=None):
+    controller = Controller()
+    controller.fixed_image_path     = fixed
+    controller.registration_channel = registration_channel
+    controller.num_threads          = num_threads
+    controller.add_moving_images(list(moving))
+
+    if params is not None:
+        controller.set_params(params)
+
+    if apply_options is not None:
+        controller.set_apply_options(apply_options)
+
+    try:
+        return controller.estimate_peak_memory()
+    except (OSError, ValueError, KeyError):
+        return None
+
+def job_controller(job):
+    # a controller set up like the one that ran the job, to find its workspace and transforms
+    controller = Controller()
+    controller.fixed_image_path     = job["fixed"]
+    controller.registration_channel = job["registration_channel"]
+    controller.workspace_root       = job["workspace_root"]
+    controller.job_id               = job["job_id"]
+    controller.add_moving_images(list(job["moving"]))
+
+    if job["params"] is not None:
+        controller.set_params(job["params"])
+
+    if job["apply_options"] is not None:
+        controller.set_apply_options(job["apply_options"])
+
+    controller.create_workspace()
+
+    return controller
+
+class JobStore:
+    def __init__(self, path=None, backoff=30.0, max_backoff=600.0):
+        self.path        = path if path is not None else default_store_path()
+        self.backoff     = backoff
+        self.max_backoff = max_backoff
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        with self.connect() as connection:
+            connection.execute(schema)
+
+            columns = [ row["name"] for row in connection.execute("pragma table_info(jobs)") ]
+
+            for name, column_type in added_columns:
+                if name not in columns:
+                    connection.execute("alter table jobs add column {} {}".format(name, column_type))
+
+    def connect(self):
+        # the scheduler, the GUI and the job processes all use the store, so wait out their locks
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+
+        return connection
+
+    def row_to_job(self, row):
+        job = dict(row)
+
+        for column in json_columns:
+            if job[column] is not None:
+                job[column] = json.loads(job[column])
+
+        return job
+
+    def add(self, fixed, moving, params=None, registration_channel=0, workspace_root=None, num_threads=None, priority=0, max_attempts=3, job_id=None, predicted_memory=None, apply_options=None):
+        # the same default as Controller.get_workspace_root
+        if workspace_root is None:
+            workspace_root = os.path.join(os.path.dirname(os.path.abspath(fixed)), "registrations")
+
+        with self.connect() as connection:
+            cursor = connection.execute("insert into jobs (job_id, status, priority, fixed, moving, registration_channel, params, params_hash, workspace_root, num_threads, max_attempts, created_at, predicted_memory, apply_options) values (?, 'queued', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                        (job_id if job_id is not None else new_job_id(), priority, os.path.abspath(fixed), json.dumps([ os.path.abspath(path) for path in moving ]), registration_channel,
+                                         json.dumps(params) if params is not None else None, params_hash(params) if params is not None else None, os.path.abspath(workspace_root), num_threads, max_attempts, time.time(), predicted_memory,
+                                         json.dumps(apply_options) if apply_options is not None else None))
+
+            return cursor.lastrowid
+
+    def get(self, id):
+        with self.connect() as connection:
+            row = connection.execute("select * from jobs where id = ?", (id,)).fetchone()
+
+        return self.row_to_job(row) if row is not None else None
+
+    def list(self, statuses=None):
+        with self.connect() as connection:
+            if statuses is None:
+                rows = connection.execute("select * from jobs order by id").fetchall()
+            else:
+                rows = connection.execute("select * from jobs where status in ({}) order by id".format(", ".join([ "?" ]*len(statuses))), list(statuses)).fetchall()
+
+        return [ self.row_to_job(row) for row in rows ]
+
+    def next_queued(self, now=None):
+        now = time.time() if now is None else now
+
+        with self.connect() as connection:
+            row = connection.execute("select * from jobs where status = 'queued' and next_attempt_at <= ? order by priority desc, id limit 1", (now,)).fetchone()
+
+        return self.row_to_job(row) if row is not None else None
+
+    def start(self, id, launch):
+        # claim the job and launch it in one transaction: only one scheduler can move a queued job
+        # to running, even with several polling the same store, and a launch that raises leaves
+        # the job queued; returns whether this call started it
+        token = uuid.uuid4().hex
+
+        with self.connect() as connection:
+            cursor = connection.execute("update jobs set status = 'running', attempts = attempts + 1, token = ?, progress = null, started_at = ?, finished_at = null, error = null where id = ? and status = 'queued'", (token, time.time(), id))
+
+            if cursor.rowcount != 1:
+                return False
+
+            connection.execute("update jobs set pid = ? where id = ?", (launch(token), id))
+
+        return True
+
+    # every attempt gets a new token, and results, failures and progress are only recorded for
+    # the current one: an attempt that was given up on, eg. after its worker stopped sending
+    # heartbeats, may still be running and must not overwrite the attempt that replaced it; jobs
+    # started before tokens were added have none, which "is" matches
+
+    def finish(self, id, token, result):
+        with self.connect() as connection:
+            connection.execute("update jobs set status = ?, pid = null, progress = null, finished_at = ?, params_hash = coalesce(?, params_hash), warped_moving_image_paths = ?, failed_channels = ?, peak_memory = ?, worker = ? where id = ? and status = 'running' and token is ?",
+                               (result["status"], time.time(), result.get("params_hash"), json.dumps(result["warped_moving_image_paths"]), json.dumps(result["failed_channels"]), result.get("peak_memory"), result.get("worker"), id, token))
+
+    def fail(self, id, token, error):
+        with self.connect() as connection:
+            row = connection.execute("select attempts, max_attempts from jobs where id = ? and status = 'running' and token is ?", (id, token)).fetchone()
+
+            if row is None:
+                return
+
+            # requeue with exponential backoff until the attempts run out; a requeued job keeps
+            # its job ID, so it resumes from its last completed stage
+            if row["attempts"] < row["max_attempts"]:
+                delay = min(self.max_backoff, self.backoff*2**(row["attempts"] - 1))
+
+                connection.execute("update jobs set status = 'queued', pid = null, progress = null, next_attempt_at = ?, error = ? where id = ?", (time.time() + delay, error, id))
+            else:
+                connection.execute("update jobs set status = 'failed', pid = null, progress = null, finished_at = ?, error = ? where id = ?", (time.time(), error, id))
+
+    def set_progress(self, id, token, progress):
+        with self.connect() as connection:
+            connection.execute("update jobs set progress = ? where id = ? and status = 'running' and token is ?", (json.dumps(progress), id, token))
+
+    def cancel(self, id):
+        with self.connect() as connection:
+            row = connection.execute("select status, pid from jobs where id = ?", (id,)).fetchone()
+
+            if row is None or row["status"] in final_statuses:
+                return None
+
+            connection.execute("update jobs set status = 'cancelled', pid = null, progress = null, finished_at = ? where id = ?", (time.time(), id))
+
+        return row["pid"]
+
+    def retry(self, id):
+        with self.connect() as connection:
+            connection.execute("update jobs set status = 'queued', attempts = 0, next_attempt_at = 0, error = null, finished_at = null where id = ? and status in ('failed', 'cancelled', 'partial')", (id,))
+
+    def set_predicted_memory(self, id, predicted_memory):
+        with self.connect() as connection:
+            connection.execute("update jobs set predicted_memory = ? where id = ?", (predicted_memory, id))
+
+    def set_priority(self, id, priority):
+        with self.connect() as connection:
+            connection.execute("update jobs set priority = ? where id = ?", (priority, id))
+
+    def remove_finished(self):
+        with self.connect() as connection:
+            connection.execute("delete from jobs where status in ('finished', 'cancelled')")
+
+class Scheduler:
+    def __init__(self, store, max_jobs=1, max_threads=None, memory_budget=None, executor=None):
+        self.store       = store
+        self.executor    = executor if executor is not None else LocalExecutor(store)
+        self.max_jobs    = max_jobs
+        self.max_threads = max_threads if max_threads is not None else (os.cpu_count() or 1)
+
+        # leave some of the node's memory to the OS and the GUI
+        if memory_budget is None and total_memory() is not None:
+            memory_budget = int(0.9*total_memory())
+
+        self.memory_budget = memory_budget
+
+    def submit(self, fixed, moving, params=None, registration_channel=0, workspace_root=None, num_threads=None, priority=0, max_attempts=3, apply_options=None):
+        predicted_memory = predict_memory(fixed, moving, params=params, registration_channel=registration_channel, num_threads=num_threads if num_threads is not None else self.max_threads//self.max_jobs, apply_options=apply_options)
+
+        return self.store.add(fixed, moving, params=params, registration_channel=registration_channel, workspace_root=workspace_root, num_threads=num_threads, priority=priority, max_attempts=max_attempts, predicted_memory=predicted_memory,
+                              apply_options=apply_options)
+
+    def threads_per_job(self, job):
+        return job["num_threads"] if job["num_threads"] is not None else max(1, self.max_threads//self.max_jobs)
+
+    def check_running(self):
+        running_jobs = []
+
+        for job in self.store.list(["running"]):
+            # jobs that finished normally have already recorded their results
+            error = self.executor.check(job)
+
+            if error is not None:
+                self.store.fail(job["id"], job["token"], error)
+            else:
+                running_jobs.append(job)
+
+                progress = self.executor.progress(job)
+
+                if progress is not None:
+                    self.store.set_progress(job["id"], job["token"], progress)
+
+        return running_jobs
+
+    def record_result(self, id, result):
+        if result["status"] == "failed":
+            self.store.fail(id, result["token"], "{} (worker {})".format(result["error"].strip(), result["worker"]))
+        else:
+            self.store.finish(id, result["token"], result)
+
+    def can_start(self, job, running_jobs):
+        if len(running_jobs) >= self.max_jobs:
+            return False
+
+        # remote workers run one job at a time within their own node's resources
+        if not self.executor.is_local:
+            return True
+
+        if len(running_jobs) > 0 and sum([ self.threads_per_job(running_job) for running_job in running_jobs ]) + self.threads_per_job(job) > self.max_threads:
+            return False
+
+        # always let one job run, so a large job is delayed instead of starved
+        if len(running_jobs) == 0:
+            return True
+
+        # a job whose memory can't be predicted only runs on its own
+        predicted_memory = [ running_job["predicted_memory"] for running_job in running_jobs ] + [job["predicted_memory"]]
+
+        if None in predicted_memory:
+            return False
+
+        # running jobs may not have reached their peaks yet, so admit against the predictions
+        # rather than what is free right now, and also keep clear of memory used outside the queue
+        if self.memory_budget is not None and sum(predicted_memory) > self.memory_budget:
+            return False
+
+        free_memory = available_memory()
+
+        return free_memory is None or free_memory >= job["predicted_memory"]
+
+    def start(self, job):
+        return self.store.start(job["id"], lambda token: self.executor.start(job, self.threads_per_job(job), token))
+
+    def poll(self):
+        for id, result in self.executor.collect():
+            self.record_result(id, result)
+
+        running_jobs = self.check_running()
+
+        while True:
+            job = self.store.next_queued()
+
+            if job is None:
+                break
+
+            # predict again, since the measured peaks of the jobs before it refine the model
+            if self.executor.is_local:
+                job["predicted_memory"] = predict_memory(job["fixed"], job["moving"], params=job["params"], registration_channel=job["registration_channel"], num_threads=self.threads_per_job(job), apply_options=job["apply_options"])
+                self.store.set_predicted_memory(job["id"], job["predicted_memory"])
+
+            # jobs start in strict priority order, so a job that doesn't fit holds back the ones after it
+            if not self.can_start(job, running_jobs):
+                break
+
+            # another scheduler on the same store may have claimed it since it was read
+            if self.start(job):
+                running_jobs.append(self.store.get(job["id"]))
+
+    def cancel(self, id):
+        job = self.store.get(id)
+
+        self.store.cancel(id)
+
+        if job is not None and job["status"] == "running":
+            self.executor.cancel(job)
+
+    def is_idle(self):
+        return len(self.store.list(["queued", "running"])) == 0
+
+    def run(self, poll_interval=1.0):
+        while True:
+            self.poll()
+
+            if self.is_idle():
+                break
+
+            time.sleep(poll_interval)
+
+def progress_summary(progress):
+    if progress is None:
+        return ""
+
+    if progress.get("telemetry") is not None:
+        return "{stage} level {level} iteration {iteration}".format(**progress["telemetry"])
+
+    return progress.get("line") or ""
+
+def run_stored_job(store, id, num_threads, token):
+    job      = store.get(id)
+    reporter = ProgressReporter(lambda progress: store.set_progress(id, token, progress))
+
+    try:
+        result = run_job({"job_id": job["job_id"], "fixed": job["fixed"], "moving": job["moving"], "registration_channel": job["registration_channel"], "apply_options": job["apply_options"]}, job["workspace_root"], num_threads, params=job["params"],
+                         progress_callback=reporter.progress_callback, telemetry_callback=reporter.telemetry_callback)
+    except Exception as e:
+        result = {"status": "failed", "error": str(e)}
+
+    if result["status"] == "failed":
+        store.fail(id, token, result["error"])
+    else:
+        store.finish(id, token, result)
+
+if __name__ == "__main__":
+    run_stored_job(JobStore(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3]), sys.argv[4])
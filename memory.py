@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+import tempfile
+import subprocess
+import numpy as np
+import nibabel as nib
+
+# antsRegistration and antsApplyTransforms work in double precision unless --float is given
+bytes_per_voxel = 8
+
+# resident size of an ANTs process before it has loaded any images
+process_overhead = 150*1024**2
+
+# displacement fields SyN keeps at the working level: the fixed and moving halves of the
+# symmetric transform, their inverses, the update field and its smoothed copy, and the
+# composed field the metric is evaluated through
+syn_fields = 8
+
+# images the cross-correlation metric keeps for its local sums
+cross_correlation_images = 5
+
+# sums each thread keeps per neighbourhood voxel as it scans: the fixed and moving values,
+# their squares and their product
+cross_correlation_sums = 5
+
+def image_voxels(path):
+    shape = nib.load(path).header.get_data_shape()
+
+    return int(np.prod(shape[:3]))
+
+def working_shrink_factor(stage_params):
+    num_iterations = stage_params["num_iterations"].split("x")
+    shrink_factors = stage_params["shrink_factors"].split("x")
+
+    # levels with no iterations are skipped, so the finest level that runs sets the size
+    levels = [ i for i in range(min(len(num_iterations), len(shrink_factors))) if int(num_iterations[i]) > 0 ]
+
+    if len(levels) == 0:
+        return max([ int(shrink_factor) for shrink_factor in shrink_factors ])
+
+    return min([ int(shrink_factors[i]) for i in levels ])
+
+def neighbourhood_voxels(radius):
+    # a radius is given for all axes at once, or per axis as eg. 4x4x2
+    radii = [ int(r) for r in str(radius).split("x") ]
+
+    if len(radii) == 1:
+        radii = radii*3
+
+    return int(np.prod([ 2*r + 1 for r in radii ]))
+
+def stage_memory(name, stage_params, metric_params, fixed_voxels, moving_voxels, num_threads):
+    level_voxels = fixed_voxels/working_shrink_factor(stage_params)**3
+
+    # the inputs, plus the full resolution smoothed copy each level is shrunk from
+    memory = 2*(fixed_voxels + moving_voxels)*bytes_per_voxel
+
+    if name == "syn":
+        memory += level_voxels*3*bytes_per_voxel*syn_fields
+
+        # the forward and inverse warps are written at full resolution
+        memory += 2*fixed_voxels*3*bytes_per_voxel
+    else:
+        # the shrunk fixed and moving images, the warped moving image and its gradient
+        memory += level_voxels*bytes_per_voxel*6
+
+    if stage_params["metric"] == "Cross-Correlation":
+        memory += level_voxels*bytes_per_voxel*cross_correlation_images
+
+        # and the neighbourhood buffers of every thread, which grow with the radius cubed
+        memory += neighbourhood_voxels(metric_params["radius"])*cross_correlation_sums*bytes_per_voxel*num_threads
+    else:
+        # a joint histogram and its derivative per thread
+        memory += 2*int(metric_params["num_bins"])**2*bytes_per_voxel*num_threads
+
+    return int(memory + process_overhead)
+
+def apply_transforms_memory(fixed_voxels, moving_voxels, syn):
+    memory = (fixed_voxels + moving_voxels)*bytes_per_voxel
+
+    if syn:
+        memory += fixed_voxels*3*bytes_per_voxel
+
+    return int(memory + process_overhead)
+
+def tiled_apply_transforms_memory(max_memory, num_processes):
+    # the chunks share max_memory, which covers both their points and the moving image and
+    # field boxes they read; each pool process adds an interpreter with numpy
+    return int(max_memory + (num_processes + 1)*process_overhead)
+
+def wait_for_peak_rss(process):
+    # reap the process ourselves to get its resource usage; Popen won't wait again once
+    # its returncode is set
+    if not hasattr(os, "wait4"):
+        process.wait()
+        return None
+
+    pid, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return rusage.ru_maxrss*(1 if sys.platform == "darwin" else 1024)
+
+def run_measured(command, env=None):
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, env=env)
+
+    with process.stdout:
+        stdout = process.stdout.read()
+
+    peak_rss = wait_for_peak_rss(process)
+
+    return subprocess.CompletedProcess(process.args, process.returncode, stdout), peak_rss
+
+class MemoryHistory:
+    def __init__(self, path, history_size=10, min_correction=0.25, max_correction=4.0):
+        self.path           = path
+        self.history_size   = history_size
+        self.min_correction = min_correction
+        self.max_correction = max_correction
+
+        self.ratios = {}
+
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.ratios = json.load(f)
+            except (OSError, ValueError):
+                self.ratios = {}
+
+    def record(self, phase, estimate, peak_rss):
+        history = self.ratios.setdefault(phase, [])
+        history.append(peak_rss/estimate)
+
+        del history[:-self.history_size]
+
+    def correction(self, phase):
+        history = self.ratios.get(phase, [])
+
+        if len(history) == 0:
+            return 1.0
+
+        # the model scales with the image sizes, so a ratio measured on one size carries over to others
+        return min(self.max_correction, max(self.min_correction, float(np.median(history))))
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.ratios, f)
+
+        os.replace(temp_path, self.path)
+
+def available_memory():
+    # MemAvailable counts reclaimable page cache too; None where /proc isn't available
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+
+    return None
+
+def total_memory():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
@@ -0,0 +1,163 @@
+import shlex
+
+transform_names = {"translation": "Translation", "rigid": "Rigid", "affine": "Affine", "syn": "SyN"}
+
+metric_names = {"Cross-Correlation": "CC", "Mutual Information": "MI"}
+
+sampling_strategies = ["None", "Regular", "Random"]
+
+# antsRegistration reads smoothing sigmas in voxels unless the list ends with a unit, eg. 4x3x2x1mm
+sigma_units = ["vox", "mm"]
+
+class PipelineError(ValueError):
+    pass
+
+def check_number(text, convert, label, minimum=None, maximum=None):
+    try:
+        value = convert(text)
+    except ValueError:
+        raise PipelineError("{} should be a number, not \"{}\".".format(label, text))
+
+    if minimum is not None and value < minimum:
+        raise PipelineError("{} should be at least {}, not {}.".format(label, minimum, text))
+
+    if maximum is not None and value > maximum:
+        raise PipelineError("{} should be at most {}, not {}.".format(label, maximum, text))
+
+    return text
+
+def check_levels(text, convert, label, minimum=None):
+    return [ check_number(level, convert, label, minimum=minimum) for level in text.split("x") ]
+
+def split_sigma_units(text):
+    for units in sigma_units:
+        if text.endswith(units):
+            return text[:-len(units)], units
+
+    return text, ""
+
+class Metric:
+    def __init__(self, kind, weight, parameter, sampling_strategy, sampling_percentage):
+        self.kind                = kind
+        self.weight              = weight
+        self.parameter           = parameter
+        self.sampling_strategy   = sampling_strategy
+        self.sampling_percentage = sampling_percentage
+
+    def validate(self, label):
+        if self.kind not in metric_names:
+            raise PipelineError("{} metric \"{}\" is not one of {}.".format(label, self.kind, ", ".join(metric_names)))
+
+        if self.sampling_strategy not in sampling_strategies:
+            raise PipelineError("{} sampling strategy \"{}\" is not one of {}.".format(label, self.sampling_strategy, ", ".join(sampling_strategies)))
+
+        check_number(self.weight, float, "{} metric weight".format(label), minimum=0)
+        check_number(self.parameter, int, "{} {}".format(label, "radius" if self.kind == "Cross-Correlation" else "number of bins"), minimum=1)
+        check_number(self.sampling_percentage, float, "{} sampling percentage".format(label), minimum=0, maximum=1)
+
+    def render(self, fixed_image_path, moving_image_path):
+        # the radius for CC and the number of bins for MI share the same position
+        return "{}[{},{},{},{},{},{}]".format(metric_names[self.kind], fixed_image_path, moving_image_path, self.weight, self.parameter, self.sampling_strategy, self.sampling_percentage)
+
+class Convergence:
+    def __init__(self, num_iterations, threshold, window_size):
+        self.num_iterations = num_iterations
+        self.threshold      = threshold
+        self.window_size    = window_size
+
+    def validate(self, label):
+        check_number(self.threshold, float, "{} convergence threshold".format(label), minimum=0)
+        check_number(self.window_size, int, "{} convergence window size".format(label), minimum=1)
+
+    def render(self):
+        return "[{},{},{}]".format("x".join(self.num_iterations), self.threshold, self.window_size)
+
+class Pyramid:
+    def __init__(self, shrink_factors, smoothing_sigmas, sigma_units=""):
+        self.shrink_factors   = shrink_factors
+        self.smoothing_sigmas = smoothing_sigmas
+        self.sigma_units      = sigma_units
+
+class Stage:
+    def __init__(self, name, transform_params, metric, convergence, pyramid):
+        self.name             = name
+        self.transform_params = transform_params
+        self.metric           = metric
+        self.convergence      = convergence
+        self.pyramid          = pyramid
+
+    @property
+    def label(self):
+        return transform_names[self.name]
+
+    def validate(self):
+        for transform_param in self.transform_params:
+            check_number(transform_param, float, "{} transform parameter".format(self.label), minimum=0)
+
+        self.metric.validate(self.label)
+        self.convergence.validate(self.label)
+
+        # antsRegistration only notices a mismatch once it has loaded the images
+        num_levels = [len(self.convergence.num_iterations), len(self.pyramid.shrink_factors), len(self.pyramid.smoothing_sigmas)]
+
+        if len(set(num_levels)) > 1:
+            raise PipelineError("{} has {} iteration counts, {} shrink factors and {} smoothing sigmas; these should all have the same number of levels.".format(self.label, *num_levels))
+
+    def argv(self, fixed_image_path, moving_image_path):
+        return ["-t", "{}[{}]".format(self.label, ",".join(self.transform_params)),
+                "-m", self.metric.render(fixed_image_path, moving_image_path),
+                "-c", self.convergence.render(),
+                "-f", "x".join(self.pyramid.shrink_factors),
+                "-s", "x".join(self.pyramid.smoothing_sigmas) + self.pyramid.sigma_units]
+
+class Pipeline:
+    def __init__(self, fixed_image_path, moving_image_path, initial_moving_transform, stages):
+        self.fixed_image_path         = fixed_image_path
+        self.moving_image_path        = moving_image_path
+        self.initial_moving_transform = initial_moving_transform
+        self.stages                   = stages
+
+    def validate(self):
+        for stage in self.stages:
+            stage.validate()
+
+    def initial_transform(self):
+        return "[{},{},{}]".format(self.fixed_image_path, self.moving_image_path, self.initial_moving_transform)
+
+    def stage_argv(self, i, output, initial_transform):
+        return ["antsRegistration", "-v", "1", "-d", "3", "-o", output, "-n", "Linear", "-r", initial_transform] + self.stages[i].argv(self.fixed_image_path, self.moving_image_path)
+
+def create_stage(name, stage_params, metric_params, num_iterations=None):
+    if name == "syn":
+        transform_params = [stage_params["gradient_step"], stage_params["update_field_variance"], stage_params["total_field_variance"]]
+    else:
+        transform_params = [stage_params["gradient_step"]]
+
+    if stage_params["metric"] == "Cross-Correlation":
+        parameter = metric_params["radius"]
+    else:
+        parameter = metric_params["num_bins"]
+
+    if num_iterations is None:
+        num_iterations = stage_params["num_iterations"]
+
+    label = transform_names[name]
+
+    gaussian_sigma, sigma_units = split_sigma_units(stage_params["gaussian_sigma"])
+
+    metric      = Metric(stage_params["metric"], metric_params["metric_weight"], parameter, metric_params["sampling_strategy"], metric_params["sampling_percentage"])
+    convergence = Convergence(check_levels(num_iterations, int, "{} number of iterations".format(label), minimum=0), stage_params["convergence_threshold"], stage_params["convergence_window_size"])
+    pyramid     = Pyramid(check_levels(stage_params["shrink_factors"], int, "{} shrink factors".format(label), minimum=1), check_levels(gaussian_sigma, float, "{} Gaussian smoothing sigma".format(label), minimum=0), sigma_units)
+
+    return Stage(name, transform_params, metric, convergence, pyramid)
+
+def apply_transforms_argv(moving_image_path, fixed_image_path, transform_paths, output_path):
+    argv = ["antsApplyTransforms", "-d", "3", "-i", moving_image_path, "-r", fixed_image_path]
+
+    for transform_path in transform_paths:
+        argv += ["-t", transform_path]
+
+    return argv + ["-o", output_path]
+
+def render_command(argv):
+    return " ".join([ shlex.quote(arg) for arg in argv ])
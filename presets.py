@@ -0,0 +1,134 @@
+import os
+import json
+import copy
+
+from controller import Controller, param_names
+from cache import params_hash
+
+preset_version = 1
+
+linear_stages = ["translation", "rigid", "affine"]
+
+def default_params():
+    return Controller().get_params()
+
+def merge_params(params, overrides):
+    params = copy.deepcopy(params)
+
+    for name in overrides:
+        params[name].update(overrides[name])
+
+    return params
+
+def fast_overrides():
+    overrides = {}
+
+    # shallower pyramids that skip the finest level, and sparse metric sampling
+    for stage in linear_stages:
+        overrides["{}_params".format(stage)]                    = {"metric": "Mutual Information", "num_iterations": "100x50x25", "shrink_factors": "8x4x2", "gaussian_sigma": "3x2x1"}
+        overrides["{}_mutual_information_params".format(stage)] = {"sampling_strategy": "Regular", "sampling_percentage": "0.1"}
+
+    overrides["syn_params"]                    = {"metric": "Mutual Information", "num_iterations": "100x50x0", "shrink_factors": "8x4x2", "gaussian_sigma": "3x2x1"}
+    overrides["syn_mutual_information_params"] = {"sampling_strategy": "Regular", "sampling_percentage": "0.1"}
+
+    return overrides
+
+def accurate_overrides():
+    overrides = {}
+
+    for stage in linear_stages:
+        overrides["{}_params".format(stage)]                    = {"num_iterations": "1000x500x250x100"}
+        overrides["{}_mutual_information_params".format(stage)] = {"sampling_strategy": "Regular", "sampling_percentage": "0.5"}
+
+    overrides["syn_params"]                    = {"num_iterations": "200x200x200x200x50"}
+    overrides["syn_cross_correlation_params"]  = {"radius": "4"}
+
+    return overrides
+
+def multimodal_overrides():
+    # cross-correlation assumes matching contrast, so use mutual information throughout
+    overrides = {}
+
+    for stage in linear_stages + ["syn"]:
+        overrides["{}_params".format(stage)] = {"metric": "Mutual Information"}
+
+    return overrides
+
+builtin_presets = {
+    "balanced":   ("Default parameters.", lambda: {}),
+    "fast":       ("Shallow pyramids and sparse sampling for quick, rough registrations.", fast_overrides),
+    "accurate":   ("More iterations, denser sampling and a wider cross-correlation radius.", accurate_overrides),
+    "multimodal": ("Mutual information for every stage, for images with different contrast.", multimodal_overrides)
+}
+
+def create_preset(name, params, description=""):
+    return {"version": preset_version, "name": name, "description": description, "hash": params_hash(params), "params": params}
+
+def builtin_preset(name):
+    description, overrides = builtin_presets[name]
+
+    return create_preset(name, merge_params(default_params(), overrides()), description)
+
+def is_yaml_path(path):
+    return os.path.splitext(path)[1].lower() in (".yaml", ".yml")
+
+def save_preset(preset, path):
+    if is_yaml_path(path):
+        import yaml
+
+        with open(path, "w") as f:
+            yaml.safe_dump(preset, f, sort_keys=True)
+    else:
+        with open(path, "w") as f:
+            json.dump(preset, f, indent=4, sort_keys=True)
+
+def load_preset(path):
+    if is_yaml_path(path):
+        import yaml
+
+        with open(path) as f:
+            preset = yaml.safe_load(f)
+    else:
+        with open(path) as f:
+            preset = json.load(f)
+
+    # a bare mapping of parameter groups is treated as an unnamed version 1 preset
+    if "params" not in preset:
+        preset = {"version": 1, "params": preset}
+
+    if preset.get("version", preset_version) > preset_version:
+        raise ValueError("Preset {} has version {}, but only versions up to {} are supported.".format(path, preset["version"], preset_version))
+
+    defaults = default_params()
+
+    for name in preset["params"]:
+        if name not in param_names:
+            raise ValueError("Preset {} has unknown parameter group \"{}\".".format(path, name))
+
+        for key in preset["params"][name]:
+            if key not in defaults[name]:
+                raise ValueError("Preset {} has unknown parameter \"{}.{}\".".format(path, name, key))
+
+    # presets may only list the parameters they change
+    params = merge_params(defaults, preset["params"])
+
+    return create_preset(preset.get("name", os.path.splitext(os.path.basename(path))[0]), params, preset.get("description", ""))
+
+def get_preset(name_or_path):
+    if name_or_path in builtin_presets:
+        return builtin_preset(name_or_path)
+
+    return load_preset(name_or_path)
+
+def diff_presets(preset_a, preset_b):
+    differences = []
+
+    for name in param_names:
+        params_a = preset_a["params"].get(name, {})
+        params_b = preset_b["params"].get(name, {})
+
+        for key in sorted(set(params_a) | set(params_b)):
+            if params_a.get(key) != params_b.get(key):
+                differences.append((name, key, params_a.get(key), params_b.get(key)))
+
+    return differences
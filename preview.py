@@ -0,0 +1,110 @@
+import os
+import math
+import numpy as np
+import nibabel as nib
+
+from controller import Controller
+from pipeline import split_sigma_units
+from volume import Volume
+from workspace import image_name
+
+def downsample_factor(shape, max_voxels):
+    num_voxels = shape[0]*shape[1]*shape[2]
+
+    return max(1, int(math.ceil((num_voxels/max_voxels)**(1.0/3.0))))
+
+def downsample_image(path, output_path, factor):
+    volume = Volume(path)
+
+    # strided sampling only reads every factor-th slice, and keeps voxel 0 where it was
+    image = np.stack([ volume.get_slice(z)[::factor, ::factor] for z in range(0, volume.depth, factor) ], axis=2)
+
+    affine = volume.image.affine.copy()
+    affine[:3, :3] *= factor
+
+    nib.save(nib.Nifti1Image(image, affine), output_path)
+
+def truncate_pyramid(stage_params, factor, max_iterations):
+    num_iterations = stage_params["num_iterations"].split("x")
+    shrink_factors = stage_params["shrink_factors"].split("x")
+    gaussian_sigma, sigma_units = split_sigma_units(stage_params["gaussian_sigma"])
+    gaussian_sigma              = gaussian_sigma.split("x")
+
+    # the images are already shrunk by the downsampling factor, so drop the levels that
+    # would be finer than that and rescale the rest to the preview's voxels
+    levels = [ i for i in range(len(shrink_factors)) if int(shrink_factors[i]) >= factor ]
+    if len(levels) == 0:
+        levels = [len(shrink_factors) - 1]
+
+    truncated_params = dict(stage_params)
+    truncated_params["num_iterations"] = "x".join([ str(min(int(num_iterations[i]), max_iterations)) for i in levels ])
+    truncated_params["shrink_factors"] = "x".join([ str(max(1, int(shrink_factors[i])//factor)) for i in levels ])
+    # sigmas in mm don't depend on the voxel size
+    if sigma_units == "mm":
+        truncated_params["gaussian_sigma"] = "x".join([ gaussian_sigma[i] for i in levels ]) + sigma_units
+    else:
+        truncated_params["gaussian_sigma"] = "x".join([ "{:g}".format(float(gaussian_sigma[i])/factor) for i in levels ]) + sigma_units
+
+    return truncated_params
+
+def create_preview_controller(controller, max_voxels, max_iterations):
+    preview_controller = Controller()
+    preview_controller.copy_params_from(controller)
+
+    preview_controller.num_threads     = controller.num_threads
+    preview_controller.workspace_root  = os.path.join(controller.get_workspace_root(), "previews")
+    preview_controller.transform_cache = None
+
+    # previews run on downsampled images with truncated pyramids, so their peaks and plateaus
+    # would skew the corrections and iteration budgets of full runs
+    preview_controller.memory_history    = None
+    preview_controller.iteration_budgets = None
+
+    preview_controller.params["adaptive_iterations"] = False
+
+    fixed_image_path  = controller.fixed_image_path
+    moving_image_path = controller.moving_image_paths[controller.registration_channel]
+
+    # read through the uncompressed copies, since downsampling reads slices all over the volumes
+    staged_fixed_image_path  = controller.stage_image(fixed_image_path)
+    staged_moving_image_path = controller.stage_image(moving_image_path)
+
+    preview_controller.staged_image_paths = {fixed_image_path: staged_fixed_image_path, moving_image_path: staged_moving_image_path}
+
+    factor = downsample_factor(Volume(staged_fixed_image_path).shape, max_voxels)
+
+    for name, stage_params, metric_params in preview_controller.get_stages():
+        stage_params.update(truncate_pyramid(stage_params, factor, max_iterations))
+
+    preview_controller.create_workspace()
+    preview_controller.workspace.create()
+
+    preview_fixed_image_path  = os.path.join(preview_controller.workspace.directory, "{}_preview.nii".format(image_name(fixed_image_path)))
+    preview_moving_image_path = os.path.join(preview_controller.workspace.directory, "{}_preview.nii".format(image_name(moving_image_path)))
+
+    downsample_image(staged_fixed_image_path, preview_fixed_image_path, factor)
+    downsample_image(staged_moving_image_path, preview_moving_image_path, downsample_factor(Volume(staged_moving_image_path).shape, max_voxels))
+
+    preview_controller.fixed_image_path = preview_fixed_image_path
+    preview_controller.add_moving_images([preview_moving_image_path])
+
+    return preview_controller
+
+def register_preview(controller, progress_callback=None, telemetry_callback=None, max_voxels=2000000, max_iterations=100):
+    preview_controller = create_preview_controller(controller, max_voxels, max_iterations)
+
+    preview_controller.register(progress_callback=progress_callback, telemetry_callback=telemetry_callback)
+
+    # the transforms are in physical space, so resample the full resolution registration
+    # channel with them to compare it against the fixed image in the preview window
+    preview_controller.fixed_image_path   = controller.fixed_image_path
+    preview_controller.moving_image_paths = [controller.moving_image_paths[controller.registration_channel]]
+
+    command = preview_controller.create_apply_transforms_command(0)
+
+    results = preview_controller.apply_transforms([(0, command)], progress_callback=progress_callback)
+
+    if results[0] != 0:
+        raise RuntimeError("Applying the preview transforms failed with exit code {}.".format(results[0]))
+
+    return preview_controller.workspace.warped_image_path(preview_controller.moving_image_paths[0], preview_controller.fixed_image_path)
@@ -0,0 +1,177 @@
+import time
+import threading
+import numpy as np
+import matplotlib
+
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+colormap_luts = {}
+
+def colormap_lut(name):
+    if name not in colormap_luts:
+        colormap = matplotlib.colormaps[name]
+
+        colormap_luts[name] = np.round(colormap(np.arange(256))[:, :3]*255.0).astype(np.uint8)
+
+    return colormap_luts[name]
+
+class SliceCache:
+    def __init__(self, render_slice, depth, max_bytes=256*1024**2, prefetch_count=4):
+        self.render_slice   = render_slice
+        self.depth          = depth
+        self.max_bytes      = max_bytes
+        self.prefetch_count = prefetch_count
+
+        self.slices    = OrderedDict()
+        self.num_bytes = 0
+        self.lock      = threading.Lock()
+
+        self.last_z    = None
+        self.direction = 1
+        self.pending   = set()
+
+        self.prefetcher = ThreadPoolExecutor(max_workers=1)
+
+    def get(self, z):
+        with self.lock:
+            image = self.slices.get(z)
+
+            if image is not None:
+                self.slices.move_to_end(z)
+
+        if image is None:
+            image = self.render_slice(z)
+            self.put(z, image)
+
+        self.prefetch(z)
+
+        return image
+
+    def put(self, z, image):
+        with self.lock:
+            if z in self.slices:
+                return
+
+            self.slices[z]  = image
+            self.num_bytes += image.nbytes
+
+            # evict least recently used slices, but always keep the newest one
+            while self.num_bytes > self.max_bytes and len(self.slices) > 1:
+                old_z, old_image = self.slices.popitem(last=False)
+                self.num_bytes  -= old_image.nbytes
+
+    def prefetch(self, z):
+        if self.last_z is not None and z != self.last_z:
+            self.direction = 1 if z > self.last_z else -1
+        self.last_z = z
+
+        # prepare the next few slices in the direction the user is scrubbing
+        for i in range(1, self.prefetch_count+1):
+            next_z = z + self.direction*i
+
+            if 0 <= next_z < self.depth:
+                with self.lock:
+                    if next_z in self.slices or next_z in self.pending:
+                        continue
+                    self.pending.add(next_z)
+
+                self.prefetcher.submit(self.prefetch_slice, next_z)
+
+    def prefetch_slice(self, z):
+        try:
+            # skip slices the user has already scrubbed away from
+            if self.last_z is not None and abs(z - self.last_z) <= self.prefetch_count:
+                self.put(z, self.render_slice(z))
+        finally:
+            with self.lock:
+                self.pending.discard(z)
+
+    def clear(self):
+        with self.lock:
+            self.slices.clear()
+            self.num_bytes = 0
+
+    def close(self):
+        self.prefetcher.shutdown(wait=False)
+        self.clear()
+
+class OverlayCompositor:
+    def __init__(self, colormap="hot", num_buffers=2):
+        self.lut = colormap_lut(colormap)
+
+        self.num_buffers  = num_buffers
+        self.buffer_index = 0
+        self.shape        = None
+
+    def allocate(self, shape):
+        height, width = shape
+
+        self.shape       = shape
+        self.overlay     = np.empty((height, width, 3), dtype=np.uint8)
+        self.accumulator = np.empty((height, width, 3), dtype=np.uint16)
+        self.background  = np.empty((height, width), dtype=np.uint16)
+
+        # the displayed image may still be referenced by the view, so alternate between outputs
+        self.outputs = [ np.empty((height, width, 3), dtype=np.uint8) for i in range(self.num_buffers) ]
+
+    def composite(self, background, overlay, alpha):
+        if background.shape != overlay.shape:
+            raise ValueError("Background slice has shape {} but overlay slice has shape {}.".format(background.shape, overlay.shape))
+
+        if background.shape != self.shape:
+            self.allocate(background.shape)
+
+        # blend in 8-bit fixed point: (a*overlay + (256 - a)*background) >> 8
+        a = int(round(alpha*256))
+
+        np.take(self.lut, overlay, axis=0, out=self.overlay)
+        np.multiply(self.overlay, a, out=self.accumulator, dtype=np.uint16)
+        np.multiply(background, 256 - a, out=self.background, dtype=np.uint16)
+        np.add(self.accumulator, self.background[:, :, np.newaxis], out=self.accumulator)
+        np.right_shift(self.accumulator, 8, out=self.accumulator)
+
+        output = self.outputs[self.buffer_index]
+        self.buffer_index = (self.buffer_index + 1) % self.num_buffers
+
+        np.copyto(output, self.accumulator, casting="unsafe")
+
+        return output
+
+class FrameTimer:
+    def __init__(self, history_size=240, callback=None):
+        self.history_size = history_size
+        self.callback     = callback
+
+        self.frame_times = {}
+        self.depth       = 0
+
+    @contextmanager
+    def frame(self, name):
+        # handlers call each other, so only the outermost one counts as a frame
+        self.depth += 1
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.depth -= 1
+
+            if self.depth == 0:
+                self.record(name, time.perf_counter() - start)
+
+    def record(self, name, frame_time):
+        if name not in self.frame_times:
+            self.frame_times[name] = deque(maxlen=self.history_size)
+
+        self.frame_times[name].append(frame_time)
+
+        if self.callback is not None:
+            self.callback(name, frame_time)
+
+    def percentiles(self, name, percentiles=(50, 95, 99)):
+        return np.percentile(self.frame_times[name], percentiles)
+
+    def clear(self):
+        self.frame_times = {}
@@ -0,0 +1,220 @@
+import os
+import gzip
+import zlib
+import shutil
+import struct
+import hashlib
+import tempfile
+import subprocess
+import numpy as np
+import nibabel as nib
+
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import file_hash
+
+chunk_size      = 16*1024*1024
+bgzf_batch_size = 256
+
+# what bgzip puts in a block, so even incompressible data fits the 64 KB limit
+bgzf_block_size = 0xff00
+
+class StagingCancelled(Exception):
+    pass
+
+def is_bgzf(path):
+    # BGZF (bgzip) files are gzip members of at most 64 KB, each with its compressed size
+    # in a "BC" extra field, so the blocks can be found without decompressing anything
+    with open(path, "rb") as f:
+        header = f.read(16)
+
+    return len(header) == 16 and header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
+
+def bgzf_blocks(f):
+    offset = 0
+
+    while True:
+        f.seek(offset)
+        header = f.read(18)
+
+        if len(header) < 18:
+            return
+
+        block_size = struct.unpack("<H", header[16:18])[0] + 1
+
+        yield offset, block_size
+
+        offset += block_size
+
+def decompress_block(block):
+    # skip the 18 byte header and the 8 byte CRC and size trailer
+    return zlib.decompress(block[18:-8], -15)
+
+def compress_block(data, level=6):
+    # one BGZF block: a gzip member with the "BC" extra field holding its size
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated   = compressor.compress(data) + compressor.flush()
+
+    header = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00" + struct.pack("<H", len(deflated) + 25)
+
+    return header + deflated + struct.pack("<II", zlib.crc32(data), len(data))
+
+def compress_bgzf(input_path, output_path, num_threads=None, level=6):
+    # BGZF output is an ordinary .gz file for every reader, but its blocks compress in parallel
+    # here and decompress in parallel when it's staged
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+
+    with open(input_path, "rb") as f, open(output_path, "wb") as output_file, ThreadPoolExecutor(max_workers=num_threads) as executor:
+        while True:
+            batch = [ f.read(bgzf_block_size) for i in range(bgzf_batch_size) ]
+            batch = [ data for data in batch if len(data) > 0 ]
+
+            if len(batch) == 0:
+                break
+
+            for block in executor.map(lambda data: compress_block(data, level), batch):
+                output_file.write(block)
+
+        output_file.write(compress_block(b""))
+
+def uncompressed_size(path):
+    header = nib.load(path).header
+
+    return int(header["vox_offset"]) + int(np.prod(header.get_data_shape()))*header.get_data_dtype().itemsize
+
+def decompress_bgzf(path, output_file, num_threads, report_progress):
+    with open(path, "rb") as f, ThreadPoolExecutor(max_workers=num_threads) as executor:
+        blocks = bgzf_blocks(f)
+
+        while True:
+            batch = []
+            for offset, block_size in blocks:
+                batch.append((offset, block_size))
+
+                if len(batch) == bgzf_batch_size:
+                    break
+
+            if len(batch) == 0:
+                return
+
+            data = []
+            for offset, block_size in batch:
+                f.seek(offset)
+                data.append(f.read(block_size))
+
+            # zlib releases the GIL, so the blocks of a batch decompress in parallel
+            for chunk in executor.map(decompress_block, data):
+                output_file.write(chunk)
+                report_progress(len(chunk))
+
+def decompress_pigz(path, output_file, num_threads, report_progress):
+    with subprocess.Popen(["pigz", "-d", "-c", "-p", str(num_threads), path], stdout=subprocess.PIPE) as p:
+        try:
+            for chunk in iter(lambda: p.stdout.read(chunk_size), b""):
+                output_file.write(chunk)
+                report_progress(len(chunk))
+        except StagingCancelled:
+            p.kill()
+            raise
+
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, p.args)
+
+def decompress_stream(path, output_file, report_progress):
+    with gzip.open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            output_file.write(chunk)
+            report_progress(len(chunk))
+
+def decompress(path, output_file, num_threads=None, progress_callback=None, cancelled=None):
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+
+    total_size  = uncompressed_size(path)
+    output_size = [0]
+
+    def report_progress(num_bytes):
+        if cancelled is not None and cancelled():
+            raise StagingCancelled(path)
+
+        output_size[0] += num_bytes
+
+        if progress_callback is not None:
+            progress_callback(min(output_size[0], total_size), total_size)
+
+    # ordinary gzip streams can only be inflated sequentially; pigz at least moves reading,
+    # writing and checksumming to threads of their own
+    if is_bgzf(path):
+        decompress_bgzf(path, output_file, num_threads, report_progress)
+    elif shutil.which("pigz") is not None:
+        decompress_pigz(path, output_file, num_threads, report_progress)
+    else:
+        decompress_stream(path, output_file, report_progress)
+
+class StagingCache:
+    def __init__(self, directory, max_size=50*1024**3, min_size=16*1024**2, num_threads=None):
+        self.directory   = directory
+        self.max_size    = max_size
+        self.min_size    = min_size
+        self.num_threads = num_threads
+
+    def needs_staging(self, path):
+        return path.endswith(".nii.gz") and os.path.getsize(path) >= self.min_size
+
+    def key(self, path):
+        return hashlib.sha256("{}:{}".format(file_hash(path), os.stat(path).st_mtime_ns).encode()).hexdigest()
+
+    def staged_path(self, path):
+        return os.path.join(self.directory, self.key(path) + ".nii")
+
+    def stage(self, path, progress_callback=None, cancelled=None):
+        if not self.needs_staging(path):
+            return path
+
+        staged_path = self.staged_path(path)
+
+        if os.path.exists(staged_path):
+            # mark the entry as recently used
+            os.utime(staged_path)
+            return staged_path
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # decompress into a temporary file first so concurrent readers never see a partial entry
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-", suffix=".nii")
+
+        try:
+            with os.fdopen(file_descriptor, "wb") as output_file:
+                decompress(path, output_file, num_threads=self.num_threads, progress_callback=progress_callback, cancelled=cancelled)
+
+            os.replace(temp_path, staged_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        self.evict(keep=staged_path)
+
+        return staged_path
+
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+
+            if not name.startswith(".") and path != keep:
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+
+        total_size = sum([ entry[1] for entry in entries ]) + (os.path.getsize(keep) if keep is not None else 0)
+
+        # remove least recently used entries first
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+            total_size -= size
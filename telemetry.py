@@ -0,0 +1,82 @@
+import re
+import csv
+from collections import namedtuple
+
+TelemetryRecord = namedtuple("TelemetryRecord", ["stage", "level", "iteration", "metric_value", "convergence_value", "iteration_time"])
+
+diagnostic_pattern = re.compile(r"^\s*\d*DIAGNOSTIC,\s*(\d+),\s*([^,]+),\s*([^,]+),\s*([^,]+),\s*([^,]+)")
+level_pattern      = re.compile(r"Current level = (\d+) of (\d+)")
+stage_pattern      = re.compile(r"^\s*Stage (\d+)\s*$")
+
+def parse_float(text):
+    try:
+        return float(text)
+    except ValueError:
+        return float("nan")
+
+class ConvergenceParser:
+    def __init__(self, callback=None):
+        self.callback = callback
+
+        self.stage   = None
+        self.level   = 0
+        self.records = []
+
+    def begin_stage(self, stage):
+        self.stage = stage
+        self.level = 0
+
+    def feed(self, line):
+        match = diagnostic_pattern.match(line)
+
+        if match is not None:
+            iteration, metric_value, convergence_value, iteration_time, since_last = match.groups()
+
+            record = TelemetryRecord(self.stage, self.level, int(iteration), parse_float(metric_value), parse_float(convergence_value), parse_float(since_last))
+            self.records.append(record)
+
+            if self.callback is not None:
+                self.callback(record)
+
+            return record
+
+        match = level_pattern.search(line)
+
+        if match is not None:
+            self.level = int(match.group(1))
+            return None
+
+        match = stage_pattern.match(line)
+
+        # stages are run one per antsRegistration call, so only fall back to ANTs' own
+        # stage numbering when no stage name was given
+        if match is not None and self.stage is None:
+            self.stage = match.group(1)
+
+        return None
+
+class TelemetryWriter:
+    def __init__(self, path):
+        self.file   = open(path, "a", newline="")
+        self.writer = csv.writer(self.file)
+
+        if self.file.tell() == 0:
+            self.writer.writerow(TelemetryRecord._fields)
+
+    def write(self, record):
+        self.writer.writerow(["{:.6g}".format(value) if isinstance(value, float) else value for value in record])
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def load_telemetry(path):
+    records = []
+
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+
+        for row in reader:
+            records.append(TelemetryRecord(row["stage"], int(row["level"]), int(row["iteration"]), float(row["metric_value"]), float(row["convergence_value"]), float(row["iteration_time"])))
+
+    return records
@@ -0,0 +1,136 @@
+import os
+import sys
+import subprocess
+import numpy as np
+import nibabel as nib
+
+from cache import file_key
+from controller import Controller
+from convergence import IterationBudgets
+from preview import create_preview_controller
+from telemetry import TelemetryRecord
+
+def test_imports_only_need_the_standard_library():
+    # a fresh interpreter, since the other tests have already imported numpy
+    code   = "import sys, controller, batch, cli; print(sorted(set(['numpy', 'nibabel']) & set(sys.modules)))"
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), universal_newlines=True)
+
+    assert output.strip() == "[]"
+
+def test_snapshot_is_independent_of_later_edits():
+    controller = Controller()
+    controller.fixed_image_path = "fixed.nii"
+    controller.add_moving_images(["moving.nii"])
+    controller.job_id = "job"
+
+    snapshot = controller.snapshot()
+
+    controller.syn_params["num_iterations"] = "10x0"
+    controller.params["syn"]                = False
+    controller.add_moving_images(["other.nii"])
+    controller.registration_channel = 1
+
+    assert snapshot.syn_params["num_iterations"] == "200x200x200x200x10"
+    assert snapshot.params["syn"]
+    assert snapshot.moving_image_paths == ["moving.nii"]
+    assert (snapshot.registration_channel, snapshot.job_id) == (0, "job")
+    assert snapshot.staging_cache is controller.staging_cache
+
+def test_peaks_without_a_memory_history():
+    controller = Controller()
+    controller.memory_history = None
+
+    controller.record_peak_memory("apply", 100, 200)
+    controller.save_memory_history()
+
+    assert controller.peak_memory == {"apply": 200}
+
+def test_plateau_policy_from_params(tmp_path):
+    from presets import get_preset, save_preset
+
+    controller = Controller()
+    controller.set_params({"params": {"plateau_window_size": 5, "plateau_margin": 1.5}})
+
+    policy = controller.plateau_policy()
+
+    assert (policy.window_size, policy.min_relative_improvement, policy.margin, policy.min_iterations) == (5, 1e-4, 1.5, 10)
+
+    # presets carry them with the other parameters
+    preset = get_preset("balanced")
+    preset["params"]["params"]["plateau_min_iterations"] = 20
+    save_preset(preset, str(tmp_path / "preset.json"))
+
+    assert get_preset(str(tmp_path / "preset.json"))["params"]["params"]["plateau_min_iterations"] == 20
+
+def test_record_iteration_budgets(tmp_path):
+    nib.save(nib.Nifti1Image(np.zeros((4, 4, 4), dtype=np.float32), np.eye(4)), str(tmp_path / "fixed.nii"))
+
+    controller = Controller()
+    controller.fixed_image_path  = str(tmp_path / "fixed.nii")
+    controller.iteration_budgets = IterationBudgets(str(tmp_path / "budgets.json"))
+
+    # level 1 flattens out after 20 iterations, level 2 improves until it runs out
+    metric_values = {1: [ -0.5 - 0.01*i for i in range(20) ] + [-0.7]*30, 2: [ -0.01*i for i in range(50) ]}
+    records       = [ TelemetryRecord("syn", level, i + 1, metric_values[level][i], 0, 0.1) for level in (1, 2) for i in range(50) ]
+
+    messages = []
+    controller.record_iteration_budgets("syn", records, messages.append)
+
+    template_key = file_key(controller.fixed_image_path)
+    budgets      = IterationBudgets(str(tmp_path / "budgets.json"))
+
+    assert budgets.history(template_key, "syn", 1) == [31]
+    assert budgets.history(template_key, "syn", 2) == [50]
+    assert "plateaued at iteration 31 of 50" in messages[0]
+    assert "still improving after 50 iterations" in messages[1]
+
+def test_registration_params_follow_adapted_iterations(tmp_path):
+    for name in ("fixed", "moving"):
+        nib.save(nib.Nifti1Image(np.zeros((4, 4, 4), dtype=np.float32), np.eye(4)), str(tmp_path / "{}.nii".format(name)))
+
+    controller = Controller()
+    controller.fixed_image_path  = str(tmp_path / "fixed.nii")
+    controller.workspace_root    = str(tmp_path / "registrations")
+    controller.iteration_budgets = IterationBudgets(str(tmp_path / "budgets.json"))
+    controller.add_moving_images([str(tmp_path / "moving.nii")])
+    controller.params["adaptive_iterations"] = True
+
+    before = controller.registration_params()
+
+    controller.iteration_budgets.record(file_key(controller.fixed_image_path), "syn", 1, 31)
+    after = controller.registration_params()
+
+    syn_params = [ stage["params"] for stage in after["stages"] if stage["stage"] == "syn" ][0]
+
+    assert before != after
+    assert syn_params["num_iterations"] == "x".join(controller.pipeline.stages[-1].convergence.num_iterations)
+    assert syn_params["num_iterations"] == "39x200x200x200x10"
+
+def test_preview_controllers_dont_record_histories(tmp_path):
+    for name in ("fixed", "moving"):
+        nib.save(nib.Nifti1Image(np.random.RandomState(0).rand(8, 8, 8).astype(np.float32), np.eye(4)), str(tmp_path / "{}.nii".format(name)))
+
+    controller = Controller()
+    controller.fixed_image_path = str(tmp_path / "fixed.nii")
+    controller.workspace_root   = str(tmp_path / "registrations")
+    controller.staging_cache    = None
+    controller.add_moving_images([str(tmp_path / "moving.nii")])
+
+    preview_controller = create_preview_controller(controller, 64, 10)
+
+    assert (preview_controller.iteration_budgets, preview_controller.memory_history) == (None, None)
+
+    # recording its plateaus is then a no-op rather than an error
+    preview_controller.record_iteration_budgets("syn", [ TelemetryRecord("syn", 1, i + 1, -0.5, 0, 0.1) for i in range(20) ])
+
+def test_missing_fixed_image_with_adaptive_iterations():
+    controller = Controller()
+    controller.fixed_image_path = "/nonexistent/fixed.nii"
+    controller.workspace_root   = "/nonexistent/registrations"
+    controller.add_moving_images(["/nonexistent/moving.nii"])
+    controller.params["adaptive_iterations"] = True
+
+    controller.create_shell_command()
+
+    assert controller.pipeline_error.startswith("Could not read the fixed image /nonexistent/fixed.nii")
+    assert controller.shell_command == ""
@@ -0,0 +1,62 @@
+import json
+
+from convergence import PlateauPolicy, IterationBudgets, plateau_iterations
+from telemetry import TelemetryRecord
+
+# flattens out after 20 iterations, and keeps improving
+plateaued = [ -0.5 - 0.01*i for i in range(20) ] + [-0.7]*30
+improving = [ -0.01*i for i in range(50) ]
+
+def test_plateau_iteration():
+    policy = PlateauPolicy()
+
+    # the first window over which the metric stops improving ends at iteration 31
+    assert policy.plateau_iteration(plateaued) == 31
+    assert policy.plateau_iteration(improving) is None
+
+    # too short to have a window
+    assert policy.plateau_iteration([-0.7]*10) is None
+
+    # with a looser threshold the steady drop of 0.1 per window counts as a plateau once it's
+    # under 45% of the metric, from -0.23 at iteration 24 to -0.33 at iteration 34
+    assert PlateauPolicy(min_relative_improvement=0.45).plateau_iteration(improving) == 34
+
+def test_iteration_budget():
+    policy = PlateauPolicy(margin=1.25, min_iterations=10)
+
+    assert policy.iteration_budget([31]) == 39
+    assert policy.iteration_budget([20, 31, 25]) == 39
+    assert policy.iteration_budget([4]) == 10
+
+def test_plateau_iterations_by_stage_and_level():
+    records = [ TelemetryRecord("syn", 1, i + 1, plateaued[i], 0, 0.1) for i in range(50) ]
+    records += [ TelemetryRecord("syn", 2, i + 1, improving[i], 0, 0.1) for i in range(50) ]
+
+    assert plateau_iterations(records, PlateauPolicy()) == {("syn", 1): 31, ("syn", 2): None}
+
+def test_adapt_shortens_only_converged_levels(tmp_path):
+    budgets = IterationBudgets(str(tmp_path / "budgets.json"))
+
+    # level 1 plateaued at 31 of 100 iterations, level 2 used all 50 of its iterations
+    budgets.record("template", "syn", 1, 31)
+    budgets.record("template", "syn", 2, 50)
+
+    assert budgets.adapt("template", "syn", "100x50x0", PlateauPolicy()) == "39x50x0"
+
+    # nothing recorded for other templates and stages
+    assert budgets.adapt("other", "syn", "100x50x0", PlateauPolicy()) == "100x50x0"
+    assert budgets.adapt("template", "affine", "100x50x0", PlateauPolicy()) == "100x50x0"
+
+def test_budgets_are_saved(tmp_path):
+    budgets = IterationBudgets(str(tmp_path / "history" / "budgets.json"), history_size=2)
+
+    for plateau_iteration in (40, 31, 35):
+        budgets.record("template", "syn", 1, plateau_iteration)
+
+    budgets.save()
+
+    assert budgets.version == 3
+    assert IterationBudgets(budgets.path).history("template", "syn", 1) == [31, 35]
+
+    with open(budgets.path) as f:
+        assert json.load(f) == {"template": {"syn": {"1": [31, 35]}}}
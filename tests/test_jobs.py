@@ -0,0 +1,119 @@
+import pytest
+
+import os
+
+from jobs import JobStore, progress_summary
+from executors import SpoolExecutor, claim_job
+
+def test_a_job_is_started_once(tmp_path):
+    store    = JobStore(str(tmp_path / "jobs.sqlite3"))
+    id       = store.add(str(tmp_path / "fixed.nii"), [str(tmp_path / "moving.nii")])
+    launches = []
+
+    def launch(token):
+        launches.append(token)
+        return 1234
+
+    assert store.start(id, launch)
+    assert not store.start(id, launch)
+
+    job = store.get(id)
+
+    assert launches == [job["token"]]
+    assert (job["status"], job["pid"], job["attempts"]) == ("running", 1234, 1)
+
+def test_a_failed_launch_leaves_the_job_queued(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    id    = store.add(str(tmp_path / "fixed.nii"), [str(tmp_path / "moving.nii")])
+
+    def launch(token):
+        raise OSError("no such executable")
+
+    with pytest.raises(OSError):
+        store.start(id, launch)
+
+    job = store.get(id)
+
+    assert (job["status"], job["attempts"]) == ("queued", 0)
+
+def test_results_of_a_replaced_attempt_are_ignored(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"), backoff=0)
+    id    = store.add(str(tmp_path / "fixed.nii"), [str(tmp_path / "moving.nii")])
+
+    store.start(id, lambda token: None)
+    first_token = store.get(id)["token"]
+
+    # given up on, eg. after missed heartbeats, and started again
+    store.fail(id, first_token, "Worker stopped sending heartbeats.")
+    store.start(id, lambda token: None)
+    second_token = store.get(id)["token"]
+
+    result = {"status": "finished", "warped_moving_image_paths": ["stale.nii.gz"], "failed_channels": []}
+
+    store.set_progress(id, first_token, {"line": "stale"})
+    store.finish(id, first_token, result)
+    store.fail(id, first_token, "stale failure")
+
+    job = store.get(id)
+
+    assert second_token != first_token
+    assert (job["status"], job["attempts"], job["progress"], job["warped_moving_image_paths"]) == ("running", 2, None, None)
+
+    store.finish(id, second_token, dict(result, warped_moving_image_paths=["warped.nii.gz"]))
+
+    assert store.get(id)["warped_moving_image_paths"] == ["warped.nii.gz"]
+
+def test_spool_files_are_named_by_attempt(tmp_path):
+    store    = JobStore(str(tmp_path / "jobs.sqlite3"))
+    executor = SpoolExecutor(str(tmp_path / "spool"), heartbeat_timeout=0)
+    id       = store.add(str(tmp_path / "fixed.nii"), [str(tmp_path / "moving.nii")])
+
+    store.start(id, lambda token: executor.start(store.get(id), 1, token))
+    job = store.get(id)
+
+    claimed = claim_job(executor.directory, "worker-1")
+
+    assert claimed["token"] == job["token"]
+    assert os.path.exists(executor.path("claimed", job["token"]))
+
+    # a missed heartbeat removes the claim, which tells the worker to stop the job
+    os.utime(executor.path("claimed", job["token"], ".worker"), (0, 0))
+
+    assert executor.check(job) == "Worker worker-1 stopped sending heartbeats."
+    assert not os.path.exists(executor.path("claimed", job["token"]))
+
+def test_progress_summary():
+    telemetry = {"stage": "syn", "level": 2, "iteration": 40, "metric_value": -0.5, "convergence_value": 1e-5, "iteration_time": 0.1}
+
+    assert progress_summary(None) == ""
+    assert progress_summary({"line": "Staging fixed.nii.gz", "telemetry": None}) == "Staging fixed.nii.gz"
+    assert progress_summary({"line": "", "telemetry": telemetry}) == "syn level 2 iteration 40"
+
+def test_apply_options_reach_the_job(tmp_path, monkeypatch):
+    import jobs
+
+    store   = JobStore(str(tmp_path / "jobs.sqlite3"))
+    options = {"tiled_apply": True, "tiled_apply_memory": 1024**3, "warp_on_demand": True}
+    id      = store.add(str(tmp_path / "fixed.nii"), [str(tmp_path / "moving.nii")], apply_options=options)
+
+    assert store.get(id)["apply_options"] == options
+
+    run_jobs = []
+
+    def run_job(job, output_directory, num_threads, **kwargs):
+        run_jobs.append(job)
+        return {"status": "finished", "warped_moving_image_paths": [], "failed_channels": []}
+
+    monkeypatch.setattr(jobs, "run_job", run_job)
+
+    store.start(id, lambda token: None)
+    jobs.run_stored_job(store, id, 1, store.get(id)["token"])
+
+    assert run_jobs[0]["apply_options"] == options
+    assert store.get(id)["status"] == "finished"
+
+    # and the controller rebuilt for the result is set up the same way
+    controller = jobs.job_controller(store.get(id))
+
+    assert controller.get_apply_options() == options
+    assert controller.workspace.job_id == store.get(id)["job_id"]
@@ -0,0 +1,16 @@
+from memory import stage_memory, neighbourhood_voxels
+
+stage_params = {"metric": "Cross-Correlation", "num_iterations": "100x50", "shrink_factors": "4x2"}
+
+def test_neighbourhood_voxels():
+    assert neighbourhood_voxels("2") == 125
+    assert neighbourhood_voxels(4) == 729
+    assert neighbourhood_voxels("4x4x2") == 9*9*5
+
+def test_cross_correlation_memory_grows_with_radius_and_threads():
+    def memory(radius, num_threads):
+        return stage_memory("syn", stage_params, {"radius": radius}, 10**6, 10**6, num_threads)
+
+    # 5 sums of 8 bytes per neighbourhood voxel and thread
+    assert memory("4", 1) - memory("2", 1) == (729 - 125)*5*8
+    assert memory("4", 8) - memory("4", 1) == 7*729*5*8
@@ -0,0 +1,29 @@
+import pytest
+
+from pipeline import PipelineError, create_stage
+from preview import truncate_pyramid
+
+stage_params  = {"gradient_step": "0.1", "metric": "Mutual Information", "num_iterations": "100x50x25x10", "convergence_threshold": "1e-6", "convergence_window_size": "10",
+                 "shrink_factors": "8x4x2x1", "gaussian_sigma": "4x3x2x1"}
+metric_params = {"metric_weight": "1", "num_bins": "32", "sampling_strategy": "Regular", "sampling_percentage": "0.25"}
+
+def smoothing_argv(gaussian_sigma):
+    argv = create_stage("affine", dict(stage_params, gaussian_sigma=gaussian_sigma), metric_params).argv("fixed.nii", "moving.nii")
+
+    return argv[argv.index("-s") + 1]
+
+def test_smoothing_sigma_units():
+    assert smoothing_argv("4x3x2x1") == "4x3x2x1"
+    assert smoothing_argv("4x3x2x1vox") == "4x3x2x1vox"
+    assert smoothing_argv("4x3x2x1mm") == "4x3x2x1mm"
+
+    with pytest.raises(PipelineError, match="should be a number, not \"1cm\""):
+        smoothing_argv("4x3x2x1cm")
+
+    with pytest.raises(PipelineError, match="4 iteration counts, 4 shrink factors and 3 smoothing sigmas"):
+        create_stage("affine", dict(stage_params, gaussian_sigma="3x2x1mm"), metric_params).validate()
+
+def test_preview_keeps_sigma_units():
+    # only sigmas in voxels shrink with the preview's voxels
+    assert truncate_pyramid(dict(stage_params, gaussian_sigma="4x3x2x1vox"), 2, 10)["gaussian_sigma"] == "2x1.5x1vox"
+    assert truncate_pyramid(dict(stage_params, gaussian_sigma="4x3x2x1mm"), 2, 10)["gaussian_sigma"] == "4x3x2mm"
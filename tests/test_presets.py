@@ -0,0 +1,26 @@
+import json
+import pytest
+
+from presets import load_preset
+
+def write_preset(tmp_path, params):
+    path = str(tmp_path / "preset.json")
+
+    with open(path, "w") as f:
+        json.dump({"version": 1, "params": params}, f)
+
+    return path
+
+def test_partial_presets_keep_the_defaults(tmp_path):
+    preset = load_preset(write_preset(tmp_path, {"syn_params": {"num_iterations": "10x0"}}))
+
+    assert preset["params"]["syn_params"]["num_iterations"] == "10x0"
+    assert preset["params"]["syn_params"]["shrink_factors"] == "12x8x4x2x1"
+
+def test_unknown_parameters_are_rejected(tmp_path):
+    with pytest.raises(ValueError, match="unknown parameter group \"syn\""):
+        load_preset(write_preset(tmp_path, {"syn": {"num_iterations": "10x0"}}))
+
+    # a misspelt key would otherwise be silently ignored
+    with pytest.raises(ValueError, match="unknown parameter \"syn_params.num_iteration\""):
+        load_preset(write_preset(tmp_path, {"syn_params": {"num_iteration": "10x0"}}))
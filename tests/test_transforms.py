@@ -0,0 +1,103 @@
+import numpy as np
+import nibabel as nib
+
+from staging import StagingCache
+from tiled import apply_transforms, chunk_budget, chunk_shape, chunk_ranges, bytes_per_point
+from transforms import AffineTransform, TransformStack, SliceTransformer, write_itk_affine, trilinear, bytes_per_box_voxel
+
+shape = (12, 14, 16)
+
+def write_pair(directory, translation):
+    # identity voxel to RAS grids, so a voxel (i, j, k) is at LPS (-i, -j, k); the warp moves
+    # points by +1 in LPS z where i < 5 and the affine translates them
+    field             = np.zeros(shape + (1, 3), dtype=np.float32)
+    field[:5, ..., 2] = 1
+
+    warp_path   = str(directory / "1Warp.nii")
+    affine_path = str(directory / "0GenericAffine.mat")
+
+    nib.save(nib.Nifti1Image(field, np.eye(4)), warp_path)
+    write_itk_affine(affine_path, AffineTransform(np.eye(3), translation, np.zeros(3)))
+
+    return [warp_path, affine_path]
+
+def test_warp_is_applied_before_affine(tmp_path):
+    transforms = TransformStack(write_pair(tmp_path, [10, 0, 0]))
+
+    # A(x + u(x)): the field is looked up at the fixed point, so the +1 z applies
+    points = transforms.map_points(np.array([[-2.0, -10.0, 10.0]]))
+
+    np.testing.assert_allclose(points, [[8, -10, 11]])
+
+def expected_output(moving):
+    # LPS x -3 is voxel i +3, the warp's LPS z +1 is voxel k +1 where i < 5
+    expected = np.zeros(shape, dtype=np.float32)
+
+    for i, j, k in np.ndindex(*shape):
+        source = (i + 3, j, k + (1 if i < 5 else 0))
+
+        if all(index < size for index, size in zip(source, shape)):
+            expected[i, j, k] = moving[source]
+
+    return expected
+
+def test_tiled_apply_transforms(tmp_path):
+    transform_paths = write_pair(tmp_path, [-3, 0, 0])
+
+    moving = np.random.RandomState(0).rand(*shape).astype(np.float32)
+    nib.save(nib.Nifti1Image(moving, np.eye(4)), str(tmp_path / "moving.nii"))
+    nib.save(nib.Nifti1Image(np.zeros(shape, dtype=np.float32), np.eye(4)), str(tmp_path / "fixed.nii"))
+
+    output_path = str(tmp_path / "output.nii")
+    apply_transforms(str(tmp_path / "moving.nii"), str(tmp_path / "fixed.nii"), transform_paths, output_path, num_workers=2, staging_cache=StagingCache(str(tmp_path / "staged"), min_size=0))
+
+    np.testing.assert_allclose(np.asanyarray(nib.load(output_path).dataobj), expected_output(moving), atol=1e-6)
+
+    # a budget small enough to tile in x and y and to split the boxes read
+    output_path = str(tmp_path / "tiled.nii")
+    apply_transforms(str(tmp_path / "moving.nii"), str(tmp_path / "fixed.nii"), transform_paths, output_path, num_workers=2, max_memory=20000, staging_cache=StagingCache(str(tmp_path / "staged"), min_size=0))
+
+    np.testing.assert_allclose(np.asanyarray(nib.load(output_path).dataobj), expected_output(moving), atol=1e-6)
+
+def test_slice_transformer(tmp_path):
+    transform_paths = write_pair(tmp_path, [-3, 0, 0])
+    nib.save(nib.Nifti1Image(np.zeros(shape, dtype=np.float32), np.eye(4)), str(tmp_path / "fixed.nii"))
+
+    transformer = SliceTransformer(str(tmp_path / "fixed.nii"), transform_paths)
+    points      = transformer.slice_points(7).reshape(shape[:2] + (3,))
+
+    # voxel (2, 4, 7) is inside the warped band, voxel (8, 4, 7) isn't
+    np.testing.assert_allclose(points[2, 4], [-5, -4, 8])
+    np.testing.assert_allclose(points[8, 4], [-11, -4, 7])
+
+def test_trilinear_splits_large_boxes():
+    data   = np.random.RandomState(1).rand(*shape).astype(np.float32)
+    voxels = np.random.RandomState(2).uniform(-1, max(shape), size=(500, 3))
+
+    class CountingArray:
+        # records the size of every box read
+        def __init__(self, data):
+            self.data  = data
+            self.shape = data.shape
+            self.reads = []
+
+        def __getitem__(self, index):
+            box = self.data[index]
+            self.reads.append(box.size)
+            return box
+
+    counting = CountingArray(data)
+    values   = trilinear(counting, shape, voxels, max_box_bytes=64*bytes_per_box_voxel)
+
+    np.testing.assert_allclose(values, trilinear(data, shape, voxels), atol=1e-6)
+    assert max(counting.reads) <= 64
+
+def test_chunks_cover_the_image():
+    size   = chunk_shape((300, 200, 50), 8*1024**2, 4)
+    counts = np.zeros((300, 200, 50), dtype=np.int8)
+
+    for start, stop in chunk_ranges(counts.shape, size):
+        counts[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]] += 1
+
+    assert (counts == 1).all()
+    assert np.prod(size)*bytes_per_point <= chunk_budget(8*1024**2, 4)[0]
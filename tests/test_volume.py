@@ -0,0 +1,19 @@
+import numpy as np
+import nibabel as nib
+
+from test_transforms import shape, write_pair, expected_output
+from transforms import SliceTransformer
+from volume import Volume, WarpedVolume
+
+def test_warped_volume_matches_hand_computed(tmp_path):
+    transform_paths = write_pair(tmp_path, [-3, 0, 0])
+
+    moving = np.random.RandomState(0).rand(*shape).astype(np.float32)
+    nib.save(nib.Nifti1Image(moving, np.eye(4)), str(tmp_path / "moving.nii"))
+    nib.save(nib.Nifti1Image(np.zeros(shape, dtype=np.float32), np.eye(4)), str(tmp_path / "fixed.nii"))
+
+    warped   = WarpedVolume(Volume(str(tmp_path / "moving.nii")), SliceTransformer(str(tmp_path / "fixed.nii"), transform_paths))
+    expected = expected_output(moving)
+
+    for z in range(warped.depth):
+        np.testing.assert_allclose(warped.get_slice(z), expected[:, :, z], atol=1e-6)
@@ -0,0 +1,179 @@
+import os
+import sys
+import argparse
+import tempfile
+import numpy as np
+import nibabel as nib
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from cache import default_cache_directory
+from staging import StagingCache, compress_bgzf
+from transforms import TransformStack, voxel_to_lps, apply_affine, trilinear, grid_points
+
+# working memory per output voxel while a chunk is resampled: the fixed and moving space
+# points, the interpolation indices, fractions and weights, and the output values
+bytes_per_point = 256
+
+def image_shape(image, path):
+    shape = image.shape
+
+    # trailing singleton dimensions are common in light-sheet exports
+    while len(shape) > 3 and shape[-1] == 1:
+        shape = shape[:-1]
+
+    if len(shape) != 3:
+        raise ValueError("{} is not a 3D image.".format(path))
+
+    return shape
+
+def chunk_budget(max_memory, num_workers):
+    # each worker's share is split between the chunk's points and the boxes interpolation reads
+    # from the moving image and displacement fields, one at a time; trilinear splits the points
+    # further when their box is larger than its half
+    budget = max_memory//num_workers
+
+    return budget//2, budget - budget//2
+
+def chunk_shape(shape, max_memory, num_workers):
+    points_budget, box_budget = chunk_budget(max_memory, num_workers)
+
+    # whole rows and slices where they fit, so the blocks are mostly contiguous in the output
+    num_points = max(1, points_budget//bytes_per_point)
+    width      = min(shape[0], num_points)
+    height     = min(shape[1], max(1, num_points//width))
+    depth      = min(shape[2], max(1, num_points//(width*height)))
+
+    # at least a few chunks per worker, so the pool stays busy to the end
+    return width, height, int(min(depth, max(1, -(-shape[2]//(4*num_workers)))))
+
+def chunk_ranges(shape, size):
+    for x in range(0, shape[0], size[0]):
+        for y in range(0, shape[1], size[1]):
+            for z in range(0, shape[2], size[2]):
+                start = (x, y, z)
+                yield start, tuple( min(first + length, last) for first, length, last in zip(start, size, shape) )
+
+def create_output(path, fixed_image, shape):
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(np.float32)
+    header.set_xyzt_units(*fixed_image.header.get_xyzt_units())
+    header.set_qform(*fixed_image.header.get_qform(coded=True))
+    header.set_sform(*fixed_image.header.get_sform(coded=True))
+
+    # the data is left sparse; each chunk fills in its own block
+    with open(path, "wb") as f:
+        header.write_to(f)
+
+        # writing the header sets the data offset past it and its extensions
+        offset = int(header.get_data_offset())
+
+        f.write(b"\x00"*(offset - f.tell()))
+        f.truncate(offset + int(np.prod(shape))*4)
+
+    return offset
+
+def resample_chunk(moving_image_path, fixed_image_path, transform_paths, output_path, output_offset, start, stop, max_box_bytes):
+    fixed_image  = nib.load(fixed_image_path, mmap=True)
+    moving_image = nib.load(moving_image_path, mmap=True)
+
+    shape        = image_shape(fixed_image, fixed_image_path)
+    moving_shape = image_shape(moving_image, moving_image_path)
+
+    points = apply_affine(voxel_to_lps(fixed_image), grid_points(start, stop))
+    points = TransformStack(transform_paths, max_box_bytes).map_points(points)
+    voxels = apply_affine(np.linalg.inv(voxel_to_lps(moving_image)), points)
+
+    del points
+
+    values = trilinear(moving_image.dataobj, moving_shape, voxels, max_box_bytes)[:, 0]
+
+    # NIfTI data is x fastest, so a block of whole slices is one contiguous run of the file
+    output = np.memmap(output_path, dtype=np.float32, mode="r+", offset=output_offset, shape=shape, order="F")
+    output[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]] = values.reshape(tuple( last - first for first, last in zip(start, stop) ))
+    output.flush()
+
+    return len(values)
+
+def apply_transforms(moving_image_path, fixed_image_path, transform_paths, output_path, num_workers=None, max_memory=2*1024**3, staging_cache=None, progress_callback=None):
+    if num_workers is None:
+        num_workers = int(os.environ.get("ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", os.cpu_count() or 1))
+
+    if staging_cache is None:
+        staging_cache = StagingCache(default_cache_directory("staged"), min_size=0)
+
+    # every chunk reads boxes from the inputs, which needs them uncompressed; only the fixed
+    # image's header is read
+    moving_image_path = staging_cache.stage(moving_image_path)
+    transform_paths   = [ staging_cache.stage(path) if path.endswith(".nii.gz") else path for path in transform_paths ]
+
+    # check the inputs before starting any workers
+    TransformStack(transform_paths)
+    fixed_image = nib.load(fixed_image_path, mmap=True)
+    shape       = image_shape(fixed_image, fixed_image_path)
+    image_shape(nib.load(moving_image_path, mmap=True), moving_image_path)
+
+    compressed = output_path.endswith(".gz")
+
+    if compressed:
+        file_descriptor, raw_output_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_path)), prefix=".tmp-", suffix=".nii")
+        os.close(file_descriptor)
+    else:
+        raw_output_path = output_path
+
+    try:
+        output_offset = create_output(raw_output_path, fixed_image, shape)
+
+        box_budget = chunk_budget(max_memory, num_workers)[1]
+        chunks     = list(chunk_ranges(shape, chunk_shape(shape, max_memory, num_workers)))
+
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [ executor.submit(resample_chunk, moving_image_path, fixed_image_path, transform_paths, raw_output_path, output_offset, start, stop, box_budget) for start, stop in chunks ]
+
+            num_voxels = 0
+            for future in as_completed(futures):
+                num_voxels += future.result()
+
+                if progress_callback is not None:
+                    progress_callback(num_voxels, int(np.prod(shape)))
+
+        if compressed:
+            compress_bgzf(raw_output_path, output_path, num_threads=num_workers)
+    finally:
+        if compressed and os.path.exists(raw_output_path):
+            os.remove(raw_output_path)
+
+def tiled_apply_transforms_argv(moving_image_path, fixed_image_path, transform_paths, output_path, max_memory=None):
+    # the same arguments as antsApplyTransforms, so the commands can be swapped for each other
+    argv = [sys.executable, os.path.abspath(__file__), "-i", moving_image_path, "-r", fixed_image_path]
+
+    for transform_path in transform_paths:
+        argv += ["-t", transform_path]
+
+    argv += ["-o", output_path]
+
+    if max_memory is not None:
+        argv += ["--max-memory", str(max_memory//1024**2)]
+
+    return argv
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply ANTs transforms to a volume larger than memory, in blocks across a process pool, with linear interpolation.")
+    parser.add_argument("-i", "--input", required=True, help="Moving image.")
+    parser.add_argument("-r", "--reference-image", required=True, help="Fixed image, which sets the output grid.")
+    parser.add_argument("-t", "--transform", action="append", default=[], help="Affine .mat or displacement field, in antsApplyTransforms order.")
+    parser.add_argument("-o", "--output", required=True, help="Output image; .nii.gz output is written as BGZF.")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Worker processes (default: ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS or all cores).")
+    parser.add_argument("--max-memory", type=int, default=2048, help="MB of working memory shared by the workers' chunks.")
+    args = parser.parse_args(argv)
+
+    def print_progress(num_voxels, total_voxels):
+        print("Resampled {} of {} voxels.".format(num_voxels, total_voxels), flush=True)
+
+    apply_transforms(args.input, args.reference_image, args.transform, args.output, num_workers=args.workers, max_memory=args.max_memory*1024**2, progress_callback=print_progress)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,243 @@
+import struct
+import threading
+import numpy as np
+import nibabel as nib
+
+from collections import OrderedDict
+
+# ITK works in LPS physical coordinates, NIfTI affines map voxels to RAS
+ras_to_lps = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+# MATLAB v4 element types, by the P digit of the MOPT type code
+matlab_types = {0: "f8", 1: "f4", 2: "i4", 3: "i2", 4: "u2", 5: "u1"}
+
+def read_matlab_v4(path):
+    # ITK writes .mat transforms in the MATLAB v4 format: each variable is a 20 byte header
+    # (type, rows, columns, imaginary flag, name length), the name, then the data column-major
+    variables = {}
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    offset = 0
+    while offset + 20 <= len(data):
+        byte_order = "<" if struct.unpack("<I", data[offset:offset + 4])[0] < 1000 else ">"
+
+        mopt, rows, columns, imaginary, name_length = struct.unpack(byte_order + "5i", data[offset:offset + 20])
+        offset += 20
+
+        name    = data[offset:offset + name_length].rstrip(b"\x00").decode()
+        offset += name_length
+
+        dtype = np.dtype(byte_order + matlab_types[(mopt % 1000)//10 % 10])
+        count = rows*columns*(2 if imaginary else 1)
+
+        values = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        offset += count*dtype.itemsize
+
+        variables[name] = values[:rows*columns].reshape((rows, columns), order="F").astype(np.float64)
+
+    return variables
+
+class AffineTransform:
+    def __init__(self, matrix, translation, center):
+        self.matrix      = np.asarray(matrix, dtype=np.float64)
+        self.translation = np.asarray(translation, dtype=np.float64)
+        self.center      = np.asarray(center, dtype=np.float64)
+
+    @property
+    def offset(self):
+        return self.translation + self.center - self.matrix.dot(self.center)
+
+    def map_points(self, points):
+        return points.dot(self.matrix.T) + self.offset
+
+def read_itk_affine(path):
+    variables = read_matlab_v4(path)
+
+    names = [ name for name in variables if name.startswith("AffineTransform_") or name.startswith("MatrixOffsetTransformBase_") ]
+
+    if len(names) == 0:
+        raise ValueError("{} doesn't contain an ITK affine transform.".format(path))
+
+    # 9 matrix elements row by row, then the translation; the center of rotation is stored separately
+    parameters = variables[names[0]].ravel()
+    center     = variables["fixed"].ravel() if "fixed" in variables else np.zeros(3)
+
+    if len(parameters) != 12:
+        raise ValueError("{} holds a {} parameter transform; only 3D affine transforms are supported.".format(path, len(parameters)))
+
+    return AffineTransform(parameters[:9].reshape((3, 3)), parameters[9:], center)
+
+def write_itk_affine(path, transform):
+    # the layout antsRegistration writes, little-endian doubles
+    variables = [("AffineTransform_double_3_3", np.concatenate([transform.matrix.ravel(), transform.translation])), ("fixed", transform.center)]
+
+    with open(path, "wb") as f:
+        for name, values in variables:
+            name = name.encode() + b"\x00"
+
+            f.write(struct.pack("<5i", 0, len(values), 1, 0, len(name)))
+            f.write(name)
+            f.write(np.asarray(values, dtype="<f8").tobytes())
+
+def voxel_to_lps(image):
+    return ras_to_lps.dot(image.affine)
+
+def apply_affine(affine, points):
+    return points.dot(affine[:3, :3].T) + affine[:3, 3]
+
+# bytes held per box voxel and component while it's read: the float32 copy, and the raw or
+# scaled values it's converted from
+bytes_per_box_voxel = 12
+
+def trilinear(data, shape, voxels, max_box_bytes=None):
+    # linear interpolation like ITK's: points up to half a voxel outside the image take the edge
+    # values, points further out are 0; only the box the points fall in is read, so data can be
+    # a memory-mapped image or an array proxy
+    shape  = np.array(shape[:3])
+    inside = np.all((voxels >= -0.5) & (voxels < shape - 0.5), axis=1)
+
+    num_components = int(np.prod(data.shape[3:])) if len(data.shape) > 3 else 1
+    values         = np.zeros((len(voxels), num_components), dtype=np.float32)
+
+    if not inside.any():
+        return values
+
+    values[inside] = interpolate(data, shape, np.clip(voxels[inside], 0, shape - 1), num_components, max_box_bytes)
+
+    return values
+
+def interpolate(data, shape, voxels, num_components, max_box_bytes):
+    lower = np.minimum(np.floor(voxels).astype(np.intp), np.maximum(shape - 2, 0))
+    upper = np.minimum(lower + 1, shape - 1)
+
+    box_start = lower.min(axis=0)
+    box_stop  = upper.max(axis=0) + 1
+    extent    = box_stop - box_start
+
+    # points spread across the image would read most of it at once, eg. through a strongly
+    # rotated affine; split them in half across the box's longest axis until their boxes fit
+    if max_box_bytes is not None and int(np.prod(extent))*num_components*bytes_per_box_voxel > max_box_bytes and extent.max() > 2:
+        axis  = int(np.argmax(extent))
+        first = lower[:, axis] < box_start[axis] + extent[axis]//2
+
+        result         = np.empty((len(voxels), num_components), dtype=np.float32)
+        result[first]  = interpolate(data, shape, voxels[first], num_components, max_box_bytes)
+        result[~first] = interpolate(data, shape, voxels[~first], num_components, max_box_bytes)
+
+        return result
+
+    fractions = (voxels - lower).astype(np.float32)
+
+    box = np.asarray(data[box_start[0]:box_stop[0], box_start[1]:box_stop[1], box_start[2]:box_stop[2]], dtype=np.float32)
+    box = box.reshape(tuple(box.shape[:3]) + (num_components,))
+
+    lower -= box_start
+    upper -= box_start
+
+    result = np.zeros((len(voxels), num_components), dtype=np.float32)
+
+    for corner in range(8):
+        indices = []
+        weights = np.ones(len(voxels), dtype=np.float32)
+
+        for axis in range(3):
+            if corner >> axis & 1:
+                indices.append(upper[:, axis])
+                weights *= fractions[:, axis]
+            else:
+                indices.append(lower[:, axis])
+                weights *= 1 - fractions[:, axis]
+
+        result += box[indices[0], indices[1], indices[2]]*weights[:, None]
+
+    return result
+
+class DisplacementField:
+    def __init__(self, path, max_box_bytes=None):
+        image = nib.load(path, mmap=True)
+
+        # a displacement field is stored as a 5D vector image, with its LPS vectors along the last axis
+        if len(image.shape) != 5 or image.shape[4] != 3:
+            raise ValueError("{} is not a 3D displacement field.".format(path))
+
+        self.path          = path
+        self.data          = image.dataobj
+        self.shape         = image.shape
+        self.max_box_bytes = max_box_bytes
+
+        # every box read from a compressed file would decompress it from the start; large
+        # fields are staged before they get here, so this copy stays small
+        if path.endswith(".gz"):
+            self.data = np.asarray(image.dataobj, dtype=np.float32)
+
+        self.lps_to_voxel = np.linalg.inv(voxel_to_lps(image))
+
+    def map_points(self, points):
+        return points + trilinear(self.data, self.shape, apply_affine(self.lps_to_voxel, points), self.max_box_bytes)
+
+def load_transform(path, max_box_bytes=None):
+    if path.endswith(".mat"):
+        return read_itk_affine(path)
+
+    if path.endswith(".nii") or path.endswith(".nii.gz"):
+        return DisplacementField(path, max_box_bytes)
+
+    raise ValueError("Unsupported transform file {}.".format(path))
+
+class TransformStack:
+    # transforms in antsApplyTransforms order, eg. [1Warp, 0GenericAffine]: the composite maps
+    # fixed space points through the first one first, so the SyN field is looked up at the fixed
+    # point and the affine is applied to the result, A(x + u(x))
+    def __init__(self, paths, max_box_bytes=None):
+        self.paths      = list(paths)
+        self.transforms = [ load_transform(path, max_box_bytes) for path in self.paths ]
+
+    def map_points(self, points):
+        for transform in self.transforms:
+            points = transform.map_points(points)
+
+        return points
+
+def grid_points(start, stop):
+    # voxel indices of a block, x varying slowest so the values reshape to (x, y, z)
+    i, j, k = np.meshgrid(*[ np.arange(first, last) for first, last in zip(start, stop) ], indexing="ij")
+
+    return np.stack([i.ravel(), j.ravel(), k.ravel()], axis=1).astype(np.float64)
+
+class SliceTransformer:
+    # maps the fixed image's Z slices into moving space one at a time; the points only depend on
+    # the transforms, so every channel warped with them shares the recently used slices
+    def __init__(self, fixed_image_path, transform_paths, max_slices=16):
+        fixed_image = nib.load(fixed_image_path)
+
+        self.shape        = fixed_image.shape[:3]
+        self.voxel_to_lps = voxel_to_lps(fixed_image)
+        self.transforms   = TransformStack(transform_paths)
+        self.max_slices   = max_slices
+
+        self.points = OrderedDict()
+        self.lock   = threading.Lock()
+
+    @property
+    def depth(self):
+        return self.shape[2]
+
+    def slice_points(self, z):
+        with self.lock:
+            points = self.points.get(z)
+
+            if points is not None:
+                self.points.move_to_end(z)
+                return points
+
+        points = self.transforms.map_points(apply_affine(self.voxel_to_lps, grid_points((0, 0, z), (self.shape[0], self.shape[1], z + 1))))
+
+        with self.lock:
+            self.points[z] = points
+
+            while len(self.points) > self.max_slices:
+                self.points.popitem(last=False)
+
+        return points
@@ -0,0 +1,283 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+import nibabel as nib
+
+from collections import OrderedDict
+
+from cache import default_cache_directory, file_key
+from staging import StagingCancelled
+from transforms import voxel_to_lps, apply_affine, trilinear
+
+# intensity windows by file, shared between every Volume opened on the same file
+intensity_windows = {}
+
+compressed_extensions = (".gz", ".bz2", ".zst")
+
+class VolumeLoadCancelled(Exception):
+    pass
+
+class Volume:
+    def __init__(self, path, percentiles=(0.5, 99.5), num_sample_slices=16, max_samples_per_slice=65536):
+        self.path = path
+
+        self.percentiles           = percentiles
+        self.num_sample_slices     = num_sample_slices
+        self.max_samples_per_slice = max_samples_per_slice
+
+        self.window = None
+        self.luts   = {}
+        self.data   = None
+
+        # only the header is read here; voxel data stays on disk behind the array proxy
+        # (memory-mapped for uncompressed files) until a slice is asked for
+        self.image = nib.load(path, mmap="r", keep_file_open=True)
+        self.shape = self.image.shape
+
+    @property
+    def depth(self):
+        return self.shape[2]
+
+    @property
+    def is_compressed(self):
+        return self.path.endswith(compressed_extensions)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes if self.data is not None else 0
+
+    def load(self, progress_callback=None, cancelled=None, slab_bytes=64*1024**2):
+        # compressed files can't be memory-mapped, and every slice read would have to
+        # decompress the file up to it, so decompress them once into memory, slab by slab
+        if self.is_compressed and self.data is None:
+            slice_bytes = self.shape[0]*self.shape[1]*self.image.get_data_dtype().itemsize
+            slab_depth  = max(1, slab_bytes//slice_bytes)
+
+            data = None
+            for z in range(0, self.depth, slab_depth):
+                if cancelled is not None and cancelled():
+                    raise VolumeLoadCancelled(self.path)
+
+                if len(self.shape) > 3:
+                    slab = np.asarray(self.image.dataobj[:, :, z:z+slab_depth, 0])
+                else:
+                    slab = np.asarray(self.image.dataobj[:, :, z:z+slab_depth])
+
+                if data is None:
+                    data = np.empty(self.shape[:3], dtype=slab.dtype)
+
+                data[:, :, z:z+slab_depth] = slab
+
+                if progress_callback is not None:
+                    progress_callback(min(z + slab_depth, self.depth), self.depth)
+
+            self.data = data
+        elif progress_callback is not None:
+            progress_callback(self.depth, self.depth)
+
+        self.get_intensity_window()
+
+        return self
+
+    def get_slice(self, z):
+        if self.data is not None:
+            return self.data[:, :, z]
+
+        if len(self.shape) > 3:
+            return np.asarray(self.image.dataobj[:, :, z, 0])
+        else:
+            return np.asarray(self.image.dataobj[:, :, z])
+
+    def get_display_slice(self, z):
+        image = self.get_slice(z)
+
+        if image.dtype.kind in "ui" and image.dtype.itemsize <= 2:
+            lut = self.get_lut(image.dtype)
+
+            if image.dtype.kind == "i":
+                return np.take(lut, image.astype(np.int32) - np.iinfo(image.dtype).min)
+            else:
+                return np.take(lut, image)
+
+        return apply_window(image, self.get_intensity_window())
+
+    def get_lut(self, dtype):
+        if dtype not in self.luts:
+            low, high = self.get_intensity_window()
+
+            info   = np.iinfo(dtype)
+            values = np.arange(info.min, info.max + 1, dtype=np.float64)
+
+            self.luts[dtype] = np.clip((values - low)*(255.0/(high - low)), 0, 255).astype(np.uint8)
+
+        return self.luts[dtype]
+
+    def get_intensity_window(self):
+        if self.window is None:
+            key = "{}:{}:{}".format(file_key(self.path), self.percentiles, self.num_sample_slices)
+
+            if key not in intensity_windows:
+                intensity_windows[key] = self.load_intensity_window(key)
+
+            self.window = intensity_windows[key]
+
+        return self.window
+
+    def load_intensity_window(self, key):
+        cache_path = os.path.join(default_cache_directory("intensity_windows"), hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path) as f:
+                    return tuple(json.load(f)["window"])
+            except (OSError, ValueError, KeyError):
+                pass
+
+        window = self.compute_intensity_window()
+
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+            with open(cache_path, "w") as f:
+                json.dump({"path": self.path, "window": window}, f)
+        except OSError:
+            pass
+
+        return window
+
+    def compute_intensity_window(self):
+        # estimate the percentiles from a strided subset of evenly spaced slices instead of
+        # reading the whole volume
+        sample_z = np.unique(np.linspace(0, self.depth - 1, min(self.num_sample_slices, self.depth)).round().astype(int))
+
+        samples = []
+        for z in sample_z:
+            image = self.get_slice(z)
+            step  = max(1, int(np.ceil(np.sqrt(image.size/self.max_samples_per_slice))))
+
+            samples.append(image[::step, ::step].ravel().astype(np.float64))
+
+        samples = np.concatenate(samples)
+        samples = samples[np.isfinite(samples)]
+
+        if len(samples) == 0:
+            return (0.0, 255.0)
+
+        low, high = np.percentile(samples, self.percentiles)
+
+        if high <= low:
+            high = low + 1
+
+        return (float(low), float(high))
+
+def apply_window(image, window):
+    low, high = window
+
+    image = (image.astype(np.float32) - low)*(255.0/(high - low))
+    np.clip(image, 0, 255, out=image)
+
+    return image.astype(np.uint8)
+
+class WarpedVolume:
+    # a moving channel as it looks in fixed space, resampled slice by slice as slices are shown,
+    # instead of reading the output of antsApplyTransforms
+    def __init__(self, volume, transformer):
+        self.volume      = volume
+        self.transformer = transformer
+
+        self.path  = volume.path
+        self.shape = transformer.shape
+
+        self.lps_to_voxel = np.linalg.inv(voxel_to_lps(volume.image))
+
+    @property
+    def depth(self):
+        return self.transformer.depth
+
+    @property
+    def nbytes(self):
+        return self.volume.nbytes
+
+    def get_slice(self, z):
+        data   = self.volume.data if self.volume.data is not None else self.volume.image.dataobj
+        voxels = apply_affine(self.lps_to_voxel, self.transformer.slice_points(z))
+
+        return trilinear(data, self.volume.shape, voxels)[:, 0].reshape(self.shape[:2])
+
+    def get_intensity_window(self):
+        # the moving channel's window, so warping doesn't change how it's displayed
+        return self.volume.get_intensity_window()
+
+    def get_display_slice(self, z):
+        return apply_window(self.get_slice(z), self.get_intensity_window())
+
+class VolumeCache:
+    def __init__(self, max_bytes=2*1024**3, staging_cache=None):
+        self.max_bytes     = max_bytes
+        self.staging_cache = staging_cache
+
+        self.volumes   = OrderedDict()
+        self.num_bytes = 0
+        self.lock      = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            entry = self.volumes.get(os.path.abspath(path))
+
+            if entry is None:
+                return None
+
+            key, volume = entry
+
+            # the file changed since it was loaded
+            if not os.path.exists(path) or file_key(path) != key:
+                del self.volumes[os.path.abspath(path)]
+                self.num_bytes -= volume.nbytes
+                return None
+
+            self.volumes.move_to_end(os.path.abspath(path))
+
+            return volume
+
+    def put(self, path, volume):
+        key  = file_key(path)
+        path = os.path.abspath(path)
+
+        with self.lock:
+            if path in self.volumes:
+                self.num_bytes -= self.volumes.pop(path)[1].nbytes
+
+            self.volumes[path] = (key, volume)
+            self.num_bytes    += volume.nbytes
+
+            # evict least recently used volumes, but always keep the newest one
+            while self.num_bytes > self.max_bytes and len(self.volumes) > 1:
+                old_path, (old_key, old_volume) = self.volumes.popitem(last=False)
+                self.num_bytes -= old_volume.nbytes
+
+    def load(self, path, progress_callback=None, cancelled=None):
+        volume = self.get(path)
+
+        if volume is None:
+            staged_path = path
+
+            # large compressed files are decompressed once to a memory-mappable copy on disk
+            if self.staging_cache is not None and self.staging_cache.needs_staging(path):
+                try:
+                    staged_path = self.staging_cache.stage(path, progress_callback=progress_callback, cancelled=cancelled)
+                except StagingCancelled:
+                    raise VolumeLoadCancelled(path)
+                except OSError:
+                    staged_path = path
+
+            volume = Volume(staged_path).load(progress_callback=progress_callback, cancelled=cancelled)
+            self.put(path, volume)
+
+        return volume
+
+    def clear(self):
+        with self.lock:
+            self.volumes.clear()
+            self.num_bytes = 0
@@ -0,0 +1,83 @@
+import os
+import json
+import time
+import uuid
+
+def new_job_id():
+    return "{}-{}".format(time.strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:8])
+
+def image_name(path):
+    filename = os.path.basename(path)
+
+    for extension in (".nii.gz", ".nii"):
+        if filename.endswith(extension):
+            return filename[:-len(extension)]
+
+    return os.path.splitext(filename)[0]
+
+class Workspace:
+    def __init__(self, root, job_id=None, prefix="warp_"):
+        self.root   = os.path.abspath(root)
+        self.job_id = job_id if job_id is not None else new_job_id()
+        self.prefix = prefix
+
+        self.directory = os.path.join(self.root, self.job_id)
+
+    def create(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def transform_prefix(self):
+        return os.path.join(self.directory, self.prefix)
+
+    @property
+    def affine_path(self):
+        return self.transform_prefix + "0GenericAffine.mat"
+
+    @property
+    def warp_path(self):
+        return self.transform_prefix + "1Warp.nii.gz"
+
+    @property
+    def checkpoint_path(self):
+        return os.path.join(self.directory, "checkpoint.json")
+
+    def stage_prefix(self, stage):
+        return os.path.join(self.directory, "{}{}_".format(self.prefix, stage))
+
+    def stage_affine_path(self, stage):
+        return self.stage_prefix(stage) + "0GenericAffine.mat"
+
+    def load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return []
+
+        with open(self.checkpoint_path) as f:
+            return json.load(f)["completed_stages"]
+
+    def save_checkpoint(self, completed_stages):
+        temp_path = self.checkpoint_path + ".tmp"
+
+        with open(temp_path, "w") as f:
+            json.dump({"completed_stages": completed_stages}, f)
+
+        os.replace(temp_path, self.checkpoint_path)
+
+    @property
+    def params_path(self):
+        return os.path.join(self.directory, "params.json")
+
+    def save_params(self, params, params_hash):
+        with open(self.params_path, "w") as f:
+            json.dump({"hash": params_hash, "params": params}, f, indent=4, sort_keys=True)
+
+    @property
+    def log_path(self):
+        return os.path.join(self.directory, "registration.log")
+
+    @property
+    def telemetry_path(self):
+        return os.path.join(self.directory, "telemetry.csv")
+
+    def warped_image_path(self, moving_image_path, fixed_image_path):
+        return os.path.join(self.directory, "{}_warped_to_{}.nii.gz".format(image_name(moving_image_path), image_name(fixed_image_path)))